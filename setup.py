@@ -55,5 +55,6 @@ if __name__ == "__main__":
         packages=find_packages(where=os.path.join(HERE, 'source')),
         install_requires=['ruamel.yaml>=0.15', 'PyQt5>=5.5', 'ipgetter>=0.6'],
         package_data=get_package_data_files(),
-        entry_points={'console_scripts': ['imperialism_remake_start=imperialism_remake.start:main']},
+        entry_points={'console_scripts': ['imperialism_remake_start=imperialism_remake.start:main',
+                                          'imperialism_remake_server=imperialism_remake.start_server:main']},
         zip_safe=False)
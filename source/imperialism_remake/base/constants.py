@@ -136,6 +136,7 @@ class M(utils.AutoNumberedEnum):
 
     SYSTEM_SHUTDOWN = ()
     SYSTEM_MONITOR_UPDATE = ()
+    SYSTEM_METRICS = ()
 
     CHAT_SUBSCRIBE = ()
     CHAT_UNSUBSCRIBE = ()
@@ -147,6 +148,9 @@ class M(utils.AutoNumberedEnum):
     LOBBY_SCENARIO_CORE_LIST = ()
     LOBBY_SCENARIO_PREVIEW = ()
     LOBBY_CONNECTED_CLIENTS = ()
+    LOBBY_SESSION_CREATE = ()
+    LOBBY_SESSION_LIST = ()
+    LOBBY_SESSION_JOIN = ()
 
 
 @unique
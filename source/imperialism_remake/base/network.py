@@ -24,11 +24,19 @@ import logging
 from PyQt5 import QtCore, QtNetwork
 
 from imperialism_remake.base import constants
-from imperialism_remake.lib import network as lib_network
+from imperialism_remake.lib import network as lib_network, protocol as lib_protocol
 
 
 logger = logging.getLogger(__name__)
 
+# enums that are sent over the network are encoded as small integers by the binary codec (order matters)
+lib_protocol.binary_codec.register_enums(constants.C, constants.M, constants.ScenarioProperty,
+                                         constants.NationProperty, constants.ProvinceProperty)
+
+# preset dictionary for compressing small letters: all actions with their channel (action names start with the channel)
+lib_protocol.set_preset_dictionary(b''.join(lib_protocol.binary_codec.encode(
+    {'channel': constants.C[action.name.split('_')[0]], 'action': action, 'content': None}) for action in constants.M))
+
 
 class NetworkClient(lib_network.ExtendedTcpSocket):
     """
@@ -50,9 +58,19 @@ class NetworkClient(lib_network.ExtendedTcpSocket):
         :param socket: A socket if there is one existing already.
         """
         super().__init__(socket)
+        self.letter_types = (constants.C, constants.M)
         self.received.connect(self._process)
         self.channels = {}
 
+        # requests waiting for their reply by id and the id of the request that is currently processed (letters sent
+        # during processing are replies to it)
+        self.requests = {}
+        self._request_counter = 0
+        self.current_request = None
+
+        # dispatch table (see lib/dispatch.py) asked before the channels or None
+        self.dispatcher = None
+
     def create_new_channel(self, channel: constants.C):
         """
         Given a new channel name (cannot already exist, otherwise an error will be thrown) creates
@@ -118,20 +136,46 @@ class NetworkClient(lib_network.ExtendedTcpSocket):
         """
         logger.debug('network client received letter: {}'.format(letter))
         channel = letter['channel']
-
-        # do we have receivers in this category
-        if channel not in self.channels:
-            raise RuntimeError('Received message on channel {} which is not existing.'
-                               .format(channel))
-
-        # send to channel and increase channel counter
-        self.channels[channel].message_counter += 1
-        self.channels[channel].received.emit(self, channel, letter['action'], letter['content'])
+        action = letter['action']
+
+        # replies go to their request only
+        reply_id = letter.get('reply')
+        if reply_id is not None:
+            self.metrics.count(('messages_in', channel, action))
+            self.metrics.count(('bytes_in', channel, action), self.last_received_size)
+            request = self.requests.get(reply_id)
+            if request is None:
+                logger.debug('dropped reply to cancelled or timed out request %d', reply_id)
+                return
+            request.finish()
+            if request.callback is not None:
+                request.callback(self, channel, action, letter['content'])
+            return
+
+        # count per channel and action, then give to the handler of the action or send to channel (letters sent
+        # meanwhile are replies to a request)
+        self.metrics.count(('messages_in', channel, action))
+        self.metrics.count(('bytes_in', channel, action), self.last_received_size)
+        self.current_request = letter.get('request')
+        try:
+            if self.dispatcher is not None and self.dispatcher.dispatch(self, channel, action, letter['content']):
+                return
+
+            # do we have receivers in this category
+            if channel not in self.channels:
+                if self.dispatcher is not None:
+                    logger.warning('no handler for %s/%s', channel, action)
+                    return
+                raise RuntimeError('Received message on channel {} which is not existing.'
+                                   .format(channel))
+            self.channels[channel].received.emit(self, channel, action, letter['content'])
+        finally:
+            self.current_request = None
 
         # note: channel with name channel_name may now already not be existing anymore (may be
         # removed during processing)
 
-    def send(self, channel: constants.C, action: constants.M, content=None):
+    def send(self, channel: constants.C, action: constants.M, content=None, reply_to=None):
         """
         Given a channel and a action id and optionally a message content wraps them in one dict
         (a letter) and sends it.
@@ -139,12 +183,146 @@ class NetworkClient(lib_network.ExtendedTcpSocket):
         :param channel: Channel id
         :param action: action id
         :param content: Message content
+        :param reply_to: Id of the request this is a reply to or None for the request currently processed (if any)
         """
         # wrap content
+        letter = self._letter(channel, action, content, reply_to)
+
+        # send and count per channel and action
+        size = super().send(letter)
+        self.metrics.count(('messages_out', channel, action))
+        self.metrics.count(('bytes_out', channel, action), size)
+
+    def request(self, channel: constants.C, action: constants.M, content=None, callback=None, timeout=None,
+                timed_out=None):
+        """
+        Like send() but with a request id. The reply of the receiver (a letter it sends while processing the request)
+        goes only to the callback, not to the receivers of the channel. Many requests can wait for their replies at
+        the same time. Replies after a timeout or cancellation are dropped.
+
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :param callback: Called with the reply like the receivers of a channel (client, channel, action, content)
+        :param timeout: Seconds to wait for the reply or None (wait as long as it takes)
+        :param timed_out: Called with the Request if no reply arrived in time
+        :return: The Request (not pending if the letter was dropped, see limit_write_queue())
+        """
+        self._request_counter += 1
+        request = Request(self, self._request_counter, callback, timed_out)
+
+        letter = {'channel': channel, 'action': action, 'content': content, 'request': request.request_id}
+        size = super().send(letter)
+        self.metrics.count(('messages_out', channel, action))
+        self.metrics.count(('bytes_out', channel, action), size)
+
+        # waits only if sent, a dropped request (write queue full) is never answered
+        if size:
+            self.requests[request.request_id] = request
+            if timeout is not None:
+                request.start_timer(timeout)
+        return request
+
+    def send_chunked(self, channel: constants.C, action: constants.M, content=None, reply_to=None):
+        """
+        Like send() but the letter is sent in chunks (for large contents, see ExtendedTcpSocket.send_chunked()).
+
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :param reply_to: See send()
+        :return: Id of the transfer or None if the letter was not sent
+        """
+        transfer_id = super().send_chunked(self._letter(channel, action, content, reply_to))
+        # count per channel and action like send()
+        self.metrics.count(('messages_out', channel, action))
+        self.metrics.count(('bytes_out', channel, action), self.last_sent_size if transfer_id is not None else 0)
+        return transfer_id
+
+    def pack_letter(self, channel: constants.C, action: constants.M, content=None):
+        """
+        Like send() but only wraps and packs the letter into a frame (see ExtendedTcpSocket.pack()) which then can
+        be written to many clients with the same codec.
+
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :return: The frame
+        """
+        return self.pack({'channel': channel, 'action': action, 'content': content})
+
+    def _letter(self, channel: constants.C, action: constants.M, content, reply_to):
+        """
+        Wraps channel, action and content in a letter, which is a reply if a request id is given or if a request is
+        currently processed. Not intended for outside use.
+        """
         letter = {'channel': channel, 'action': action, 'content': content}
+        if reply_to is None:
+            reply_to = self.current_request
+        if reply_to is not None:
+            letter['reply'] = reply_to
+        return letter
+
+
+class Request:
+    """
+    A request sent by NetworkClient.request() that waits for its reply.
+    """
+
+    def __init__(self, client: NetworkClient, request_id, callback, timed_out):
+        """
+        :param client: The network client that sent the request
+        :param request_id: The id of the request (unique for the client)
+        :param callback: Called with the reply
+        :param timed_out: Called with the request if no reply arrived in time
+        """
+        self.client = client
+        self.request_id = request_id
+        self.callback = callback
+        self.timed_out = timed_out
+        self._timer = None
+
+    def start_timer(self, timeout):
+        """
+        Waits only a limited time for the reply.
 
-        # send
-        super().send(letter)
+        :param timeout: Time in seconds
+        """
+        self._timer = QtCore.QTimer(self.client)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._time_out)
+        self._timer.start(int(timeout * 1000))
+
+    def is_pending(self):
+        """
+        :return: True if still waiting for the reply
+        """
+        return self.client.requests.get(self.request_id) is self
+
+    def cancel(self):
+        """
+        Stops waiting for the reply, it will be dropped.
+        """
+        self.finish()
+
+    def finish(self):
+        """
+        The request is not waiting anymore (reply arrived, cancelled or timed out).
+        """
+        self.client.requests.pop(self.request_id, None)
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer.deleteLater()
+            self._timer = None
+
+    def _time_out(self):
+        """
+        No reply arrived in time. Not intended for outside use.
+        """
+        self.finish()
+        logger.warning('request %d timed out', self.request_id)
+        if self.timed_out is not None:
+            self.timed_out(self)
 
 
 class Channel(QtCore.QObject):
@@ -159,4 +337,3 @@ class Channel(QtCore.QObject):
 
     def __init__(self):
         super().__init__()
-        self.message_counter = 0
@@ -24,5 +24,49 @@ Global switches (and default values).
 # TODO check if this holds
 DEBUG_MODE = True
 
+#: interval in seconds for logging network metrics on the server (0 means never)
+NETWORK_METRICS_LOG_INTERVAL = 0
+
+#: interval in seconds between two pings on a network connection
+NETWORK_HEARTBEAT_INTERVAL = 5
+
+#: seconds without receiving anything after which a network connection is considered dead
+NETWORK_IDLE_TIMEOUT = 20
+
+#: interval in seconds at which the server measures the lag of its event loop (0 means never)
+SERVER_LAG_MONITOR_INTERVAL = 0.1
+
+#: seconds after which a handler of a message or a lag of the event loop on the server is logged as slow (0 means
+#: never)
+SERVER_SLOW_THRESHOLD = 0.05
+
+#: maximal (estimated) memory size in bytes of the cached scenario previews on the server
+SERVER_PREVIEW_CACHE_SIZE = 50 * 2 ** 20
+
+#: kind of the worker pool of the server for slow requests like scenario previews ('thread' or 'process')
+SERVER_WORKER_POOL = 'thread'
+
+#: number of workers in the worker pool of the server
+SERVER_WORKERS = 2
+
+#: maximal number of connected clients on the server, more connections are refused (0 means no limit)
+SERVER_MAX_CLIENTS = 0
+
+#: maximal number of game sessions of the server, each in its own worker process (0 means no limit), and seconds
+#: after which a session without clients ends
+SERVER_MAX_SESSIONS = 8
+SERVER_SESSION_IDLE_TIMEOUT = 60
+
+#: maximal number of bytes waiting to be sent to a server client (slow readers) and what happens with more messages:
+#: 'drop' them or 'disconnect' the client
+SERVER_WRITE_QUEUE_LIMIT = 4 * 2 ** 20
+SERVER_WRITE_QUEUE_POLICY = 'disconnect'
+
+#: number of chat messages the server remembers
+SERVER_CHAT_HISTORY_SIZE = 1000
+
+#: maximal number of cached scenario previews on the client
+CLIENT_PREVIEW_CACHE_SIZE = 10
+
 #: global switch for checking existence if files in constants (not needed if we are creating these files)
 FILE_EXISTENCE_CHECK = False
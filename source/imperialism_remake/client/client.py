@@ -25,7 +25,7 @@ import logging
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 
-from imperialism_remake.base import constants, tools, network as base_network
+from imperialism_remake.base import constants, switches, tools, network as base_network
 from imperialism_remake.client import audio, graphics
 from imperialism_remake.lib import qt, utils
 from imperialism_remake import version
@@ -334,39 +334,69 @@ class Client:
         # audio
         audio.soundtrack_player.stop()
 
-        # stop the local server
-        local_network_client.send(constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN)
-        # TODO is this okay, is there a better way
-        local_network_client.socket.flush()
+        # stop the local server (or stop connecting to it)
+        if local_network_client.is_connected():
+            local_network_client.send(constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN)
+            # TODO is this okay, is there a better way
+            local_network_client.flush()
+        else:
+            local_network_client.cancel_connect()
 
         # close the main window
         self.main_window.close()
 
 
-def local_network_connect():
+def local_network_connect(server_connection=None):
     """
-    Connect to a server running locally.
+    Starts connecting to a server running locally. Does not block, the name is sent as soon as we are connected.
+
+    :param server_connection: One end of a multiprocessing.Pipe() to the local server or None for connecting by TCP
     """
 
     # connect network client of client
     logger.info('client tries to connect to server')
-    local_network_client.connect_to_host(constants.NETWORK_PORT)
-    # TODO what if this is not possible
-    # that should always be possible, if not, we should try again, and then throw an error
+    local_network_client.enable_heartbeat(switches.NETWORK_HEARTBEAT_INTERVAL, switches.NETWORK_IDLE_TIMEOUT)
+    local_network_client.connected.connect(local_network_connected)
+    local_network_client.connection_failed.connect(local_network_connection_failed)
+    if server_connection is not None:
+        local_network_client.connect_to_pipe(server_connection)
+    else:
+        local_network_client.connect_to_host(constants.NETWORK_PORT)
+
 
-    # tell name
+def local_network_connected():
+    """
+    The network client of the client is connected, tell our name.
+    """
     local_network_client.send(constants.C.GENERAL, constants.M.GENERAL_NAME,
                               tools.get_option(constants.Option.LOCALCLIENT_NAME))
 
 
-def start_client():
+def local_network_connection_failed(description):
+    """
+    The network client of the client could not connect to the local server.
+
+    :param description: Description of the failure
+    """
+    # TODO show this to the user and offer to try again
+    logger.error('client could not connect to the local server: %s', description)
+
+
+def start_client(server_connection=None, server_thread=None):
     """
     Creates the Qt application and shows the main window.
+
+    :param server_connection: One end of a multiprocessing.Pipe() to the local server or None for connecting by TCP
+    :param server_thread: A server.ServerThread that is started together with the client or None
     """
 
     # create app
     app = QtWidgets.QApplication([])
 
+    # the server thread needs an application object
+    if server_thread is not None:
+        server_thread.start()
+
     # test for desktop availability
     desktop = app.desktop()
     rect = desktop.screenGeometry()
@@ -410,5 +440,5 @@ def start_client():
     # start Qt app execution and immediately try to connect to local server
     logger.info('client initialized, start Qt app execution')
     # noinspection PyCallByClass
-    QtCore.QTimer.singleShot(0, local_network_connect)
+    QtCore.QTimer.singleShot(0, partial(local_network_connect, server_connection))
     app.exec_()
@@ -22,7 +22,7 @@ from functools import partial
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 
-from imperialism_remake.base import constants, tools, network as base_network
+from imperialism_remake.base import constants, switches, tools, network as base_network
 from imperialism_remake.lib import qt, utils
 from imperialism_remake.client import graphics
 from imperialism_remake.client.client import local_network_client
@@ -183,6 +183,9 @@ class ServerLobby(QtWidgets.QWidget):
         # chat messages
         local_network_client.connect_to_channel(constants.C.CHAT, self.receive_chat_messages)
         local_network_client.send(constants.C.CHAT, constants.M.CHAT_SUBSCRIBE)
+        # the recent chat messages (contains all chat messages received until the reply)
+        self.chat_log_request = local_network_client.request(constants.C.CHAT, constants.M.CHAT_LOG,
+                                                             callback=self.receive_chat_log)
 
         # LOBBY
         local_network_client.connect_to_channel(constants.C.LOBBY, self.receive_lobby_messages)
@@ -215,6 +218,20 @@ class ServerLobby(QtWidgets.QWidget):
         if action == constants.M.CHAT_MESSAGE:
             self.chat_log_text_edit.append(content)
 
+    def receive_chat_log(self, client: base_network.NetworkClient, channel: constants.C, action: constants.M,
+                         content):
+        """
+        Receives the recent chat messages. Replaces the chat log.
+
+        :param client:
+        :param channel:
+        :param action:
+        :param content:
+        """
+        self.chat_log_text_edit.clear()
+        for chat_message in content['messages']:
+            self.chat_log_text_edit.append(chat_message)
+
     def request_updated_client_list(self):
         """
         Sends a request to get an updated connected client list.
@@ -243,12 +260,101 @@ class ServerLobby(QtWidgets.QWidget):
         """
         local_network_client.send(constants.C.CHAT, constants.M.CHAT_UNSUBSCRIBE)
         local_network_client.disconnect_from_channel(constants.C.CHAT, self.receive_chat_messages)
+        self.chat_log_request.cancel()
 
         local_network_client.disconnect_from_channel(constants.C.LOBBY, self.receive_lobby_messages)
 
         return True
 
 
+#: seconds to wait for a requested scenario preview
+PREVIEW_TIMEOUT = 30
+
+
+class ScenarioPreviewCache(QtCore.QObject):
+    """
+    Requests scenario previews from the server and keeps a limited number of them. Previews can be prefetched, showing
+    them then needs no waiting for the server. The drawing of the map of a preview (the outlines of all nations) is
+    prepared when the preview is shown first, not for every prefetched preview.
+    """
+
+    #: signal, emitted with the scenario file name if a requested preview has arrived
+    preview_ready = QtCore.pyqtSignal(str)
+
+    def __init__(self, maximal_number=switches.CLIENT_PREVIEW_CACHE_SIZE):
+        """
+        :param maximal_number: Maximal number of cached previews
+        """
+        super().__init__()
+        self._previews = utils.LRUCache(maximal_number, size_of=lambda _: 1)
+        self._requested = set()
+
+    def get(self, scenario_file):
+        """
+        :param scenario_file: The scenario file name
+        :return: Tuple of preview and nation outlines (see nation_outlines()) or None if not cached
+        """
+        entry = self._previews.get(scenario_file)
+        if entry is None:
+            return None
+        if entry[1] is None:
+            entry[1] = nation_outlines(entry[0])
+        return tuple(entry)
+
+    def request(self, scenario_file):
+        """
+        Requests a preview from the server unless it is cached or already requested. The preview_ready signal is
+        emitted on arrival.
+
+        :param scenario_file: The scenario file name
+        """
+        if scenario_file in self._previews or scenario_file in self._requested:
+            return
+        request = local_network_client.request(constants.C.LOBBY, constants.M.LOBBY_SCENARIO_PREVIEW, scenario_file,
+                                               self._received_preview, PREVIEW_TIMEOUT,
+                                               lambda request: self._requested.discard(scenario_file))
+        # a dropped request can be repeated
+        if request.is_pending():
+            self._requested.add(scenario_file)
+
+    def prefetch(self, scenario_files):
+        """
+        Requests the previews of several scenarios in the background (the most recently used are kept).
+
+        :param scenario_files: The scenario file names
+        """
+        for scenario_file in scenario_files:
+            self.request(scenario_file)
+
+    def _received_preview(self, client, channel, action, content):
+        """
+        A preview arrived, cache it (the nation outlines follow once it is shown). Not intended for outside use.
+        """
+        scenario_file = content['scenario']
+        self._requested.discard(scenario_file)
+        self._previews.put(scenario_file, [content, None])
+        self.preview_ready.emit(scenario_file)
+
+
+def nation_outlines(preview):
+    """
+    The outlines of all nations on the map of a scenario preview (in a single pass over the map).
+
+    :param preview: The scenario preview
+    :return: Dictionary of nation id to QPainterPath
+    """
+    columns = preview[constants.ScenarioProperty.MAP_COLUMNS]
+    paths = {nation_id: QtGui.QPainterPath() for nation_id in preview['nations']}
+    for index, nation_id in enumerate(preview['map']):
+        if nation_id in paths:
+            paths[nation_id].addRect(index % columns, index // columns, 1, 1)
+    return {nation_id: path.simplified() for nation_id, path in paths.items()}
+
+
+#: cached scenario previews of the lobby
+preview_cache = ScenarioPreviewCache()
+
+
 class SinglePlayerScenarioPreview(QtWidgets.QWidget):
     """
     Displays the preview of a single player scenario in the game lobby.
@@ -261,26 +367,36 @@ class SinglePlayerScenarioPreview(QtWidgets.QWidget):
 
     def __init__(self, scenario_file):
         """
-            Given a scenario file name, get the preview from the server.
+            Given a scenario file name, get the preview from the cache or the server.
         """
-        # TODO move the network communication outside this class.
         super().__init__()
 
-        # add a channel for us
-        local_network_client.connect_to_channel(constants.C.LOBBY, self.received_preview)
-
-        # send a message and ask for preview
-        local_network_client.send(constants.C.LOBBY, constants.M.LOBBY_SCENARIO_PREVIEW, scenario_file)
-
+        self.scenario_file = scenario_file
         self.selected_nation = None
 
-    def received_preview(self, client, channel, action, message):
+        cached = preview_cache.get(scenario_file)
+        if cached:
+            self.show_preview(*cached)
+        else:
+            preview_cache.preview_ready.connect(self.preview_ready)
+            preview_cache.request(scenario_file)
+
+    def preview_ready(self, scenario_file):
+        """
+        A requested preview has arrived, show it if it is ours.
         """
-        Populates the widget after the network reply comes from the server with the preview.
+        if scenario_file != self.scenario_file:
+            return
+        preview_cache.preview_ready.disconnect(self.preview_ready)
+        self.show_preview(*preview_cache.get(scenario_file))
+
+    def show_preview(self, message, outlines):
         """
+        Populates the widget with the preview.
 
-        # immediately unsubscribe, we need it only once
-        local_network_client.disconnect_from_channel(constants.C.LOBBY, self.received_preview)
+        :param message: The preview (see server.services.scenario_preview())
+        :param outlines: The nation outlines of the preview (see nation_outlines())
+        """
 
         # unpack message
         nations = [(message['nations'][key][constants.NationProperty.NAME], key) for key in message['nations']]
@@ -363,16 +479,7 @@ class SinglePlayerScenarioPreview(QtWidgets.QWidget):
             # get nation name
             nation_name = nation[constants.NationProperty.NAME]
 
-            # get nation outline
-            path = QtGui.QPainterPath()
-            # TODO traversing everything is quite slow go only once and add to paths
-            for column in range(0, columns):
-                for row in range(0, rows):
-                    if nation_id == message['map'][column + row * columns]:
-                        path.addRect(column, row, 1, 1)
-            path = path.simplified()
-
-            item = graphics.MiniMapNationItem(path)
+            item = graphics.MiniMapNationItem(outlines[nation_id])
             item.signaller.clicked.connect(
                 partial(self.map_selected_nation, utils.index_of_element(nation_names, nation_name)))
 #           item.signaller.entered.connect(partial(self.change_map_name, nation_name))
@@ -449,11 +556,9 @@ class SinglePlayerScenarioTitleSelection(QtWidgets.QGroupBox):
         self.setTitle('Select Scenario')
         self.layout = QtWidgets.QVBoxLayout(self)
 
-        # add a channel for us
-        local_network_client.connect_to_channel(constants.C.LOBBY, self.received_titles)
-
-        # send message and ask for scenario titles
-        local_network_client.send(constants.C.LOBBY, constants.M.LOBBY_SCENARIO_CORE_LIST)
+        # ask for scenario titles
+        self.titles_request = local_network_client.request(constants.C.LOBBY, constants.M.LOBBY_SCENARIO_CORE_LIST,
+                                                           callback=self.received_titles)
 
     def received_titles(self, client, channel, action, content):
         """
@@ -461,12 +566,12 @@ class SinglePlayerScenarioTitleSelection(QtWidgets.QGroupBox):
             which act as unique identifiers. The list is sorted by title.
         """
 
-        # immediately close the channel, we do not want to get this content twice
-        client.remove_channel(channel)
-
         # unpack content
         scenario_titles, self.scenario_files = zip(*content)
 
+        # the user will probably look at some of them
+        preview_cache.prefetch(self.scenario_files)
+
         # create list widget
         self.list = QtWidgets.QListWidget()
         self.list.itemSelectionChanged.connect(self.selection_changed)
@@ -493,5 +598,5 @@ class SinglePlayerScenarioTitleSelection(QtWidgets.QGroupBox):
         """
             Interruption. Clean up network channels and the like.
         """
-        # network channel might still be open
-        local_network_client.remove_channel(self.CH_TITLES, ignore_not_existing=True)
+        # the titles might not have arrived yet
+        self.titles_request.cancel()
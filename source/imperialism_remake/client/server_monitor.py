@@ -38,6 +38,8 @@ class ServerMonitorWidget(QtWidgets.QWidget):
 
         self.status = QtWidgets.QLabel('No information yet.')
         self.layout.addWidget(self.status)
+        self.network_status = QtWidgets.QLabel('')
+        self.layout.addWidget(self.network_status)
         self.layout.addStretch()
 
         local_network_client.connect_to_channel(constants.C.SYSTEM, self.update_monitor)
@@ -56,12 +58,33 @@ class ServerMonitorWidget(QtWidgets.QWidget):
         Sends a request for an update of the system monitor.
         """
         local_network_client.send(constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE)
+        local_network_client.send(constants.C.SYSTEM, constants.M.SYSTEM_METRICS)
 
     def update_monitor(self, client: base_network.NetworkClient, channel: constants.C,
                        action: constants.M, content):
         """
         Regular updates of the server stats
         """
+        if action == constants.M.SYSTEM_METRICS:
+            # messages in and out over all server clients
+            counters = content['total']['counters']
+            messages_in = sum(value for key, value in counters.items() if key[0] == 'messages_in')
+            messages_out = sum(value for key, value in counters.items() if key[0] == 'messages_out')
+            text = 'Server messages received: {} - sent: {}'.format(messages_in, messages_out)
+            if local_network_client.round_trip_time is not None:
+                text += ' - latency: {:.1f} ms'.format(local_network_client.round_trip_time * 1000)
+            if content['handlers']:
+                # the handler that took the most time in total (keys are 'handler', channel, action)
+                key, summary = max(content['handlers'].items(), key=lambda item: item[1]['count'] * item[1]['mean'])
+                text += '\nBusiest handler: {} ({} calls, {:.1f} ms in total)'.format(
+                    key[2].name, summary['count'], summary['count'] * summary['mean'] * 1000)
+            if content['loop_lag']['count']:
+                text += '\nEvent loop lag: {:.1f} ms (median), {:.1f} ms (99%), {:.1f} ms (max)'.format(
+                    content['loop_lag']['p50'] * 1000, content['loop_lag']['p99'] * 1000,
+                    content['loop_lag']['max'] * 1000)
+            self.network_status.setText(text)
+            return
+
         # get time and format it
         now = datetime.now().strftime('%H:%M:%S')
 
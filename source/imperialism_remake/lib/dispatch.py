@@ -0,0 +1,115 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Dispatch table for letters: one handler for each channel and action, called directly (no signal emission, no chain of
+comparisons) and timed.
+"""
+
+import time
+
+from imperialism_remake.lib import metrics
+
+
+class Dispatcher:
+    """
+    Maps (channel, action) to a handler. Handlers are called like the receivers of a channel (client, channel,
+    action, content). The number of calls and the time of each handler are recorded in a histogram with key
+    ('handler', channel, action).
+
+    An admission function (client, channel, action) can refuse letters before their handler is called (e.g. for rate
+    limiting), refused letters are dropped.
+
+    Handlers taking longer than a threshold are reported to a function (client, channel, action, seconds) and the
+    slowest call since the last take_slowest() is remembered, to find the cause of a blocked event loop.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.metrics = metrics.Metrics()
+        self.admission = None
+        self.slow_threshold = None
+        self.slow_handler = None
+        self._slowest = None
+
+    def register(self, channel, action, handler):
+        """
+        Registers the handler of an action.
+
+        :param channel: Channel id
+        :param action: action id
+        :param handler: A callable
+        """
+        key = (channel, action)
+        if key in self.handlers:
+            raise RuntimeError('Handler for {}/{} already registered.'.format(channel, action))
+        self.handlers[key] = handler
+
+    def unregister(self, channel, action):
+        """
+        Removes the handler of an action.
+
+        :param channel: Channel id
+        :param action: action id
+        """
+        del self.handlers[(channel, action)]
+
+    def dispatch(self, client, channel, action, content):
+        """
+        Calls the handler of an action if there is one.
+
+        :param client: The client that received the letter
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :return: True if there was a handler (also if the letter was refused)
+        """
+        handler = self.handlers.get((channel, action))
+        if handler is None:
+            return False
+        if self.admission is not None and not self.admission(client, channel, action):
+            return True
+        t0 = time.perf_counter()
+        try:
+            handler(client, channel, action, content)
+        finally:
+            seconds = time.perf_counter() - t0
+            self.metrics.observe(('handler', channel, action), seconds)
+            if self._slowest is None or seconds > self._slowest[0]:
+                self._slowest = (seconds, client, channel, action)
+            if self.slow_threshold is not None and seconds > self.slow_threshold and self.slow_handler is not None:
+                self.slow_handler(client, channel, action, seconds)
+        return True
+
+    def take_slowest(self):
+        """
+        The slowest handler call since the last time and forgets it.
+
+        :return: Tuple of seconds, client, channel and action or None if no handler was called
+        """
+        slowest = self._slowest
+        self._slowest = None
+        return slowest
+
+    def busiest_handlers(self, number=5):
+        """
+        The handlers that took the most time in total.
+
+        :param number: Number of handlers
+        :return: List of tuples of channel, action and histogram, busiest first
+        """
+        histograms = sorted(self.metrics.histograms.items(), key=lambda item: item[1].total, reverse=True)
+        return [(key[1], key[2], histogram) for key, histogram in histograms[:number]]
@@ -0,0 +1,178 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Simple metrics (counters, gauges and histograms) that are cheap to record and can be merged and exported.
+"""
+
+import collections
+import math
+
+
+class Histogram:
+    """
+    Histogram with logarithmic buckets (powers of two times a resolution). Records count, sum, minimum and maximum
+    exactly, percentiles are estimated (upper bound of the bucket, at most a factor two off).
+    """
+
+    def __init__(self, resolution=1e-6):
+        """
+        :param resolution: Values up to this size all fall into the first bucket (e.g. 1e-6 for times in seconds).
+        """
+        self.resolution = resolution
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, value):
+        """
+        Records a value.
+
+        :param value: The value (non-negative)
+        """
+        if value <= self.resolution:
+            index = 0
+        else:
+            index = math.ceil(math.log2(value / self.resolution))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, fraction):
+        """
+        Estimates a percentile.
+
+        :param fraction: Between 0 and 1 (e.g. 0.99)
+        :return: The estimated value or None if there are no values yet.
+        """
+        if self.count == 0:
+            return None
+        threshold = fraction * self.count
+        cumulated = 0
+        for index in sorted(self.buckets):
+            cumulated += self.buckets[index]
+            if cumulated >= threshold:
+                return min(self.resolution * 2 ** index, self.maximum)
+        return self.maximum
+
+    def mean(self):
+        """
+        Mean of all values or None if there are no values yet.
+        """
+        return self.total / self.count if self.count else None
+
+    def merge(self, other):
+        """
+        Adds the values of another histogram with the same resolution.
+
+        :param other: Histogram
+        """
+        if other.count == 0:
+            return
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+
+    def summary(self):
+        """
+        :return: Dictionary with count, mean, min, max and the 50, 90 and 99 percentiles.
+        """
+        return {'count': self.count, 'mean': self.mean(), 'min': self.minimum, 'max': self.maximum,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+
+class Metrics:
+    """
+    A collection of counters, gauges (last value) and histograms, each identified by a key (any hashable, for example
+    a tuple (name, channel, action)).
+    """
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, key, amount=1):
+        """
+        Increases a counter.
+
+        :param key: Key of the counter
+        :param amount: Amount
+        """
+        self.counters[key] += amount
+
+    def set(self, key, value):
+        """
+        Sets a gauge.
+
+        :param key: Key of the gauge
+        :param value: Value
+        """
+        self.gauges[key] = value
+
+    def observe(self, key, value, resolution=1e-6):
+        """
+        Records a value in a histogram.
+
+        :param key: Key of the histogram
+        :param value: Value
+        :param resolution: Resolution of the histogram if it does not exist yet (see Histogram)
+        """
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(resolution)
+        histogram.observe(value)
+
+    def merge(self, other):
+        """
+        Adds counters and histograms of other metrics, gauges are added up too.
+
+        :param other: Metrics
+        """
+        self.counters.update(other.counters)
+        for key, value in other.gauges.items():
+            self.gauges[key] = self.gauges.get(key, 0) + value
+        for key, histogram in other.histograms.items():
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(histogram.resolution)
+            self.histograms[key].merge(histogram)
+
+    def snapshot(self):
+        """
+        :return: Dictionary of all counters, gauges and histogram summaries (only basic types, can be sent).
+        """
+        return {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                'histograms': {key: histogram.summary() for key, histogram in self.histograms.items()}}
+
+    def top_counters(self, name, number=10):
+        """
+        The largest counters whose key is a tuple starting with a given name.
+
+        :param name: First element of the keys
+        :param number: Number of counters
+        :return: List of tuples of key and value, largest first
+        """
+        counters = [(key, value) for key, value in self.counters.items()
+                    if isinstance(key, tuple) and key[0] == name]
+        return sorted(counters, key=lambda item: item[1], reverse=True)[:number]
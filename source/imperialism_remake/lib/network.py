@@ -17,16 +17,19 @@
 """
 Basic general network functionality (client and server) wrapping around QtNetwork.QTcpSocket and QtNetwork.QTcpServer.
 
-Messages are sent using yaml (for serialization) and zlib (for compression).
+Messages are sent using a codec (binary or yaml, see lib/protocol.py, for serialization) and an adaptive compression
+(small messages are not compressed, see protocol.CompressionPolicy). The codec is negotiated when the connection opens,
+until then yaml is used.
 """
 
+import collections
 import logging
+import os
+import threading
 import time
-import zlib
 
 from PyQt5 import QtCore, QtNetwork
-from imperialism_remake.lib.utils import yaml
-from ruamel.yaml.compat import StringIO
+from imperialism_remake.lib import metrics, protocol
 
 #: shortcut for QtNetwork.QHostAddress.LocalHost/Any
 SCOPE = {'local': QtNetwork.QHostAddress.LocalHost, 'any': QtNetwork.QHostAddress.Any}
@@ -37,42 +40,161 @@ logger = logging.getLogger(__name__)
 class ExtendedTcpSocket(QtCore.QObject):
     """
     Wrapper around QtNetwork.QTcpSocket. The socket can either be given in the initialization or be created there.
-    Sends and reads messages via serialization (yaml), compression (zlib) and wrapping (QByteArray) as well as
-    un-wrapping, de-compressing and de-serialization on the other side.
+    Sends and reads messages via serialization (binary or yaml codec), compression (depending on the compression
+    policy) and length prefixed framing as well as buffering until frames are complete, de-compressing and
+    de-serialization on the other side.
+
+    Connecting (connect_to_host) does not block, failed attempts are repeated with increasing delays. Instead of TCP a
+    pipe to a local process can be used (connect_to_pipe).
+
+    The side that connects (connect_to_host) offers its codecs in a hello control frame as soon as it is connected,
+    the other side chooses one and acknowledges. Messages are sent with yaml until then and whenever the binary codec
+    cannot serialize a message.
+
+    If batching is enabled, messages sent during one iteration of the event loop are collected and sent as a single
+    batch frame when the control returns to the event loop or when the batch gets too large. The receiving side
+    unpacks batches transparently.
+
+    Large messages can be sent in chunks (send_chunked()). Chunks are only written while the amount of not yet written
+    bytes is below a window, more chunks follow whenever bytes were written. Other messages are not blocked meanwhile.
+    The receiving side reassembles the chunks and reports the progress.
+
+    If the heartbeat is enabled, ping control frames are sent regularly and answered by the peer with pong control
+    frames, giving the round trip time (exponentially weighted average and histogram). If nothing at all was received
+    for longer than the idle timeout, the connection is considered stalled (signal stalled).
+
+    If the write queue is limited, messages are not sent while too many bytes are waiting to be sent (a slow reader).
+    They are either dropped or the connection is aborted.
+
+    Metrics (see lib/metrics.py) record the time for serialization, compression, decompression and parsing, the
+    sizes of the write queue and the round trip time of the codec negotiation.
     """
 
     #: signal for socket connected
     connected = QtCore.pyqtSignal()
+    #: signal for a failed connect_to_host() (after all attempts) with a description
+    connection_failed = QtCore.pyqtSignal(str)
     #: signal for socket disconnected
     disconnected = QtCore.pyqtSignal()
     #: signal for a SocketError
     error = QtCore.pyqtSignal(QtNetwork.QAbstractSocket.SocketError)
     #: signal for a received message (only whole messages are emitted)
     received = QtCore.pyqtSignal(object)
-
-    def __init__(self, socket: QtNetwork.QTcpSocket = None):
+    #: signal for a stalled connection (nothing received within the idle timeout) with the seconds since the last
+    #: receipt
+    stalled = QtCore.pyqtSignal(float)
+    #: signal for the progress of a chunked transfer we send (transfer id, bytes sent, total bytes)
+    send_progress = QtCore.pyqtSignal(int, int, int)
+    #: signal for the progress of a chunked transfer we receive (transfer id, bytes received, total bytes)
+    receive_progress = QtCore.pyqtSignal(int, int, int)
+
+    def __init__(self, socket: QtNetwork.QTcpSocket = None, compression: protocol.CompressionPolicy = None):
         """
         Initializes the extended TCP socket. Either wraps around an existing socket or creates its own and resets
         the number of bytes written.
 
         :param socket: An already existing socket or None if none is given.
+        :param compression: Compression policy of sent frames or None for the default policy.
         """
         super().__init__()
 
-        # new QTcpSocket() if none is given
+        # new QTcpSocket() if none is given, then we are the side that connects and offers the codecs
         if socket is not None:
             self.socket = socket
         else:
             self.socket = QtNetwork.QTcpSocket()
+            self.socket.connected.connect(self._connect_succeeded)
+            self.socket.connected.connect(self._send_hello)
 
+        self.bytes_written = 0
+
+        # connecting (see connect_to_host), a timer for the timeout of an attempt and one for the delay until the next
+        self._connect_target = None
+        self._connect_attempts = 0
+        self._connect_failures = 0
+        self._connect_delay = (0, 0)
+        self._connect_timer = QtCore.QTimer(self)
+        self._connect_timer.setSingleShot(True)
+        self._connect_timer.timeout.connect(self._connect_attempt_failed)
+        self._retry_timer = QtCore.QTimer(self)
+        self._retry_timer.setSingleShot(True)
+        self._retry_timer.timeout.connect(self._connect_attempt)
+
+        # codecs in order of preference and the negotiated codec (yaml until negotiated)
+        self.codecs = list(protocol.CODECS)
+        self.codec = 'yaml'
+
+        # how to compress sent frames and statistics about frames, bytes and compression
+        self.compression = compression if compression is not None else protocol.CompressionPolicy()
+        self.statistics = protocol.FrameStatistics()
+        self.metrics = metrics.Metrics()
+
+        # if given (channel enum, action enum) every received message is validated as letter (see protocol)
+        self.letter_types = None
+
+        # size of the serialized message that is currently emitted with received
+        self.last_received_size = 0
+        # size of the serialized message of the last transfer started with send_chunked
+        self.last_sent_size = 0
+        # codecs offered with our hello until the peer acknowledged one (None if we did not offer)
+        self._offered_codecs = None
+        self._hello_time = None
+
+        # heartbeat (see enable_heartbeat), round trip time in seconds (weighted average) and time of the last receipt
+        self.heartbeat = False
+        self.idle_timeout = 0
+        self.round_trip_time = None
+        self._last_receipt_time = time.perf_counter()
+        self._stalled = False
+        self._heartbeat_timer = QtCore.QTimer(self)
+        self._heartbeat_timer.timeout.connect(self._beat)
+
+        # received bytes until they form complete frames
+        self._receive_buffer = protocol.FrameBuffer()
+
+        # optional batching of sent messages (see enable_batching)
+        self.batching = False
+        self.batch_size_limit = 0
+        self._batch = []
+        self._batch_size = 0
+        self._batch_timer = QtCore.QTimer(self)
+        self._batch_timer.setSingleShot(True)
+        self._batch_timer.setInterval(0)
+        self._batch_timer.timeout.connect(self.flush_batch)
+
+        # chunked transfers, outgoing (transfer id, frame, bytes sent) and incoming (limited, see IncomingTransfers)
+        self.chunk_size = 64 * 1024
+        self.transfer_window = 256 * 1024
+        self._transfer_counter = 0
+        self._outgoing_transfers = collections.deque()
+        self._incoming_transfers = protocol.IncomingTransfers()
+
+        # optional limit of the bytes waiting to be sent (see limit_write_queue)
+        self.write_queue_limit = None
+        self.write_queue_policy = 'drop'
+
+        self._wire_socket()
+
+    def _wire_socket(self):
+        """
+        Connects to the signals of the socket. A pipe socket is a trusted local connection, messages are pickled and
+        not compressed. Not intended for outside use.
+        """
         # some wiring, new data is handled by _receive()
         self.socket.readyRead.connect(self._receive)
         self.socket.error.connect(self.error)
+        self.socket.error.connect(self._connect_attempt_failed)
         self.socket.connected.connect(self.connected)
         self.socket.disconnected.connect(self.disconnected)
         self.socket.bytesWritten.connect(self.count_bytes_written)
+        self.socket.bytesWritten.connect(self._send_chunks)
+        self.socket.disconnected.connect(self._clear_transfers)
+        self.socket.connected.connect(self._start_heartbeat)
+        self.socket.disconnected.connect(self._stop_heartbeat)
 
-        self.bytes_written = 0
+        if isinstance(self.socket, PipeSocket):
+            self.codec = 'pickle'
+            self.compression = None
 
     def peer_address(self):
         """
@@ -82,36 +204,238 @@ class ExtendedTcpSocket(QtCore.QObject):
         """
         return self.socket.peerAddress(), self.socket.peerPort()
 
+    def is_local(self):
+        """
+        :return: True if the peer is on the same machine (loopback address or a pipe)
+        """
+        return self.socket.peerAddress().isLoopback()
+
+    def enable_batching(self, size_limit=64 * 1024):
+        """
+        From now on, messages are collected and sent as batches (see class description).
+
+        :param size_limit: A batch is sent immediately if its encoded messages reach this number of bytes.
+        """
+        self.batching = True
+        self.batch_size_limit = size_limit
+
+    def enable_heartbeat(self, interval=5, idle_timeout=20):
+        """
+        From now on, pings are sent regularly while connected and the connection is watched (see class description).
+
+        :param interval: Seconds between two pings (and checks for idleness).
+        :param idle_timeout: Seconds without any receipt after which the connection is stalled.
+        """
+        self.heartbeat = True
+        self.idle_timeout = idle_timeout
+        self._heartbeat_timer.setInterval(int(interval * 1000))
+        if self.is_connected():
+            self._start_heartbeat()
+
+    def limit_write_queue(self, size_limit, policy='drop'):
+        """
+        From now on, no messages are sent while too many bytes are waiting to be sent (see queued_bytes()). Dropped
+        messages are counted ('dropped_messages'), aborted connections too ('write_queue_overflows').
+
+        :param size_limit: Maximal number of bytes waiting to be sent
+        :param policy: 'drop' the messages or 'disconnect' (abort the connection)
+        """
+        if policy not in ('drop', 'disconnect'):
+            raise RuntimeError('Unknown write queue policy {}.'.format(policy))
+        self.write_queue_limit = size_limit
+        self.write_queue_policy = policy
+
+    def queued_bytes(self):
+        """
+        :return: Number of bytes waiting to be sent: not yet written by the socket, in the batch and the rest of the
+            outgoing transfers
+        """
+        transfers = sum(len(frame) - offset for _, frame, offset in self._outgoing_transfers)
+        return self.socket.bytesToWrite() + self._batch_size + transfers
+
+    def _write_queue_full(self):
+        """
+        Checks the limit of the write queue before sending a message and drops it or aborts the connection if too
+        many bytes are waiting (see limit_write_queue()). Not intended for outside use.
+
+        :return: True if the message must not be sent
+        """
+        if self.write_queue_limit is None:
+            return False
+        queued = self.queued_bytes()
+        if queued < self.write_queue_limit:
+            return False
+        if self.write_queue_policy == 'disconnect':
+            logger.warning('write queue full (%d bytes), abort connection', queued)
+            self.metrics.count('write_queue_overflows')
+            self.abort()
+        else:
+            self.metrics.count('dropped_messages')
+        return True
+
+    def _start_heartbeat(self):
+        """
+        Called by the sockets connected signal (or when the heartbeat is enabled). Not intended for outside use.
+        """
+        if self.heartbeat:
+            self._last_receipt_time = time.perf_counter()
+            self._stalled = False
+            self._heartbeat_timer.start()
+
+    def _stop_heartbeat(self):
+        """
+        Called by the sockets disconnected signal. Not intended for outside use.
+        """
+        self._heartbeat_timer.stop()
+
+    def _beat(self):
+        """
+        Called by the heartbeat timer. Checks for idleness and sends a ping. Not intended for outside use.
+        """
+        idle = time.perf_counter() - self._last_receipt_time
+        if idle > self.idle_timeout:
+            if not self._stalled:
+                self._stalled = True
+                logger.warning('socket stalled, nothing received for %.1fs', idle)
+                self.stalled.emit(idle)
+            return
+        if self.is_connected():
+            # the peer answers with our own time stamp
+            self._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_PING,
+                                                                                  time.perf_counter())))
+
+    def _update_round_trip_time(self, round_trip_time):
+        """
+        Records a measured round trip time. Not intended for outside use.
+
+        :param round_trip_time: Round trip time in seconds
+        """
+        self.metrics.observe('round_trip', round_trip_time)
+        if self.round_trip_time is None:
+            self.round_trip_time = round_trip_time
+        else:
+            self.round_trip_time += 0.2 * (round_trip_time - self.round_trip_time)
+
+    def flush(self):
+        """
+        Sends a pending batch and writes as much as possible from the internal write buffer to the network.
+        """
+        self.flush_batch()
+        self.socket.flush()
+
     def disconnect_from_host(self):
         """
         Attempts to close the underlying socket.
         """
+        self.flush_batch()
         self.socket.disconnectFromHost()
 
-    def connect_to_host(self, port, host='local'):
+    def abort(self):
+        """
+        Closes the underlying socket immediately, discarding everything not yet written.
+        """
+        self._batch = []
+        self._batch_size = 0
+        self.socket.abort()
+
+    def connect_to_host(self, port, host='local', attempts=10, timeout=2000, initial_delay=200, maximal_delay=5000):
         """
-        Tries to connect to a host specified by port and host address.
+        Starts connecting to a host specified by port and host address and returns immediately. If an attempt fails
+        (error or no connection within the timeout), the next attempt starts after a delay which doubles after every
+        failure (exponential backoff). Signal connected is emitted on success, signal connection_failed after the last
+        failed attempt.
 
         :param port: The port number to connect to.
         :param host: The host address (or 'local' for the local host) to connect to.
+        :param attempts: Maximal number of attempts.
+        :param timeout: Time in ms an attempt may take.
+        :param initial_delay: Delay in ms after the first failed attempt.
+        :param maximal_delay: Upper bound of the delay in ms.
         """
-        # TODO only if not yet connected
+        if self.is_connected() or self.is_connecting():
+            raise RuntimeError('Socket is already connected or connecting.')
         if host == 'local':
-            host = SCOPE['local']
+            host = QtNetwork.QHostAddress(SCOPE['local']).toString()
         logger.info('client connecting to host=%s port=%d', host, port)
-        # try to connect multiple times - maybe the server did not manage to start, yet
-        failure_count = 0
-        while True:
-            self.socket.connectToHost(host, port)
-            if self.socket.waitForConnected(2000):
-                break
-            else:
-                time.sleep(0.2)
-                logger.warning("connection delayed - will try again")
-                failure_count += 1
-                if failure_count == 10:
-                    raise RuntimeError('Failed to connect to server: host=%s port=%d', host, port)
-        logger.info('client successfully connected to host=%s port=%d', host, port)
+        self._connect_target = (host, port)
+        self._connect_attempts = attempts
+        self._connect_failures = 0
+        self._connect_timer.setInterval(timeout)
+        self._connect_delay = (initial_delay, maximal_delay)
+        self._connect_attempt()
+
+    def cancel_connect(self):
+        """
+        Stops connecting (see connect_to_host()). Nothing happens if we are not connecting.
+        """
+        if not self.is_connecting():
+            return
+        logger.info('client stopped connecting to host=%s port=%d', *self._connect_target)
+        self._connect_target = None
+        self._connect_timer.stop()
+        self._retry_timer.stop()
+        self.socket.abort()
+
+    def connect_to_pipe(self, connection):
+        """
+        Connects to a local process over a pipe instead of TCP (see PipeSocket). Signal connected is emitted
+        immediately.
+
+        :param connection: One end of a multiprocessing.Pipe(), the local process has the other end.
+        """
+        if self.is_connected() or self.is_connecting():
+            raise RuntimeError('Socket is already connected or connecting.')
+        logger.info('client connecting to local pipe')
+        self.socket = PipeSocket(connection)
+        self._wire_socket()
+        self.socket.open()
+
+    def is_connecting(self):
+        """
+
+        :return: True if connect_to_host() was called and the connection is neither established nor failed yet
+        """
+        return self._connect_target is not None
+
+    def _connect_attempt(self):
+        """
+        Starts a single connection attempt. Not intended for outside use.
+        """
+        self.socket.abort()
+        self._connect_timer.start()
+        self.socket.connectToHost(*self._connect_target)
+
+    def _connect_attempt_failed(self, *args):
+        """
+        Called on a socket error or if an attempt timed out. Schedules the next attempt or gives up. Not intended
+        for outside use.
+        """
+        if not self.is_connecting() or self.is_connected():
+            return
+        self._connect_timer.stop()
+        self.socket.abort()
+        self._connect_failures += 1
+        host, port = self._connect_target
+        if self._connect_failures >= self._connect_attempts:
+            self._connect_target = None
+            logger.error('failed to connect to server: host=%s port=%d', host, port)
+            self.connection_failed.emit('Failed to connect to host={} port={} after {} attempts.'.format(
+                host, port, self._connect_failures))
+            return
+        initial_delay, maximal_delay = self._connect_delay
+        delay = min(initial_delay * 2 ** (self._connect_failures - 1), maximal_delay)
+        logger.warning('connection delayed - will try again in %d ms', delay)
+        self._retry_timer.start(delay)
+
+    def _connect_succeeded(self):
+        """
+        Called by the sockets connected signal. Not intended for outside use.
+        """
+        if self.is_connecting():
+            self._connect_timer.stop()
+            self._retry_timer.stop()
+            logger.info('client successfully connected to host=%s port=%d', *self._connect_target)
+            self._connect_target = None
 
     def is_connected(self):
         """
@@ -123,54 +447,287 @@ class ExtendedTcpSocket(QtCore.QObject):
     def _receive(self):
         """
         Called by the sockets readyRead signal. Not intended for outside use.
-        While there are messages available read them and process them.
-        Reading is reading of a QByteArray from the TCPSocket, un-compressing and de-serializing.
+        Appends all available bytes to the receive buffer and processes all complete frames in it.
+        Processing is un-compressing and de-serializing. Frames may arrive in several parts or many at once.
         """
-        while self.socket.bytesAvailable() > 0:
-            logger.info('socket will receive')
-            # read a QByteArray using a data stream
-            reader = QtCore.QDataStream(self.socket)
-            bytearray = QtCore.QByteArray()
-            reader >> bytearray
+        self._receive_buffer.feed(self.socket.readAll().data())
+        self._last_receipt_time = time.perf_counter()
+        self._stalled = False
+
+        # decode all complete frames first (they are only views into the receive buffer), then process them
+        values = []
+        try:
+            for frame in self._receive_buffer.frames():
+                try:
+                    values.extend(self._decode_frame(frame))
+                except ValueError as e:
+                    # malformed or invalid, drop the frame
+                    logger.warning('socket dropped received frame: %s', e)
+                    self.metrics.count('rejected_frames')
+        except Exception as e:
+            # a frame too large (the stream cannot be resynchronized) or one that cannot be decoded at all
+            logger.warning('socket received invalid data, abort connection: %r', e)
+            self.metrics.count('protocol_errors')
+            self._receive_buffer.clear()
+            self.abort()
+            return
+
+        for kind, value, size in values:
+            if kind == protocol.KIND_CONTROL:
+                self._process_control(value)
+                continue
+            if kind == protocol.KIND_CHUNK:
+                self.receive_progress.emit(*value)
+                continue
 
-            # uncompress bytes from bytearray
-            uncompressed = zlib.decompress(bytearray.data())
+            logger.debug('socket received: %s', value)
 
-            # security validator (check for everything that we do not like (!!python)
-            # TODO implement this
+            self.last_received_size = size
+            self.received.emit(value)
 
-            # decode from utf-8 bytes to unicode and deserialize from yaml
-            value = yaml.load(uncompressed.decode())
+    def _decode_frame(self, frame, max_size=None):
+        """
+        Un-compresses and de-serializes a frame. Not intended for outside use.
 
-            logger.debug('socket received: %s', value)
+        :param frame: The frame
+        :param max_size: Maximal size of the uncompressed body or None for the maximal frame size
+        :return: List of tuples of frame kind, value and serialized size (several for a batch frame)
+        """
+        # first byte is the header (kind of frame and compression), uncompress the rest
+        t0 = time.perf_counter()
+        if max_size is None:
+            max_size = self._receive_buffer.max_frame_size
+        kind, uncompressed = protocol.unpack_frame(frame, self.statistics, max_size)
+        self.metrics.observe('decompress', time.perf_counter() - t0)
+
+        # deserialize with the codec given by the kind
+        if kind == protocol.KIND_CHUNK:
+            return self._receive_chunk(uncompressed)
+        if kind == protocol.KIND_BATCH:
+            return [self._decode_body(entry_kind, body) for entry_kind, body in protocol.unpack_batch(uncompressed)]
+        return [self._decode_body(kind, uncompressed)]
+
+    def _decode_body(self, kind, body):
+        """
+        De-serializes a body. Not intended for outside use.
 
-            self.received.emit(value)
+        :return: Tuple of frame kind, value and serialized size
+        """
+        t0 = time.perf_counter()
+        # only a pipe is trusted, never because of the negotiated codec
+        allow_pickle = isinstance(self.socket, PipeSocket)
+        if self.letter_types is not None and kind != protocol.KIND_CONTROL:
+            value = protocol.decode_letter(kind, body, *self.letter_types, allow_pickle=allow_pickle)
+        else:
+            value = protocol.decode_body(kind, body, allow_pickle)
+        self.metrics.observe('parse', time.perf_counter() - t0)
+        return kind, value, len(body)
+
+    def _receive_chunk(self, body):
+        """
+        Copies the data of a chunk into its transfer. Not intended for outside use.
+
+        :param body: Body of a chunk frame
+        :return: List of the progress (kind chunk) and the decoded message if the transfer is complete
+        """
+        transfer_id, received, total, data = self._incoming_transfers.add(body)
+        values = [(protocol.KIND_CHUNK, (transfer_id, received, total), len(body))]
+        if data is not None:
+            # complete, the transferred data is a frame itself
+            values.extend(self._decode_frame(data))
+        return values
+
+    def _process_control(self, value):
+        """
+        A control frame was received. Not intended for outside use.
+
+        :param value: Tuple of control message type and content
+        """
+        control, content = value
+        if control == protocol.CONTROL_HELLO:
+            # the peer offers codecs, choose one and acknowledge
+            self.codec = protocol.choose_codec(self.codecs, content)
+            self._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_HELLO_ACK,
+                                                                                  self.codec)))
+            logger.info('socket negotiated codec %s', self.codec)
+        elif control == protocol.CONTROL_HELLO_ACK:
+            # only an answer to our hello, with one of the codecs we offered
+            if self._offered_codecs is None or content not in protocol.CODECS or content not in self._offered_codecs:
+                logger.warning('socket ignored unexpected acknowledgement of codec %s', content)
+                return
+            self._offered_codecs = None
+            self.codec = content
+            self._update_round_trip_time(time.perf_counter() - self._hello_time)
+            logger.info('socket negotiated codec %s', self.codec)
+        elif control == protocol.CONTROL_PING:
+            self._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_PONG, content)))
+        elif control == protocol.CONTROL_PONG and isinstance(content, float):
+            self._update_round_trip_time(time.perf_counter() - content)
+        else:
+            logger.warning('socket received unknown control message %s', control)
+
+    def _send_hello(self):
+        """
+        Called by the sockets connected signal (if we initiated the connection). Not intended for outside use.
+        Offers our codecs to the peer.
+        """
+        self._offered_codecs = list(self.codecs)
+        self._hello_time = time.perf_counter()
+        self._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_HELLO, self.codecs)))
 
     def send(self, value):
         """
-        Sends a message by serializing, compressing and wrapping to a QByteArray, then streaming over the TCP socket.
+        Sends a message by serializing, compressing and prefixing the length, then streaming over the TCP socket.
 
         :param value: The message to send.
+        :return: Size of the serialized message in bytes (0 if the message was not sent)
         """
         if not self.is_connected():
             raise RuntimeError('Try to send on unconnected socket.')
 
+        if self._write_queue_full():
+            return 0
+
         logger.debug('socket send: %s', value)
-        # serialize value to yaml
-        stream = StringIO()
-        yaml.dump(value, stream)
-        serialized = stream.getvalue()
+        # serialize value with the negotiated codec
+        t0 = time.perf_counter()
+        kind, serialized = protocol.encode_body(value, self.codec)
+        self.metrics.observe('serialize', time.perf_counter() - t0)
+
+        if not self.batching:
+            self._send_frame(kind, serialized)
+            return len(serialized)
+
+        # add to batch, send at next event loop iteration or now if the batch is large enough
+        self._batch.append((kind, serialized))
+        self._batch_size += len(serialized)
+        self.metrics.set('batch_length', len(self._batch))
+        if self._batch_size >= self.batch_size_limit:
+            self.flush_batch()
+        elif not self._batch_timer.isActive():
+            self._batch_timer.start()
+        return len(serialized)
+
+    def pack(self, value):
+        """
+        Serializes and compresses a message into a frame ready for writing (with length prefix) using the codec and
+        the compression policy of this socket. Useful for sending the same message to many sockets with the same
+        codec (see write_frame()).
+
+        :param value: The message
+        :return: bytes
+        """
+        kind, serialized = protocol.encode_body(value, self.codec)
+        return protocol.prefix_length(protocol.pack_frame(kind, serialized, self.compression, self.statistics))
+
+    def write_frame(self, frame):
+        """
+        Writes a frame created by pack() (of this or another socket with the same codec). A pending batch is sent
+        before to keep the order of messages.
+
+        :param frame: bytes
+        """
+        if not self.is_connected():
+            raise RuntimeError('Try to send on unconnected socket.')
+        if self._write_queue_full():
+            return
+        self.flush_batch()
+        self.socket.write(frame)
+
+    def send_chunked(self, value):
+        """
+        Sends a (large) message in chunks (see class description). The message is serialized and compressed at once,
+        the chunks are written over time.
+
+        :param value: The message
+        :return: Id of the transfer (see signal send_progress) or None if the message was not sent
+        """
+        if not self.is_connected():
+            raise RuntimeError('Try to send on unconnected socket.')
+        if self._write_queue_full():
+            return None
+
+        kind, serialized = protocol.encode_body(value, self.codec)
+        self.last_sent_size = len(serialized)
+        frame = protocol.pack_frame(kind, serialized, self.compression, self.statistics)
+        self._transfer_counter += 1
+        self._outgoing_transfers.append([self._transfer_counter, memoryview(frame), 0])
+        self._send_chunks()
+        return self._transfer_counter
+
+    def _send_chunks(self, *args):
+        """
+        Writes chunks of the outgoing transfers as long as not too many bytes are waiting to be written. Called
+        whenever bytes were written. Not intended for outside use.
+        """
+        while self._outgoing_transfers and self.socket.bytesToWrite() < self.transfer_window:
+            transfer = self._outgoing_transfers[0]
+            transfer_id, frame, offset = transfer
+            data = frame[offset:offset + self.chunk_size]
+            body = protocol.pack_chunk(transfer_id, offset, len(frame), data)
+            chunk = protocol.pack_frame(protocol.KIND_CHUNK, body, None, self.statistics)
+            self.socket.write(protocol.prefix_length(chunk))
+            transfer[2] += len(data)
+            if transfer[2] >= len(frame):
+                self._outgoing_transfers.popleft()
+            self.send_progress.emit(transfer_id, transfer[2], len(frame))
+
+    def _clear_transfers(self):
+        """
+        The socket was disconnected, all unfinished transfers are dropped. Not intended for outside use.
+        """
+        if self._outgoing_transfers or self._incoming_transfers:
+            logger.warning('socket disconnected, dropped %d outgoing and %d incoming transfers',
+                           len(self._outgoing_transfers), len(self._incoming_transfers))
+        self._outgoing_transfers.clear()
+        self._incoming_transfers.clear()
 
-        # encode to utf-8 bytes and compress
-        compressed = zlib.compress(serialized.encode())
+    def flush_batch(self):
+        """
+        Sends all messages collected for the current batch. Called automatically by a timer in the next event loop
+        iteration.
+        """
+        self._batch_timer.stop()
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        if not self.is_connected():
+            logger.warning('socket unconnected, dropped batch of %d messages', len(batch))
+            return
+        if len(batch) == 1:
+            self._send_frame(*batch[0])
+        else:
+            self._send_frame(protocol.KIND_BATCH, protocol.pack_batch(batch))
 
-        # wrap in QByteArray
-        bytearray = QtCore.QByteArray(compressed)
+    def _send_frame(self, kind, body):
+        """
+        Compresses the body, prepends the header and writes the frame. Not intended for outside use.
 
-        # write using a data stream
-        writer = QtCore.QDataStream(self.socket)
-        writer.setVersion(QtCore.QDataStream.Qt_5_5)
-        writer << bytearray
+        :param kind: Frame kind (see protocol)
+        :param body: Serialized body (bytes)
+        """
+        # compress and write with length prefix
+        t0 = time.perf_counter()
+        frame = protocol.pack_frame(kind, body, self.compression, self.statistics)
+        self.metrics.observe('compress', time.perf_counter() - t0)
+        self.socket.write(protocol.prefix_length(frame))
+        self.metrics.observe('write_queue_bytes', self.socket.bytesToWrite(), resolution=1)
+
+    def metrics_snapshot(self):
+        """
+        All metrics of this socket including the frame statistics.
+
+        :return: Dictionary (see Metrics.snapshot())
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot['frames'] = self.statistics.as_dict()
+        snapshot['gauges']['write_queue_bytes'] = self.socket.bytesToWrite()
+        snapshot['gauges']['outgoing_transfers'] = len(self._outgoing_transfers)
+        snapshot['gauges']['incoming_transfers'] = len(self._incoming_transfers)
+        snapshot['gauges']['round_trip_time'] = self.round_trip_time
+        return snapshot
 
     def count_bytes_written(self, bytes):
         """
@@ -181,6 +738,170 @@ class ExtendedTcpSocket(QtCore.QObject):
         self.bytes_written += bytes
 
 
+class PipeSocket(QtCore.QObject):
+    """
+    Socket like wrapper around one end of a multiprocessing.Pipe() to a local process, offering the part of the
+    interface of QtNetwork.QTcpSocket used by ExtendedTcpSocket. Writing sends immediately, received data is read when
+    the event loop notices it (or on Windows a thread waits for received data and hands it over to the thread of this
+    object).
+
+    The local process is trusted (we started it), ExtendedTcpSocket therefore pickles messages and does not compress
+    them on a pipe socket.
+    """
+
+    #: signals like the ones of QTcpSocket
+    readyRead = QtCore.pyqtSignal()
+    connected = QtCore.pyqtSignal()
+    disconnected = QtCore.pyqtSignal()
+    error = QtCore.pyqtSignal(QtNetwork.QAbstractSocket.SocketError)
+    bytesWritten = QtCore.pyqtSignal(int)
+
+    #: signals from the reading thread
+    _data_received = QtCore.pyqtSignal(bytes)
+    _closed = QtCore.pyqtSignal()
+
+    def __init__(self, connection):
+        """
+        :param connection: One end of a multiprocessing.Pipe()
+        """
+        super().__init__()
+        self.connection = connection
+        self._open = False
+        self._buffer = bytearray()
+        self._bytes_written = 0
+        self._notifier = None
+        self._data_received.connect(self._append)
+        self._closed.connect(self.abort)
+
+    def open(self):
+        """
+        Starts reading from the pipe and emits connected.
+        """
+        self._open = True
+        if os.name == 'posix':
+            # the pipe is a file descriptor, the event loop can wait for it
+            self._notifier = QtCore.QSocketNotifier(self.connection.fileno(), QtCore.QSocketNotifier.Read, self)
+            self._notifier.activated.connect(self._read_available)
+        else:
+            threading.Thread(target=self._read, daemon=True).start()
+        self.connected.emit()
+
+    def _read_available(self):
+        """
+        Called by the socket notifier, reads one message (the notifier is activated again if there is more). Not
+        intended for outside use.
+        """
+        try:
+            self._buffer += self.connection.recv_bytes()
+        except (EOFError, OSError):
+            self.abort()
+            return
+        self.readyRead.emit()
+
+    def _read(self):
+        """
+        Runs in its own thread and waits for received data until the pipe is closed. Not intended for outside use.
+        """
+        try:
+            while True:
+                self._data_received.emit(self.connection.recv_bytes())
+        except (EOFError, OSError):
+            self._closed.emit()
+
+    def _append(self, data):
+        """
+        Data was received. Not intended for outside use.
+        """
+        self._buffer += data
+        self.readyRead.emit()
+
+    def readAll(self):
+        """
+        :return: All received data as QByteArray
+        """
+        data = QtCore.QByteArray(bytes(self._buffer))
+        self._buffer.clear()
+        return data
+
+    def write(self, data):
+        """
+        Sends data.
+
+        :param data: bytes
+        :return: Number of bytes written or -1 on an error
+        """
+        if not self._open:
+            return -1
+        try:
+            self.connection.send_bytes(data)
+        except OSError:
+            self.abort()
+            return -1
+        # bytesWritten is emitted later like by a QTcpSocket
+        if not self._bytes_written:
+            QtCore.QTimer.singleShot(0, self._emit_bytes_written)
+        self._bytes_written += len(data)
+        return len(data)
+
+    def _emit_bytes_written(self):
+        """
+        Not intended for outside use.
+        """
+        bytes_written = self._bytes_written
+        self._bytes_written = 0
+        if bytes_written:
+            self.bytesWritten.emit(bytes_written)
+
+    def bytesToWrite(self):
+        """
+        :return: Always 0, data is sent immediately
+        """
+        return 0
+
+    def flush(self):
+        """
+        Nothing to do, data is sent immediately.
+        """
+        return False
+
+    def state(self):
+        """
+        :return: QAbstractSocket.ConnectedState or QAbstractSocket.UnconnectedState
+        """
+        if self._open:
+            return QtNetwork.QAbstractSocket.ConnectedState
+        return QtNetwork.QAbstractSocket.UnconnectedState
+
+    def peerAddress(self):
+        """
+        :return: The local host
+        """
+        return QtNetwork.QHostAddress(QtNetwork.QHostAddress.LocalHost)
+
+    def peerPort(self):
+        """
+        :return: 0, there is no port
+        """
+        return 0
+
+    def abort(self):
+        """
+        Closes the pipe and emits disconnected.
+        """
+        if self._open:
+            self._open = False
+            if self._notifier is not None:
+                self._notifier.setEnabled(False)
+            self.connection.close()
+            self.disconnected.emit()
+
+    def disconnectFromHost(self):
+        """
+        Closes the pipe (see abort()).
+        """
+        self.abort()
+
+
 class ExtendedTcpServer(QtCore.QObject):
     """
         Wrapper around QtNetwork.QTcpServer providing some simple functionality to determine the scope (local/any) and
@@ -0,0 +1,975 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Wire protocol of the network (independent of Qt): message codecs and frame layout.
+
+On the wire each frame is prefixed by its length (unsigned 32 bit, big endian, the same as a QByteArray written into a
+QDataStream), see FrameBuffer for the receiving side. Every frame starts with a header byte, followed by the
+(compressed) body. The lower four bits of the header byte
+give the kind of the frame (which codec was used for the body or whether it is a control frame), the upper four bits
+give the compression of the body (see CompressionPolicy).
+
+Two codecs exist:
+
+* yaml: the value is serialized as YAML text, can serialize (almost) every Python value, but received YAML is only
+  de-serialized to basic types, tuples and registered enums (never arbitrary objects)
+* binary: compact tagged binary format for None, bool, int, float, str, bytes, list, tuple, dict and registered enums,
+  enums are encoded as small integers (index of the enum class and value)
+
+Between trusted local processes (see lib/network.PipeSocket) values are pickled instead, this is never negotiated.
+
+Control frames are always encoded with the binary codec. They are used for negotiating the codec when the connection
+opens. Batch frames contain several encoded messages (see pack_batch()) and are compressed as a whole. Chunk frames
+contain a part of a large frame (see pack_chunk()) that is transferred in many pieces.
+
+Received letters can be validated (dictionary with channel, action and content, see decode_letter()), with the binary
+codec in the same pass as decoding.
+"""
+
+import bz2
+from enum import Enum
+import lzma
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from ruamel.yaml import YAML
+from ruamel.yaml.compat import StringIO
+from ruamel.yaml.constructor import ConstructorError, SafeConstructor
+from ruamel.yaml.error import YAMLError
+
+from imperialism_remake.lib.utils import yaml
+
+#: frame kinds (lower four bits of the header byte)
+KIND_YAML = 0
+KIND_BINARY = 1
+KIND_CONTROL = 2
+KIND_BATCH = 3
+KIND_CHUNK = 4
+KIND_PICKLE = 5
+
+#: codec names and the frame kind they produce, in order of preference
+CODECS = {'binary': KIND_BINARY, 'yaml': KIND_YAML}
+
+#: compressions (upper four bits of the header byte)
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZLIB_DICTIONARY = 2
+COMPRESSION_BZ2 = 3
+COMPRESSION_LZMA = 4
+
+#: maximal size of a frame (received frames and decompressed bodies)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+#: keys of a letter (the messages sent by the network clients)
+LETTER_KEYS = {'channel', 'action', 'content'}
+
+#: optional keys of a letter (at most one), the id of a request or the id of the request that is replied to
+LETTER_ID_KEYS = {'request', 'reply'}
+
+#: control messages
+CONTROL_HELLO = 1
+CONTROL_HELLO_ACK = 2
+CONTROL_PING = 3
+CONTROL_PONG = 4
+
+# tags of the binary codec
+_TAG_NONE = 0
+_TAG_FALSE = 1
+_TAG_TRUE = 2
+_TAG_INT = 3
+_TAG_FLOAT = 4
+_TAG_STR = 5
+_TAG_BYTES = 6
+_TAG_LIST = 7
+_TAG_TUPLE = 8
+_TAG_DICT = 9
+_TAG_ENUM = 10
+
+_double = struct.Struct('>d')
+_length = struct.Struct('>I')
+
+# variable length integers have at most 10 bytes (64 bits), longer ones are malformed
+_MAX_VARINT_BYTES = 10
+
+
+class BinaryCodec:
+    """
+    Compact binary serialization. Only knows a few basic types (integers of 64 bits) and enums that were registered
+    before. Encoding anything else raises a TypeError, decoding malformed data raises a ValueError.
+
+    Both sides of a connection must register the same enums in the same order.
+    """
+
+    def __init__(self):
+        self._enums = []
+        self._enum_index = {}
+        self._enum_names = {}
+
+    def register_enums(self, *enums):
+        """
+        Registers enum classes, their members can be encoded afterwards.
+
+        :param enums: Enum classes
+        """
+        for enum in enums:
+            if enum not in self._enum_index:
+                self._enum_index[enum] = len(self._enums)
+                self._enums.append(enum)
+                self._enum_names[enum.__module__ + '.' + enum.__qualname__] = enum
+
+    def enum_by_name(self, name):
+        """
+        A registered enum class by its full name (module and class name).
+
+        :param name: Full name
+        :return: The enum class or None if no such enum is registered
+        """
+        return self._enum_names.get(name)
+
+    def encode(self, value):
+        """
+        Encodes a value.
+
+        :param value: The value
+        :return: The encoded value as bytes
+        """
+        out = bytearray()
+        self._encode(value, out)
+        return bytes(out)
+
+    def decode(self, data):
+        """
+        Decodes a value. The data must contain exactly one encoded value.
+
+        :param data: Bytes like object
+        :return: The value
+        """
+        data = memoryview(data)
+        try:
+            value, position = self._decode(data, 0)
+        except (IndexError, TypeError, struct.error, UnicodeDecodeError, RecursionError) as e:
+            raise ValueError('Malformed data: {}'.format(e))
+        if position != len(data):
+            raise ValueError('Trailing data after position {}.'.format(position))
+        return value
+
+    def decode_letter(self, data, channel_type, action_type):
+        """
+        Decodes a letter (dictionary with keys channel, action and content) and validates its shape while decoding:
+        the encoded value must be a dictionary with exactly these keys (and optionally one of LETTER_ID_KEYS with an
+        integer), the channel and action must be members of the given enums. The content can be anything the codec
+        knows.
+
+        Raises a ValueError if the data is malformed or not a valid letter.
+
+        :param data: Bytes like object
+        :param channel_type: Enum class of channels
+        :param action_type: Enum class of actions
+        :return: The letter
+        """
+        data = memoryview(data)
+        try:
+            if data[0] != _TAG_DICT:
+                raise ValueError('Letter is not a dictionary.')
+            length, position = _read_varint(data, 1)
+            if length != len(LETTER_KEYS) and length != len(LETTER_KEYS) + 1:
+                raise ValueError('Letter has {} instead of {} entries.'.format(length, len(LETTER_KEYS)))
+            letter = {}
+            for _ in range(length):
+                key, position = self._decode(data, position)
+                if (key not in LETTER_KEYS and key not in LETTER_ID_KEYS) or key in letter:
+                    raise ValueError('Unexpected key {!r} in letter.'.format(key))
+                letter[key], position = self._decode(data, position)
+        except (IndexError, TypeError, struct.error, UnicodeDecodeError, RecursionError) as e:
+            raise ValueError('Malformed data: {}'.format(e))
+        if position != len(data):
+            raise ValueError('Trailing data after position {}.'.format(position))
+        _validate_letter(letter, channel_type, action_type)
+        return letter
+
+    def _encode(self, value, out):
+        """
+        Appends the encoding of a value to a bytearray. Not intended for outside use.
+        """
+        value_type = type(value)
+        if value is None:
+            out.append(_TAG_NONE)
+        elif value_type is bool:
+            out.append(_TAG_TRUE if value else _TAG_FALSE)
+        elif value_type is int:
+            if not -2 ** 63 <= value < 2 ** 63:
+                raise TypeError('Cannot encode integer {} with more than 64 bits.'.format(value))
+            out.append(_TAG_INT)
+            _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif value_type is str:
+            encoded = value.encode()
+            out.append(_TAG_STR)
+            _write_varint(out, len(encoded))
+            out += encoded
+        elif value_type is float:
+            out.append(_TAG_FLOAT)
+            out += _double.pack(value)
+        elif value_type is list or value_type is tuple:
+            out.append(_TAG_LIST if value_type is list else _TAG_TUPLE)
+            _write_varint(out, len(value))
+            for element in value:
+                self._encode(element, out)
+        elif value_type is dict:
+            out.append(_TAG_DICT)
+            _write_varint(out, len(value))
+            for key, element in value.items():
+                self._encode(key, out)
+                self._encode(element, out)
+        elif value_type is bytes:
+            out.append(_TAG_BYTES)
+            _write_varint(out, len(value))
+            out += value
+        elif isinstance(value, Enum) and value_type in self._enum_index:
+            out.append(_TAG_ENUM)
+            _write_varint(out, self._enum_index[value_type])
+            _write_varint(out, value.value)
+        else:
+            raise TypeError('Cannot encode value of type {}.'.format(value_type))
+
+    def _decode(self, data, position):
+        """
+        Decodes a single value starting at a position. Not intended for outside use.
+
+        :return: The value and the position after the value.
+        """
+        tag = data[position]
+        position += 1
+        if tag == _TAG_NONE:
+            return None, position
+        if tag == _TAG_FALSE:
+            return False, position
+        if tag == _TAG_TRUE:
+            return True, position
+        if tag == _TAG_INT:
+            n, position = _read_varint(data, position)
+            return (n >> 1) if not n & 1 else -((n + 1) >> 1), position
+        if tag == _TAG_STR:
+            length, position = _read_varint(data, position)
+            end = position + length
+            if end > len(data):
+                raise ValueError('String exceeds data.')
+            return str(data[position:end], 'utf-8'), end
+        if tag == _TAG_FLOAT:
+            return _double.unpack_from(data, position)[0], position + 8
+        if tag == _TAG_LIST or tag == _TAG_TUPLE:
+            length, position = _read_varint(data, position)
+            elements = []
+            for _ in range(length):
+                element, position = self._decode(data, position)
+                elements.append(element)
+            return (elements if tag == _TAG_LIST else tuple(elements)), position
+        if tag == _TAG_DICT:
+            length, position = _read_varint(data, position)
+            value = {}
+            for _ in range(length):
+                key, position = self._decode(data, position)
+                value[key], position = self._decode(data, position)
+            return value, position
+        if tag == _TAG_BYTES:
+            length, position = _read_varint(data, position)
+            end = position + length
+            if end > len(data):
+                raise ValueError('Bytes exceed data.')
+            return bytes(data[position:end]), end
+        if tag == _TAG_ENUM:
+            index, position = _read_varint(data, position)
+            number, position = _read_varint(data, position)
+            if index >= len(self._enums):
+                raise ValueError('Unknown enum index {}.'.format(index))
+            return self._enums[index](number), position
+        raise ValueError('Unknown tag {} at position {}.'.format(tag, position - 1))
+
+
+def _write_varint(out, n):
+    """
+    Appends a non-negative integer as variable length integer (7 bits per byte, little endian). Not intended for
+    outside use.
+    """
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, position):
+    """
+    Reads a variable length integer, raises a ValueError if it is longer than _MAX_VARINT_BYTES. Not intended for
+    outside use.
+
+    :return: The integer and the position after it.
+    """
+    n = 0
+    for shift in range(0, 7 * _MAX_VARINT_BYTES, 7):
+        byte = data[position]
+        position += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, position
+    raise ValueError('Variable length integer at position {} is too long.'.format(position - _MAX_VARINT_BYTES))
+
+
+#: the binary codec instance used by the network (register enums here)
+binary_codec = BinaryCodec()
+
+
+def encode_yaml(value):
+    """
+    Serializes a value as UTF-8 encoded YAML.
+
+    :param value: The value
+    :return: bytes
+    """
+    stream = StringIO()
+    yaml.dump(value, stream)
+    return stream.getvalue().encode()
+
+
+class _SafeConstructor(SafeConstructor):
+    """
+    Constructs only the basic YAML types, tuples and members of the enums registered at the binary codec. Everything
+    else (in particular arbitrary Python objects) raises a ConstructorError. Not intended for outside use.
+    """
+
+    def construct_python_tuple(self, node):
+        return tuple(self.construct_sequence(node))
+
+    def construct_enum(self, suffix, node):
+        enum = binary_codec.enum_by_name(suffix)
+        if enum is None:
+            raise ConstructorError(None, None, 'constructing {} is not allowed'.format(suffix), node.start_mark)
+        value = self.construct_sequence(node)
+        if len(value) != 1:
+            raise ConstructorError(None, None, 'malformed enum {}'.format(suffix), node.start_mark)
+        return enum(value[0])
+
+
+_SafeConstructor.add_constructor('tag:yaml.org,2002:python/tuple', _SafeConstructor.construct_python_tuple)
+_SafeConstructor.add_multi_constructor('tag:yaml.org,2002:python/object/apply:', _SafeConstructor.construct_enum)
+
+#: yaml instance for loading received data
+_safe_yaml = YAML(typ='safe')
+_safe_yaml.Constructor = _SafeConstructor
+
+
+def decode_yaml(data):
+    """
+    De-serializes UTF-8 encoded YAML. Only basic types, tuples and registered enums (see BinaryCodec.register_enums())
+    are constructed, anything else raises a ValueError (received data must never create arbitrary objects).
+
+    :param data: Bytes like object
+    :return: The value
+    """
+    try:
+        return _safe_yaml.load(bytes(data).decode())
+    except (YAMLError, UnicodeDecodeError, TypeError, ValueError, RecursionError) as e:
+        raise ValueError('Malformed data: {}'.format(e))
+
+
+def encode_body(value, codec):
+    """
+    Encodes a value with a codec. If the binary codec cannot encode the value, falls back to YAML.
+
+    The codec pickle is not negotiable (not in CODECS), it is only used between trusted local processes.
+
+    :param value: The value
+    :param codec: Name of the codec (see CODECS) or pickle
+    :return: Tuple of frame kind and encoded body
+    """
+    if codec == 'binary':
+        try:
+            return KIND_BINARY, binary_codec.encode(value)
+        except TypeError:
+            pass
+    elif codec == 'pickle':
+        return KIND_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    return KIND_YAML, encode_yaml(value)
+
+
+def decode_body(kind, body, allow_pickle=False):
+    """
+    Decodes the body of a frame of a given kind.
+
+    :param kind: Frame kind
+    :param body: Bytes like object
+    :param allow_pickle: If True, pickled bodies are accepted (only from trusted peers, unpickling can execute code)
+    :return: The value
+    """
+    if kind == KIND_CONTROL:
+        return decode_control(body)
+    if kind == KIND_BINARY:
+        return binary_codec.decode(body)
+    if kind == KIND_YAML:
+        return decode_yaml(body)
+    if kind == KIND_PICKLE and allow_pickle:
+        return pickle.loads(body)
+    raise ValueError('Unknown or not allowed frame kind {}.'.format(kind))
+
+
+def decode_control(body):
+    """
+    Decodes the body of a control frame and checks its shape: a tuple of control message type (integer) and content.
+    The content of a hello must be a list of codec names, the one of a hello acknowledgement a codec name.
+
+    :param body: Bytes like object
+    :return: Tuple of control message type and content
+    """
+    value = binary_codec.decode(body)
+    if type(value) is not tuple or len(value) != 2 or type(value[0]) is not int:
+        raise ValueError('Malformed control message.')
+    control, content = value
+    if control == CONTROL_HELLO:
+        if type(content) not in (list, tuple) or not all(type(codec) is str for codec in content):
+            raise ValueError('Malformed hello.')
+    elif control == CONTROL_HELLO_ACK:
+        if type(content) is not str:
+            raise ValueError('Malformed hello acknowledgement.')
+    return value
+
+
+def decode_letter(kind, body, channel_type, action_type, allow_pickle=False):
+    """
+    Decodes the body of a frame of a given kind which must contain a letter (a dictionary with keys channel, action
+    and content and optionally a request or reply id) and validates the letter (see BinaryCodec.decode_letter()).
+
+    :param kind: Frame kind
+    :param body: Bytes like object
+    :param channel_type: Enum class of channels
+    :param action_type: Enum class of actions
+    :param allow_pickle: See decode_body()
+    :return: The letter
+    """
+    if kind == KIND_BINARY:
+        return binary_codec.decode_letter(body, channel_type, action_type)
+    letter = decode_body(kind, body, allow_pickle)
+    if type(letter) is not dict:
+        raise ValueError('Not a letter.')
+    _validate_letter(letter, channel_type, action_type)
+    return letter
+
+
+def _validate_letter(letter, channel_type, action_type):
+    """
+    Raises a ValueError if a dictionary has not the keys of a letter (plus at most one id) or if channel or action
+    are not of the given types or an id is not an integer. Not intended for outside use.
+    """
+    if len(letter) == len(LETTER_KEYS):
+        if letter.keys() != LETTER_KEYS:
+            raise ValueError('Not a letter.')
+    else:
+        extra_keys = letter.keys() - LETTER_KEYS
+        if len(extra_keys) != 1 or len(letter) != len(LETTER_KEYS) + 1 or not extra_keys <= LETTER_ID_KEYS:
+            raise ValueError('Not a letter.')
+        request_id = letter[extra_keys.pop()]
+        if type(request_id) is not int:
+            raise ValueError('Id {!r} is not an integer.'.format(request_id))
+    if type(letter['channel']) is not channel_type:
+        raise ValueError('Channel {!r} is not a {}.'.format(letter['channel'], channel_type.__name__))
+    if type(letter['action']) is not action_type:
+        raise ValueError('Action {!r} is not a {}.'.format(letter['action'], action_type.__name__))
+
+
+def choose_codec(own, offered):
+    """
+    Chooses the first of our codecs that is also offered by the peer. YAML is always understood.
+
+    :param own: Our codecs in order of preference
+    :param offered: Codecs offered by the peer
+    :return: Name of the codec
+    """
+    for codec in own:
+        if codec in offered and codec in CODECS:
+            return codec
+    return 'yaml'
+
+
+#: preset dictionary for zlib (must be the same on both sides, see set_preset_dictionary())
+_preset_dictionary = b''
+
+
+def set_preset_dictionary(data):
+    """
+    Sets the preset dictionary for zlib compression. Should contain byte sequences that are common in small messages
+    (typical encoded letters), the most common ones at the end.
+
+    :param data: bytes (at most 32 KB are used)
+    """
+    global _preset_dictionary
+    _preset_dictionary = bytes(data[-32768:])
+
+
+class CompressionPolicy:
+    """
+    Decides how a frame body is compressed. Bodies below a size threshold are not compressed at all (compression
+    would only make them bigger and cost time), larger bodies are compressed with the algorithm and level given.
+    Optionally zlib uses the preset dictionary for bodies up to a size limit, which helps with short repetitive
+    lobby messages.
+    """
+
+    #: available algorithms
+    ALGORITHMS = {'zlib': COMPRESSION_ZLIB, 'bz2': COMPRESSION_BZ2, 'lzma': COMPRESSION_LZMA}
+
+    def __init__(self, threshold=128, algorithm='zlib', level=6, use_dictionary=False, dictionary_limit=4096):
+        """
+        :param threshold: Bodies with fewer bytes are not compressed
+        :param algorithm: Name of the algorithm (see ALGORITHMS)
+        :param level: Compression level (zlib and bz2: 1-9, lzma: 0-9)
+        :param use_dictionary: If True and algorithm is zlib, small bodies are compressed using the preset dictionary
+        :param dictionary_limit: Bodies up to this size use the preset dictionary
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise RuntimeError('Unknown compression algorithm {}.'.format(algorithm))
+        self.threshold = threshold
+        self.algorithm = algorithm
+        self.level = level
+        self.use_dictionary = use_dictionary
+        self.dictionary_limit = dictionary_limit
+
+    def compress(self, body):
+        """
+        Compresses a body according to the policy.
+
+        :param body: bytes
+        :return: Tuple of compression and compressed body
+        """
+        size = len(body)
+        if size < self.threshold:
+            return COMPRESSION_NONE, body
+        if self.algorithm == 'zlib':
+            if self.use_dictionary and _preset_dictionary and size <= self.dictionary_limit:
+                compressor = zlib.compressobj(self.level, zdict=_preset_dictionary)
+                return COMPRESSION_ZLIB_DICTIONARY, compressor.compress(body) + compressor.flush()
+            return COMPRESSION_ZLIB, zlib.compress(body, self.level)
+        if self.algorithm == 'bz2':
+            return COMPRESSION_BZ2, bz2.compress(body, self.level)
+        return COMPRESSION_LZMA, lzma.compress(body, preset=self.level)
+
+
+def decompress(compression, data, max_size=MAX_FRAME_SIZE):
+    """
+    Decompresses a body. Raises a ValueError if the data is corrupt or truncated or would decompress to more than
+    the maximal size (a small frame could expand to gigabytes otherwise).
+
+    :param compression: Compression (from the header byte)
+    :param data: Bytes like object
+    :param max_size: Maximal size of the decompressed body
+    :return: Bytes like object
+    """
+    if compression == COMPRESSION_NONE:
+        return data
+    if compression == COMPRESSION_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif compression == COMPRESSION_ZLIB_DICTIONARY:
+        decompressor = zlib.decompressobj(zdict=_preset_dictionary)
+    elif compression == COMPRESSION_BZ2:
+        decompressor = bz2.BZ2Decompressor()
+    elif compression == COMPRESSION_LZMA:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError('Unknown compression {}.'.format(compression))
+    try:
+        body = decompressor.decompress(data, max_size)
+    except (zlib.error, OSError, lzma.LZMAError, EOFError) as e:
+        raise ValueError('Corrupt compressed body: {}'.format(e))
+    if not decompressor.eof:
+        # the output was cut at the maximal size or the data ends early
+        raise ValueError('Compressed body is truncated or exceeds {} bytes.'.format(max_size))
+    return body
+
+
+def pack_frame(kind, body, policy, statistics=None):
+    """
+    Compresses a body and prepends the header byte.
+
+    :param kind: Frame kind
+    :param body: Serialized body (bytes)
+    :param policy: CompressionPolicy or None for no compression
+    :param statistics: Optional FrameStatistics that are updated
+    :return: The frame (bytes)
+    """
+    t0 = time.perf_counter()
+    if policy is None:
+        compression, compressed = COMPRESSION_NONE, body
+    else:
+        compression, compressed = policy.compress(body)
+    if statistics is not None:
+        statistics.sent(len(body), len(compressed), compression, time.perf_counter() - t0)
+    return bytes((compression << 4 | kind,)) + compressed
+
+
+def unpack_frame(frame, statistics=None, max_size=MAX_FRAME_SIZE):
+    """
+    Splits the header byte from a frame and decompresses the body. Raises a ValueError for an empty frame or a body
+    that cannot be decompressed (see decompress()).
+
+    :param frame: Bytes like object
+    :param statistics: Optional FrameStatistics that are updated
+    :param max_size: Maximal size of the decompressed body
+    :return: Tuple of frame kind and decompressed body
+    """
+    if not len(frame):
+        raise ValueError('Empty frame.')
+    header = frame[0]
+    t0 = time.perf_counter()
+    body = decompress(header >> 4, frame[1:], max_size)
+    if statistics is not None:
+        statistics.received(len(body), len(frame) - 1, header >> 4, time.perf_counter() - t0)
+    return header & 0x0f, body
+
+
+def pack_batch(entries):
+    """
+    Packs several encoded messages into the body of a batch frame. Each entry is stored as kind (one byte), length
+    (variable length integer) and the encoded message.
+
+    :param entries: List of tuples of frame kind and encoded body
+    :return: bytes
+    """
+    out = bytearray()
+    for kind, body in entries:
+        out.append(kind)
+        _write_varint(out, len(body))
+        out += body
+    return bytes(out)
+
+
+def unpack_batch(body):
+    """
+    Inverse of pack_batch().
+
+    :param body: Bytes like object
+    :return: List of tuples of frame kind and encoded body (as memoryview)
+    """
+    body = memoryview(body)
+    entries = []
+    position = 0
+    try:
+        while position < len(body):
+            kind = body[position]
+            length, position = _read_varint(body, position + 1)
+            end = position + length
+            if end > len(body):
+                raise ValueError('Batch entry exceeds batch.')
+            entries.append((kind, body[position:end]))
+            position = end
+    except IndexError:
+        raise ValueError('Malformed batch.')
+    return entries
+
+
+def pack_chunk(transfer_id, offset, total, data):
+    """
+    Creates the body of a chunk frame. A chunk is a part of a transfer (the transferred data is a complete frame).
+
+    :param transfer_id: Id of the transfer (unique for the sender)
+    :param offset: Position of the data within the transfer
+    :param total: Total size of the transfer
+    :param data: Bytes like object
+    :return: bytes
+    """
+    out = bytearray()
+    _write_varint(out, transfer_id)
+    _write_varint(out, offset)
+    _write_varint(out, total)
+    out += data
+    return bytes(out)
+
+
+def unpack_chunk(body):
+    """
+    Inverse of pack_chunk().
+
+    :param body: Bytes like object
+    :return: Tuple of transfer id, offset, total size and data (as memoryview)
+    """
+    body = memoryview(body)
+    try:
+        transfer_id, position = _read_varint(body, 0)
+        offset, position = _read_varint(body, position)
+        total, position = _read_varint(body, position)
+    except IndexError:
+        raise ValueError('Malformed chunk.')
+    if total <= 0:
+        raise ValueError('Empty transfer.')
+    data = body[position:]
+    if offset + len(data) > total:
+        raise ValueError('Chunk exceeds transfer.')
+    return transfer_id, offset, total, data
+
+
+class TransferBudget:
+    """
+    Number of bytes buffered by the incoming transfers of many connections together and its limit. Thread safe, the
+    connections of a process (also those of a server in another thread) share one budget.
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: Maximal number of buffered bytes
+        """
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        :param size: Number of bytes
+        :return: True if the bytes were reserved, False if they would exceed the limit
+        """
+        with self._lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        """
+        Gives reserved bytes back.
+
+        :param size: Number of bytes
+        """
+        with self._lock:
+            self.used -= size
+
+
+#: the budget of all incoming transfers of this process
+transfer_budget = TransferBudget(256 * 1024 * 1024)
+
+
+class IncomingTransfers:
+    """
+    Reassembles the chunks of incoming transfers (see pack_chunk()). The chunks of a transfer must arrive in order
+    (the sender writes them in order on one connection), so a completed transfer has no holes. The announced size of
+    a transfer is limited to the maximal frame size, the data is buffered as it arrives (not allocated for the
+    announced size) and counted in a budget shared by all connections. The number of open transfers is limited too.
+    A peer cannot make us allocate memory without bound.
+    """
+
+    def __init__(self, max_transfers=8, max_size=MAX_FRAME_SIZE, budget=None):
+        """
+        :param max_transfers: Maximal number of open transfers
+        :param max_size: Maximal size of a transfer
+        :param budget: TransferBudget of the buffered bytes or None for the budget of the process
+        """
+        self.max_transfers = max_transfers
+        self.max_size = max_size
+        self.budget = budget if budget is not None else transfer_budget
+        # transfer id -> data received so far and total size
+        self._transfers = {}
+
+    def __len__(self):
+        """
+        Number of open transfers.
+        """
+        return len(self._transfers)
+
+    def clear(self):
+        """
+        Drops all open transfers.
+        """
+        for transfer_id in list(self._transfers):
+            self._drop(transfer_id)
+
+    def add(self, body):
+        """
+        Adds a chunk to its transfer. Raises a ValueError if the chunk is malformed, does not continue its transfer
+        (the transfer is dropped then) or would exceed the limits.
+
+        :param body: Body of a chunk frame
+        :return: Tuple of transfer id, bytes received, total size and the transferred data if the transfer is
+            complete or None
+        """
+        transfer_id, offset, total, data = unpack_chunk(body)
+        if not len(data):
+            raise ValueError('Empty chunk.')
+        transfer = self._transfers.get(transfer_id)
+        if transfer is None:
+            if offset != 0:
+                raise ValueError('Chunk does not start transfer {}.'.format(transfer_id))
+            if total > self.max_size:
+                raise ValueError('Transfer of {} bytes exceeds {} bytes.'.format(total, self.max_size))
+            if len(self._transfers) >= self.max_transfers:
+                raise ValueError('Too many open transfers.')
+            transfer = self._transfers[transfer_id] = [bytearray(), total]
+        elif total != transfer[1] or offset != len(transfer[0]):
+            self._drop(transfer_id)
+            raise ValueError('Chunk does not continue transfer {}.'.format(transfer_id))
+        if not self.budget.reserve(len(data)):
+            self._drop(transfer_id)
+            raise ValueError('Incoming transfers exceed {} bytes.'.format(self.budget.limit))
+        transfer[0] += data
+        if len(transfer[0]) < total:
+            return transfer_id, len(transfer[0]), total, None
+        self._drop(transfer_id)
+        return transfer_id, total, total, transfer[0]
+
+    def _drop(self, transfer_id):
+        """
+        Not intended for outside use.
+        """
+        self.budget.release(len(self._transfers.pop(transfer_id)[0]))
+
+
+def prefix_length(frame):
+    """
+    Prepends the length to a frame for writing it on the wire.
+
+    :param frame: The frame (bytes)
+    :return: bytes
+    """
+    return _length.pack(len(frame)) + frame
+
+
+class FrameBuffer:
+    """
+    Receive buffer for length prefixed frames. Received bytes are accumulated (they may contain many small frames or
+    only a part of a large frame), complete frames are extracted as memoryview slices of the buffer without copying.
+    The consumed bytes are removed from the buffer only once after all complete frames have been extracted.
+    """
+
+    #: marker of a null QByteArray written into a QDataStream (an empty frame)
+    NULL_LENGTH = 0xffffffff
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        """
+        :param max_frame_size: Larger frames are considered an error
+        """
+        self._buffer = bytearray()
+        self.max_frame_size = max_frame_size
+
+    def __len__(self):
+        """
+        Number of buffered bytes.
+        """
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        Appends received bytes.
+
+        :param data: Bytes like object
+        """
+        self._buffer += data
+
+    def clear(self):
+        """
+        Discards all buffered bytes (e.g. when the connection is aborted).
+        """
+        self._buffer = bytearray()
+
+    def frames(self):
+        """
+        Generator of all complete frames in the buffer. Each frame is a memoryview which is only valid until the next
+        frame is requested, the consumer must copy (decompress, decode) what it needs before.
+
+        A frame counts as consumed once it was yielded, also if the consumer raises while processing it. Raises a
+        ValueError if a frame is larger than the maximal frame size (the stream cannot be resynchronized then).
+        """
+        buffer = self._buffer
+        size = len(buffer)
+        offset = 0
+        view = memoryview(buffer)
+        try:
+            while size - offset >= 4:
+                length = _length.unpack_from(buffer, offset)[0]
+                if length == self.NULL_LENGTH:
+                    offset += 4
+                    continue
+                if length > self.max_frame_size:
+                    raise ValueError('Frame of {} bytes exceeds maximal frame size.'.format(length))
+                end = offset + 4 + length
+                if end > size:
+                    # incomplete frame, wait for more data
+                    break
+                frame = view[offset + 4:end]
+                offset = end
+                try:
+                    yield frame
+                finally:
+                    frame.release()
+        finally:
+            view.release()
+            if offset:
+                try:
+                    del buffer[:offset]
+                except BufferError:
+                    # the consumer still holds views of consumed frames (e.g. in a traceback), copy the rest instead
+                    self._buffer = buffer[offset:]
+
+
+class FrameStatistics:
+    """
+    Counts frames and bytes (before and after compression) in both directions as well as the time spent for
+    compression and decompression.
+    """
+
+    def __init__(self):
+        self.frames_sent = 0
+        self.frames_sent_compressed = 0
+        self.bytes_sent_uncompressed = 0
+        self.bytes_sent_compressed = 0
+        self.compression_time = 0
+        self.frames_received = 0
+        self.frames_received_compressed = 0
+        self.bytes_received_uncompressed = 0
+        self.bytes_received_compressed = 0
+        self.decompression_time = 0
+
+    def sent(self, uncompressed, compressed, compression, duration):
+        """
+        A frame body was compressed for sending.
+        """
+        self.frames_sent += 1
+        self.bytes_sent_uncompressed += uncompressed
+        self.bytes_sent_compressed += compressed
+        if compression != COMPRESSION_NONE:
+            self.frames_sent_compressed += 1
+            self.compression_time += duration
+
+    def received(self, uncompressed, compressed, compression, duration):
+        """
+        A received frame body was decompressed.
+        """
+        self.frames_received += 1
+        self.bytes_received_uncompressed += uncompressed
+        self.bytes_received_compressed += compressed
+        if compression != COMPRESSION_NONE:
+            self.frames_received_compressed += 1
+            self.decompression_time += duration
+
+    def compression_ratio(self):
+        """
+        Ratio of bytes sent after compression to bytes before compression (1 if nothing was sent yet).
+        """
+        if self.bytes_sent_uncompressed == 0:
+            return 1
+        return self.bytes_sent_compressed / self.bytes_sent_uncompressed
+
+    def as_dict(self):
+        """
+        All statistics as dictionary (for example for the server monitor).
+        """
+        statistics = dict(vars(self))
+        statistics['compression_ratio'] = self.compression_ratio()
+        return statistics
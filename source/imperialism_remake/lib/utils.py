@@ -18,6 +18,11 @@
 General utility functions (not graphics related) only based on Python or common libraries (not Qt) and not specific
 to the project.
 """
+import collections
+import io
+import sys
+import threading
+import time
 import zipfile
 from enum import Enum
 
@@ -132,8 +137,9 @@ class ZipArchiveWriter:
         :param name: File name
         :param obj: Python value
         """
-        data = yaml.dump(obj).encode()
-        self.write(name, data)
+        stream = io.StringIO()
+        yaml.dump(obj, stream)
+        self.write(name, stream.getvalue().encode())
 
     def __del__(self):
         """
@@ -183,6 +189,118 @@ class List2D:
         self._array[index] = v
 
 
+class LRUCache:
+    """
+    A cache that forgets the least recently used entries once the total (estimated) size of all values exceeds a
+    maximal size. Can be used from several threads.
+    """
+
+    def __init__(self, maximal_size, size_of=None):
+        """
+        :param maximal_size: Maximal total size of all values
+        :param size_of: Function returning the size of a value (default: estimate_size)
+        """
+        self.maximal_size = maximal_size
+        self._size_of = size_of if size_of else estimate_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value of a key (which is now the most recently used) or a default if not cached.
+
+        :param key: The key
+        :param default: Returned if the key is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """
+        Caches a value and forgets the least recently used values if the maximal size is exceeded. Values larger than
+        the maximal size are not cached at all.
+
+        :param key: The key
+        :param value: The value
+        :param size: Size of the value (e.g. estimated in another thread) or None to compute it here
+        """
+        if size is None:
+            size = self._size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.maximal_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.maximal_size:
+                _, (_, forgotten_size) = self._entries.popitem(last=False)
+                self.size -= forgotten_size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens are added at a constant rate up to a maximum (the burst), every event takes one
+    token and events without a token are not allowed.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """
+        :param rate: Tokens per second
+        :param burst: Maximal number of tokens (the bucket starts full)
+        :param clock: Function returning the time in seconds
+        """
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self.tokens = burst
+        self._last = clock()
+
+    def take(self):
+        """
+        Takes a token if there is one.
+
+        :return: True if the event is allowed
+        """
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def estimate_size(value):
+    """
+    Estimates the memory size of a value in bytes including the contents of lists, tuples, sets and dictionaries.
+
+    :param value: The value
+    :return: Size in bytes
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
 def index_of_element(sequence, element):
     """
     Finds the index of a certain element in a list. Returns the index of the first occurrence or ValueError if the
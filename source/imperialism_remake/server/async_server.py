@@ -0,0 +1,760 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Server on asyncio streams instead of QTcpServer and the Qt event loop, for headless dedicated servers with many
+clients. Speaks the same protocol (framing, codecs, compression, batches, chunks, controls, see lib/protocol.py) and
+letter format as lib/network.py and base/network.py and offers the same services (see services.py).
+
+    asyncio.run(AsyncServerManager().serve(constants.NETWORK_PORT))
+"""
+
+import asyncio
+import ipaddress
+import logging
+import os
+import signal
+import time
+
+from imperialism_remake.base import constants, switches
+# registers the enums of the binary codec and sets the preset dictionary (no Qt event loop needed)
+from imperialism_remake.base import network as base_network  # noqa: F401 (imported for its side effects)
+from imperialism_remake.lib import metrics, protocol
+from imperialism_remake.server.services import ServerServices
+
+#: shortcut for the hosts of the scopes local/any (see lib/network.SCOPE)
+SCOPE = {'local': '127.0.0.1', 'any': None}
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncNetworkClient:
+    """
+    A connection on asyncio streams with the same channel API as base/network.NetworkClient (send letters, receivers
+    connected to channels). Used for server clients by the AsyncServerManager and for clients (see connect()).
+
+    Messages sent during one iteration of the event loop are sent together as a batch frame. Receivers are called with
+    client, channel, action and content like the receivers of NetworkClient. The write queue can be limited like the
+    one of NetworkClient (see lib/network.ExtendedTcpSocket.limit_write_queue()).
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, compression=None):
+        """
+        :param reader: Stream reader of the connection
+        :param writer: Stream writer of the connection
+        :param compression: Compression policy of sent frames or None for the default policy.
+        """
+        self.reader = reader
+        self.writer = writer
+
+        # codecs in order of preference and the negotiated codec (yaml until negotiated)
+        self.codecs = list(protocol.CODECS)
+        self.codec = 'yaml'
+        self.negotiated = asyncio.Event()
+
+        self.compression = compression if compression is not None else protocol.CompressionPolicy()
+        self.statistics = protocol.FrameStatistics()
+        self.metrics = metrics.Metrics()
+        self.round_trip_time = None
+        # codecs offered with our hello until the peer acknowledged one (None if we did not offer)
+        self._offered_codecs = None
+        self._hello_time = None
+
+        # channel -> list of receivers
+        self.channels = {}
+
+        # futures of requests waiting for their reply by id and the id of the request that is currently processed
+        self.requests = {}
+        self._request_counter = 0
+        self.current_request = None
+
+        # dispatch table (see lib/dispatch.py) asked before the channels or None
+        self.dispatcher = None
+
+        # messages of the current event loop iteration
+        self._batch = []
+        self._batch_size = 0
+        self._receive_buffer = protocol.FrameBuffer()
+
+        # chunked transfers (and the number of bytes of outgoing transfers not yet written)
+        self.chunk_size = 64 * 1024
+        self._transfer_counter = 0
+        self._transfer_bytes = 0
+        self._incoming_transfers = protocol.IncomingTransfers()
+
+        # optional limit of the bytes waiting to be sent (see limit_write_queue)
+        self.write_queue_limit = None
+        self.write_queue_policy = 'drop'
+
+        # important properties (of server clients)
+        self.name = ''
+        self.client_id = None
+
+    @classmethod
+    async def connect(cls, port, host='local'):
+        """
+        Connects to a server and offers our codecs.
+
+        :param port: The port number to connect to.
+        :param host: The host address (or 'local' for the local host) to connect to.
+        :return: The connected client (the codec is negotiated when negotiated is set)
+        """
+        reader, writer = await asyncio.open_connection(SCOPE.get(host, host), port)
+        client = cls(reader, writer)
+        client._offered_codecs = list(client.codecs)
+        client._hello_time = time.perf_counter()
+        client._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_HELLO,
+                                                                                client.codecs)))
+        return client
+
+    def connect_to_channel(self, channel: constants.C, callback: callable):
+        """
+        Connects a receiver to a channel.
+
+        :param channel: Name of the channel
+        :param callback: A callable
+        """
+        self.channels.setdefault(channel, []).append(callback)
+
+    def disconnect_from_channel(self, channel: constants.C, callback: callable):
+        """
+        Disconnects a receiver from a channel.
+
+        :param channel: Name of the channel
+        :param callback: A callable
+        """
+        if channel not in self.channels:
+            raise RuntimeError('Channel with this name not existing.')
+        self.channels[channel].remove(callback)
+
+    def is_connected(self):
+        """
+
+        :return: True if it is connected
+        """
+        return not self.writer.is_closing()
+
+    def is_local(self):
+        """
+        :return: True if the peer is on the same machine (loopback address)
+        """
+        peer = self.writer.get_extra_info('peername')
+        return peer is not None and ipaddress.ip_address(peer[0]).is_loopback
+
+    def abort(self):
+        """
+        Closes the connection immediately.
+        """
+        self._batch = []
+        self._batch_size = 0
+        self.writer.transport.abort()
+
+    def limit_write_queue(self, size_limit, policy='drop'):
+        """
+        From now on, no messages are sent while too many bytes are waiting to be sent (see queued_bytes()), see
+        lib/network.ExtendedTcpSocket.limit_write_queue().
+
+        :param size_limit: Maximal number of bytes waiting to be sent
+        :param policy: 'drop' the messages or 'disconnect' (abort the connection)
+        """
+        if policy not in ('drop', 'disconnect'):
+            raise RuntimeError('Unknown write queue policy {}.'.format(policy))
+        self.write_queue_limit = size_limit
+        self.write_queue_policy = policy
+
+    def queued_bytes(self):
+        """
+        :return: Number of bytes waiting to be sent: in the buffer of the transport, in the batch and the rest of the
+            outgoing transfers
+        """
+        return self.writer.transport.get_write_buffer_size() + self._batch_size + self._transfer_bytes
+
+    def _write_queue_full(self):
+        """
+        Checks the limit of the write queue before sending a message. Not intended for outside use.
+
+        :return: True if the message must not be sent
+        """
+        if self.write_queue_limit is None:
+            return False
+        queued = self.queued_bytes()
+        if queued < self.write_queue_limit:
+            return False
+        if self.write_queue_policy == 'disconnect':
+            logger.warning('write queue full (%d bytes), abort connection', queued)
+            self.metrics.count('write_queue_overflows')
+            self.abort()
+        else:
+            self.metrics.count('dropped_messages')
+        return True
+
+    def send(self, channel: constants.C, action: constants.M, content=None, reply_to=None):
+        """
+        Wraps channel, action and content in a letter and sends it (in the batch of this event loop iteration).
+
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :param reply_to: Id of the request this is a reply to or None for the request currently processed (if any)
+        """
+        self._send_letter(self._letter(channel, action, content, reply_to))
+
+    def request(self, channel: constants.C, action: constants.M, content=None):
+        """
+        Like send() but with a request id. The reply of the receiver goes only to the returned future, not to the
+        receivers of the channel (see base/network.NetworkClient.request()). For a timeout use asyncio.wait_for().
+
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :return: Future of the reply content
+        """
+        self._request_counter += 1
+        request_id = self._request_counter
+        future = asyncio.get_running_loop().create_future()
+        self.requests[request_id] = future
+        future.add_done_callback(lambda _: self.requests.pop(request_id, None))
+        self._send_letter({'channel': channel, 'action': action, 'content': content, 'request': request_id})
+        return future
+
+    def _letter(self, channel: constants.C, action: constants.M, content, reply_to):
+        """
+        Wraps channel, action and content in a letter, which is a reply if a request id is given or if a request is
+        currently processed. Not intended for outside use.
+        """
+        letter = {'channel': channel, 'action': action, 'content': content}
+        if reply_to is None:
+            reply_to = self.current_request
+        if reply_to is not None:
+            letter['reply'] = reply_to
+        return letter
+
+    def _send_letter(self, letter):
+        """
+        Sends a letter in the batch of this event loop iteration. Not intended for outside use.
+        """
+        if not self.is_connected():
+            raise RuntimeError('Try to send on unconnected socket.')
+        if self._write_queue_full():
+            return
+        channel = letter['channel']
+        action = letter['action']
+        t0 = time.perf_counter()
+        kind, serialized = protocol.encode_body(letter, self.codec)
+        self.metrics.observe('serialize', time.perf_counter() - t0)
+        if not self._batch:
+            asyncio.get_running_loop().call_soon(self.flush_batch)
+        self._batch.append((kind, serialized))
+        self._batch_size += len(serialized)
+        self.metrics.count(('messages_out', channel, action))
+        self.metrics.count(('bytes_out', channel, action), len(serialized))
+
+    def send_chunked(self, channel: constants.C, action: constants.M, content=None, reply_to=None):
+        """
+        Like send() but the letter is sent in chunks, the next chunk is written when the previous was drained.
+
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :param reply_to: See send()
+        :return: Id of the transfer or None if the letter was not sent
+        """
+        if not self.is_connected():
+            raise RuntimeError('Try to send on unconnected socket.')
+        if self._write_queue_full():
+            return None
+        kind, serialized = protocol.encode_body(self._letter(channel, action, content, reply_to), self.codec)
+        frame = protocol.pack_frame(kind, serialized, self.compression, self.statistics)
+        self.metrics.count(('messages_out', channel, action))
+        self.metrics.count(('bytes_out', channel, action), len(serialized))
+        self._transfer_counter += 1
+        self._transfer_bytes += len(frame)
+        asyncio.ensure_future(self._send_chunks(self._transfer_counter, memoryview(frame)))
+        return self._transfer_counter
+
+    async def _send_chunks(self, transfer_id, frame):
+        """
+        Writes the chunks of a transfer. Not intended for outside use.
+        """
+        written = 0
+        try:
+            for offset in range(0, len(frame), self.chunk_size):
+                if not self.is_connected():
+                    return
+                data = frame[offset:offset + self.chunk_size]
+                chunk = protocol.pack_frame(protocol.KIND_CHUNK,
+                                            protocol.pack_chunk(transfer_id, offset, len(frame), data),
+                                            None, self.statistics)
+                self.writer.write(protocol.prefix_length(chunk))
+                self._transfer_bytes -= len(data)
+                written += len(data)
+                await self.writer.drain()
+        finally:
+            self._transfer_bytes -= len(frame) - written
+
+    def pack_letter(self, channel: constants.C, action: constants.M, content=None):
+        """
+        Packs a letter into a frame which then can be written to many clients with the same codec.
+
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        :return: The frame
+        """
+        kind, serialized = protocol.encode_body({'channel': channel, 'action': action, 'content': content},
+                                                self.codec)
+        return protocol.prefix_length(protocol.pack_frame(kind, serialized, self.compression, self.statistics))
+
+    def write_frame(self, frame):
+        """
+        Writes a frame created by pack_letter() after the pending batch.
+
+        :param frame: bytes
+        """
+        if self._write_queue_full():
+            return
+        self.flush_batch()
+        self.writer.write(frame)
+
+    def flush_batch(self):
+        """
+        Sends all messages collected for the current batch. Called automatically in the next event loop iteration.
+        """
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        if not self.is_connected():
+            logger.warning('socket unconnected, dropped batch of %d messages', len(batch))
+            return
+        if len(batch) == 1:
+            self._send_frame(*batch[0])
+        else:
+            self._send_frame(protocol.KIND_BATCH, protocol.pack_batch(batch))
+
+    def _send_frame(self, kind, body):
+        """
+        Compresses the body, prepends the header and writes the frame. Not intended for outside use.
+        """
+        t0 = time.perf_counter()
+        frame = protocol.pack_frame(kind, body, self.compression, self.statistics)
+        self.metrics.observe('compress', time.perf_counter() - t0)
+        self.writer.write(protocol.prefix_length(frame))
+
+    async def run(self, idle_timeout=None):
+        """
+        Receives and processes messages until the connection is closed or nothing was received within the idle
+        timeout.
+
+        :param idle_timeout: Seconds or None for no timeout
+        """
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(self.reader.read(256 * 1024), idle_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning('socket stalled, nothing received for %.1fs', idle_timeout)
+                    return
+                except ConnectionError:
+                    return
+                if not data:
+                    return
+                self._receive_buffer.feed(data)
+                values = []
+                try:
+                    for frame in self._receive_buffer.frames():
+                        try:
+                            values.extend(self._decode_frame(frame))
+                        except ValueError as e:
+                            # malformed or invalid, drop the frame
+                            logger.warning('socket dropped received frame: %s', e)
+                            self.metrics.count('rejected_frames')
+                except Exception as e:
+                    # a frame too large (the stream cannot be resynchronized) or one that cannot be decoded at all
+                    logger.warning('socket received invalid data, abort connection: %r', e)
+                    self.metrics.count('protocol_errors')
+                    self._receive_buffer.clear()
+                    self.abort()
+                    return
+                for kind, value, size in values:
+                    if kind == protocol.KIND_CONTROL:
+                        self._process_control(value)
+                    elif kind != protocol.KIND_CHUNK:
+                        self._process(value, size)
+        finally:
+            # unfinished transfers give their bytes back to the budget of the process
+            self._incoming_transfers.clear()
+
+    async def heartbeat(self, interval):
+        """
+        Sends pings regularly while connected, the peer answers with pongs (see ExtendedTcpSocket).
+
+        :param interval: Seconds between two pings
+        """
+        while self.is_connected():
+            await asyncio.sleep(interval)
+            if self.is_connected():
+                self._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_PING,
+                                                                                      time.perf_counter())))
+
+    def _decode_frame(self, frame, max_size=None):
+        """
+        Un-compresses and de-serializes a frame (see lib/network.ExtendedTcpSocket._decode_frame()). Not intended
+        for outside use.
+
+        :return: List of tuples of frame kind, value and serialized size (several for a batch frame)
+        """
+        t0 = time.perf_counter()
+        if max_size is None:
+            max_size = self._receive_buffer.max_frame_size
+        kind, uncompressed = protocol.unpack_frame(frame, self.statistics, max_size)
+        self.metrics.observe('decompress', time.perf_counter() - t0)
+        if kind == protocol.KIND_CHUNK:
+            return self._receive_chunk(uncompressed)
+        if kind == protocol.KIND_BATCH:
+            return [self._decode_body(entry_kind, body) for entry_kind, body in protocol.unpack_batch(uncompressed)]
+        return [self._decode_body(kind, uncompressed)]
+
+    def _decode_body(self, kind, body):
+        """
+        De-serializes a body (validates letters). Not intended for outside use.
+        """
+        t0 = time.perf_counter()
+        if kind == protocol.KIND_CONTROL:
+            value = protocol.decode_body(kind, body)
+        else:
+            value = protocol.decode_letter(kind, body, constants.C, constants.M)
+        self.metrics.observe('parse', time.perf_counter() - t0)
+        return kind, value, len(body)
+
+    def _receive_chunk(self, body):
+        """
+        Copies the data of a chunk into its transfer. Not intended for outside use.
+        """
+        transfer_id, received, total, data = self._incoming_transfers.add(body)
+        values = [(protocol.KIND_CHUNK, (transfer_id, received, total), len(body))]
+        if data is not None:
+            values.extend(self._decode_frame(data))
+        return values
+
+    def _process_control(self, value):
+        """
+        A control frame was received. Not intended for outside use.
+        """
+        control, content = value
+        if control == protocol.CONTROL_HELLO:
+            self.codec = protocol.choose_codec(self.codecs, content)
+            self._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_HELLO_ACK,
+                                                                                  self.codec)))
+            self.negotiated.set()
+        elif control == protocol.CONTROL_HELLO_ACK:
+            # only an answer to our hello, with one of the codecs we offered
+            if self._offered_codecs is None or content not in protocol.CODECS or content not in self._offered_codecs:
+                logger.warning('socket ignored unexpected acknowledgement of codec %s', content)
+                return
+            self._offered_codecs = None
+            self.codec = content
+            self._update_round_trip_time(time.perf_counter() - self._hello_time)
+            self.negotiated.set()
+        elif control == protocol.CONTROL_PING:
+            self._send_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_PONG, content)))
+        elif control == protocol.CONTROL_PONG and isinstance(content, float):
+            self._update_round_trip_time(time.perf_counter() - content)
+        else:
+            logger.warning('socket received unknown control message %s', control)
+
+    def _update_round_trip_time(self, round_trip_time):
+        """
+        Records a measured round trip time. Not intended for outside use.
+        """
+        self.metrics.observe('round_trip', round_trip_time)
+        if self.round_trip_time is None:
+            self.round_trip_time = round_trip_time
+        else:
+            self.round_trip_time += 0.2 * (round_trip_time - self.round_trip_time)
+
+    def _process(self, letter, size):
+        """
+        A letter was received, calls all receivers of its channel. Not intended for outside use.
+        """
+        logger.debug('network client received letter: {}'.format(letter))
+        channel = letter['channel']
+        action = letter['action']
+        self.metrics.count(('messages_in', channel, action))
+        self.metrics.count(('bytes_in', channel, action), size)
+
+        # replies go to their request only
+        reply_id = letter.get('reply')
+        if reply_id is not None:
+            future = self.requests.get(reply_id)
+            if future is None or future.done():
+                logger.debug('dropped reply to cancelled request %d', reply_id)
+            else:
+                future.set_result(letter['content'])
+            return
+
+        self.current_request = letter.get('request')
+        try:
+            if self.dispatcher is not None:
+                # like in the Qt event loop, an error in a handler does not end the connection
+                try:
+                    if self.dispatcher.dispatch(self, channel, action, letter['content']):
+                        return
+                except Exception:
+                    logger.exception('error in handler of %s/%s', channel, action)
+                    return
+            if channel not in self.channels:
+                if self.dispatcher is not None:
+                    logger.warning('no handler for %s/%s', channel, action)
+                    return
+                raise RuntimeError('Received message on channel {} which is not existing.'.format(channel))
+            for callback in list(self.channels[channel]):
+                # like in the Qt event loop, an error in a receiver does not end the connection
+                try:
+                    callback(self, channel, action, letter['content'])
+                except Exception:
+                    logger.exception('error in receiver of %s/%s', channel, action)
+        finally:
+            self.current_request = None
+
+    def metrics_snapshot(self):
+        """
+        All metrics of this connection including the frame statistics.
+
+        :return: Dictionary (see Metrics.snapshot())
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot['frames'] = self.statistics.as_dict()
+        snapshot['gauges']['write_queue_bytes'] = self.writer.transport.get_write_buffer_size()
+        snapshot['gauges']['incoming_transfers'] = len(self._incoming_transfers)
+        snapshot['gauges']['round_trip_time'] = self.round_trip_time
+        return snapshot
+
+
+class AsyncServerManager(ServerServices):
+    """
+    Manages the server and the server clients (AsyncNetworkClient) like ServerManager but on asyncio.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.server = None
+        self._stopped = None
+        self._loop = None
+        self._client_tasks = set()
+
+    async def serve(self, port=constants.NETWORK_PORT, scope='local', ready=None):
+        """
+        Starts listening and serves until stopped (see stop()).
+
+        :param port: The port number (0 lets the system choose one).
+        :param scope: The scope (local/any).
+        :param ready: Called with the port number once listening or None
+        """
+        self._stopped = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self.session_router.scope = scope
+        logger.info('server starts (pid=%d)', os.getpid())
+        self.server = await asyncio.start_server(self._new_client, SCOPE[scope], port)
+        port = self.server.sockets[0].getsockname()[1]
+        logger.info('server listens on scope=%s port=%d', scope, port)
+        if ready is not None:
+            ready(port)
+
+        # core scenario previews will surely be requested
+        self.prewarm_previews()
+
+        # log network metrics regularly and measure the lag of the event loop if wished
+        tasks = []
+        if switches.NETWORK_METRICS_LOG_INTERVAL > 0:
+            tasks.append(asyncio.ensure_future(self._log_metrics_regularly()))
+        if switches.SERVER_LAG_MONITOR_INTERVAL > 0:
+            tasks.append(asyncio.ensure_future(self._measure_lag()))
+
+        await self._stopped.wait()
+        for task in tasks:
+            task.cancel()
+
+        # disconnect all server clients and wait until their tasks have finished
+        for client in list(self.server_clients):
+            self.drop_client(client)
+        await asyncio.gather(*self._client_tasks, return_exceptions=True)
+        await self.server.wait_closed()
+        self.stop_workers()
+
+    def stop(self):
+        """
+        Stops listening and lets serve() return.
+        """
+        self.server.close()
+        self._stopped.set()
+
+    def call_soon(self, callback):
+        """
+        Calls a callback in the event loop of the server (thread-safe).
+
+        :param callback: A callable
+        """
+        try:
+            self._loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            # the event loop is closed already
+            pass
+
+    async def _log_metrics_regularly(self):
+        """
+        Not intended for outside use.
+        """
+        while True:
+            await asyncio.sleep(switches.NETWORK_METRICS_LOG_INTERVAL)
+            self.log_metrics()
+
+    async def _measure_lag(self):
+        """
+        The lag is how much longer than the interval a sleep took. Not intended for outside use.
+        """
+        interval = switches.SERVER_LAG_MONITOR_INTERVAL
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.observe_lag(max(0, time.perf_counter() - t0 - interval))
+
+    async def _new_client(self, reader, writer):
+        """
+        A new connection to the server occurred. Adds a server client and processes its messages until the
+        connection is closed or stalls. Not intended for outside use.
+        """
+        if not self.admit_connection():
+            writer.transport.abort()
+            return
+        client = AsyncNetworkClient(reader, writer)
+        client.limit_write_queue(switches.SERVER_WRITE_QUEUE_LIMIT, switches.SERVER_WRITE_QUEUE_POLICY)
+        self.add_client(client)
+        task = asyncio.current_task()
+        self._client_tasks.add(task)
+        heartbeat = asyncio.ensure_future(client.heartbeat(switches.NETWORK_HEARTBEAT_INTERVAL))
+        try:
+            await client.run(switches.NETWORK_IDLE_TIMEOUT)
+        except Exception:
+            logger.exception('error processing messages of client with id %d', client.client_id)
+        finally:
+            heartbeat.cancel()
+            self._client_tasks.discard(task)
+            self.drop_client(client)
+
+
+class SessionServerManager(AsyncServerManager):
+    """
+    Serves one game session in a worker process started by a SessionRouter (see sessions.py). Reports its port and
+    number of clients to the router over a pipe and ends after switches.SERVER_SESSION_IDLE_TIMEOUT seconds without
+    clients. Does not start sessions itself.
+    """
+
+    def __init__(self, connection):
+        """
+        :param connection: Sending end of a multiprocessing.Pipe() to the router
+        """
+        super().__init__()
+        self.connection = connection
+        self._idle_timer = None
+        for action in (constants.M.LOBBY_SESSION_CREATE, constants.M.LOBBY_SESSION_LIST,
+                       constants.M.LOBBY_SESSION_JOIN):
+            self.dispatcher.unregister(constants.C.LOBBY, action)
+
+    def prewarm_previews(self):
+        """
+        Nothing to prewarm, the lobby with the scenario previews stays with the router.
+        """
+        pass
+
+    def ready(self, port):
+        """
+        Listening, tells the router where clients find this session.
+
+        :param port: The port number
+        """
+        self._report('ready', port)
+        self._update_idle_timer()
+
+    def add_client(self, client):
+        super().add_client(client)
+        self._report('clients', len(self.server_clients))
+        self._update_idle_timer()
+
+    def drop_client(self, client):
+        if client not in self.server_clients:
+            return
+        super().drop_client(client)
+        self._report('clients', len(self.server_clients))
+        self._update_idle_timer()
+
+    def _report(self, kind, value):
+        """
+        Not intended for outside use.
+        """
+        try:
+            self.connection.send((kind, value))
+        except OSError:
+            # the router is gone, so is the lobby
+            logger.warning('lost the connection to the router')
+            self.stop()
+
+    def _update_idle_timer(self):
+        """
+        Stops the session after a while without clients. Not intended for outside use.
+        """
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        if not self.server_clients and not self._stopped.is_set():
+            self._idle_timer = self._loop.call_later(switches.SERVER_SESSION_IDLE_TIMEOUT, self.stop)
+
+
+def run_session(connection, session_id, scope, switch_values, log_level):
+    """
+    Entry point of the worker process of a game session (see sessions.SessionRouter).
+
+    :param connection: Sending end of a multiprocessing.Pipe() to the router
+    :param session_id: Id of the session
+    :param scope: The scope (local/any)
+    :param switch_values: Values of the switches of the router (name -> value)
+    :param log_level: Level of the root logger
+    """
+    # the worker is spawned, switches and logging start fresh
+    for name, value in switch_values.items():
+        setattr(switches, name, value)
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter('%(asctime)s - session {} - %(name)s - %(levelname)s - '
+                                               '%(message)s'.format(session_id)))
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    root.addHandler(log_handler)
+
+    server_manager = SessionServerManager(connection)
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        # the router terminates its sessions, Ctrl+C reaches the whole process group
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, server_manager.stop)
+            except NotImplementedError:
+                pass
+        await server_manager.serve(0, scope, server_manager.ready)
+
+    asyncio.run(serve())
+    connection.close()
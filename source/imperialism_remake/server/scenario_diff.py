@@ -0,0 +1,466 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Section by section differences (patches) between scenarios and three-way merges of scenarios.
+
+A scenario archive consists of sections (properties, maps, provinces, nations), see constants.SCENARIO_FILE_*. The
+sections are read as they are stored in the archive, no rules file is needed. A patch is a dictionary with one entry
+per changed section and can be stored as YAML like everything else.
+
+* map layers are compared row by row (whole rows are compared at once, only changed rows are scanned tile by tile),
+  changes are stored as runs of consecutive tiles together with the bounding box of all changed tiles
+* properties are stored as 'set' and 'unset' property keys
+* provinces, nations (keyed by their id) and rivers (keyed by their position, names need not be unique) are stored as
+  'added', 'removed' and 'changed' entries
+"""
+
+import copy
+
+from imperialism_remake.base import constants
+from imperialism_remake.lib import utils
+
+#: all sections of a scenario archive that take part in the diff
+SECTIONS = (constants.SCENARIO_FILE_PROPERTIES, constants.SCENARIO_FILE_MAPS, constants.SCENARIO_FILE_PROVINCES,
+            constants.SCENARIO_FILE_NATIONS)
+
+#: rivers are stored inside the properties but are diffed separately (keyed by position)
+RIVERS = 'rivers'
+
+#: marker for a removed property during merging
+_UNSET = object()
+
+
+def read_scenario_sections(file_name):
+    """
+    Reads all sections of a scenario archive.
+
+    :param file_name: File name of the scenario
+    :return: Dictionary of section name and section content
+    """
+    reader = utils.ZipArchiveReader(file_name)
+    return {section: reader.read_as_yaml(section) for section in SECTIONS}
+
+
+def write_scenario_sections(file_name, sections):
+    """
+    Writes all sections into a new scenario archive (see also Scenario.save()).
+
+    :param file_name: File name of the scenario
+    :param sections: Dictionary of section name and section content
+    """
+    writer = utils.ZipArchiveWriter(file_name)
+    for section in SECTIONS:
+        writer.write_as_yaml(section, sections[section])
+
+
+def diff(old, new):
+    """
+    Computes the patch that transforms the sections of the old scenario into the sections of the new scenario. Only
+    changed sections are contained in the patch, an empty patch means no differences.
+
+    :param old: Sections of the old scenario
+    :param new: Sections of the new scenario
+    :return: The patch
+    """
+    patch = {}
+
+    old_properties, old_rivers = _split_rivers(old[constants.SCENARIO_FILE_PROPERTIES])
+    new_properties, new_rivers = _split_rivers(new[constants.SCENARIO_FILE_PROPERTIES])
+    _add_if_changed(patch, constants.SCENARIO_FILE_PROPERTIES, diff_properties(old_properties, new_properties))
+    _add_if_changed(patch, RIVERS, diff_keyed(old_rivers, new_rivers))
+
+    columns = new_properties.get(constants.ScenarioProperty.MAP_COLUMNS, 0)
+    maps = {}
+    old_maps = old[constants.SCENARIO_FILE_MAPS]
+    new_maps = new[constants.SCENARIO_FILE_MAPS]
+    for layer in new_maps:
+        layer_diff = diff_map_layer(old_maps.get(layer), new_maps[layer], columns)
+        if layer_diff:
+            maps[layer] = layer_diff
+    for layer in old_maps:
+        if layer not in new_maps:
+            maps[layer] = {'removed': True}
+    _add_if_changed(patch, constants.SCENARIO_FILE_MAPS, maps)
+
+    for section in (constants.SCENARIO_FILE_PROVINCES, constants.SCENARIO_FILE_NATIONS):
+        _add_if_changed(patch, section, diff_keyed(old[section], new[section]))
+
+    return patch
+
+
+def apply_patch(sections, patch):
+    """
+    Applies a patch to the sections of a scenario. The given sections are not modified.
+
+    :param sections: Sections of a scenario
+    :param patch: A patch (see diff())
+    :return: The patched sections
+    """
+    sections = copy.deepcopy(sections)
+
+    properties, rivers = _split_rivers(sections[constants.SCENARIO_FILE_PROPERTIES])
+    properties = apply_properties(properties, patch.get(constants.SCENARIO_FILE_PROPERTIES, {}))
+    rivers = apply_keyed(rivers, patch.get(RIVERS, {}))
+    sections[constants.SCENARIO_FILE_PROPERTIES] = _join_rivers(properties, rivers)
+
+    maps = sections[constants.SCENARIO_FILE_MAPS]
+    for layer, layer_diff in patch.get(constants.SCENARIO_FILE_MAPS, {}).items():
+        if layer_diff.get('removed'):
+            del maps[layer]
+        else:
+            maps[layer] = apply_map_layer(maps.get(layer), layer_diff)
+
+    for section in (constants.SCENARIO_FILE_PROVINCES, constants.SCENARIO_FILE_NATIONS):
+        sections[section] = apply_keyed(sections[section], patch.get(section, {}))
+
+    return sections
+
+
+def merge(base, ours, theirs):
+    """
+    Three-way merge of two scenarios (ours, theirs) that both derive from a common base. Changes that only one side
+    made are taken over, changes that both sides made identically are taken over once. If both sides changed the same
+    tile, property or entry differently, ours wins and the place is reported as conflict.
+
+    :param base: Sections of the common base scenario
+    :param ours: Sections of our scenario
+    :param theirs: Sections of their scenario
+    :return: Merged sections and a list of conflicts, each a tuple (section, key, detail)
+    """
+    our_patch = diff(base, ours)
+    their_patch = diff(base, theirs)
+    conflicts = []
+    patch = {}
+
+    section = constants.SCENARIO_FILE_PROPERTIES
+    _add_if_changed(patch, section, _merge_property_diffs(our_patch.get(section, {}), their_patch.get(section, {}),
+                                                          conflicts, section, None))
+
+    for section in (RIVERS, constants.SCENARIO_FILE_PROVINCES, constants.SCENARIO_FILE_NATIONS):
+        _add_if_changed(patch, section, _merge_keyed_diffs(our_patch.get(section, {}), their_patch.get(section, {}),
+                                                           conflicts, section))
+
+    base_maps = base[constants.SCENARIO_FILE_MAPS]
+    our_maps = our_patch.get(constants.SCENARIO_FILE_MAPS, {})
+    their_maps = their_patch.get(constants.SCENARIO_FILE_MAPS, {})
+    columns = base[constants.SCENARIO_FILE_PROPERTIES].get(constants.ScenarioProperty.MAP_COLUMNS, 0)
+    maps = {}
+    for layer in set(our_maps) | set(their_maps):
+        maps[layer] = _merge_map_layer_diffs(base_maps.get(layer), our_maps.get(layer), their_maps.get(layer),
+                                             columns, conflicts, layer)
+    _add_if_changed(patch, constants.SCENARIO_FILE_MAPS, maps)
+
+    return apply_patch(base, patch), conflicts
+
+
+def diff_map_layer(old, new, columns):
+    """
+    Difference of a map layer (a linear list of tiles, row by row). Rows are compared as a whole first, only rows
+    that differ are scanned tile by tile. The changed tiles are stored as runs (start index, list of new values) and
+    the bounding box (first column, first row, last column, last row) of all changed tiles is given.
+
+    If the old layer does not exist or has a different size, the whole new layer is stored instead.
+
+    :param old: Old map layer or None
+    :param new: New map layer
+    :param columns: Number of columns of the map
+    :return: Layer diff or an empty dictionary if there are no differences.
+    """
+    if old is None or len(old) != len(new) or columns <= 0:
+        return {'replaced': list(new)}
+    if old == new:
+        return {}
+
+    changed = []
+    for start in range(0, len(new), columns):
+        end = start + columns
+        old_row = old[start:end]
+        new_row = new[start:end]
+        if old_row != new_row:
+            changed.extend(start + i for i, (a, b) in enumerate(zip(old_row, new_row)) if a != b)
+
+    runs = []
+    for index in changed:
+        if runs and runs[-1][0] + len(runs[-1][1]) == index:
+            runs[-1][1].append(new[index])
+        else:
+            runs.append([index, [new[index]]])
+
+    changed_columns = [index % columns for index in changed]
+    changed_rows = [index // columns for index in changed]
+    bounding_box = (min(changed_columns), changed_rows[0], max(changed_columns), changed_rows[-1])
+
+    return {'runs': runs, 'bounding_box': bounding_box, 'number_changed': len(changed)}
+
+
+def apply_map_layer(layer, layer_diff):
+    """
+    Applies a layer diff (see diff_map_layer()) to a map layer.
+
+    :param layer: Map layer (not modified)
+    :param layer_diff: Layer diff
+    :return: New map layer
+    """
+    if 'replaced' in layer_diff:
+        return list(layer_diff['replaced'])
+    layer = list(layer)
+    for start, values in layer_diff.get('runs', []):
+        layer[start:start + len(values)] = values
+    return layer
+
+
+def diff_properties(old, new):
+    """
+    Difference of two property dictionaries.
+
+    :param old: Old properties
+    :param new: New properties
+    :return: Dictionary with new or changed properties ('set') and removed property keys ('unset')
+    """
+    result = {}
+    changed = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    if changed:
+        result['set'] = changed
+    removed = [key for key in old if key not in new]
+    if removed:
+        result['unset'] = removed
+    return result
+
+
+def apply_properties(properties, properties_diff):
+    """
+    Applies a properties diff (see diff_properties()) to a property dictionary.
+
+    :param properties: Properties (not modified)
+    :param properties_diff: Properties diff
+    :return: New properties
+    """
+    properties = dict(properties)
+    for key in properties_diff.get('unset', []):
+        properties.pop(key, None)
+    properties.update(copy.deepcopy(properties_diff.get('set', {})))
+    return properties
+
+
+def diff_keyed(old, new):
+    """
+    Difference of two dictionaries of entries (provinces, nations, rivers). Entries that are dictionaries themselves
+    are compared property by property, all other entries are compared as a whole.
+
+    :param old: Old entries
+    :param new: New entries
+    :return: Dictionary with 'added', 'removed' and 'changed' entries
+    """
+    result = {}
+    added = {key: value for key, value in new.items() if key not in old}
+    if added:
+        result['added'] = added
+    removed = [key for key in old if key not in new]
+    if removed:
+        result['removed'] = removed
+    changed = {}
+    for key, value in new.items():
+        if key in old and old[key] != value:
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                changed[key] = diff_properties(old[key], value)
+            else:
+                changed[key] = {'value': value}
+    if changed:
+        result['changed'] = changed
+    return result
+
+
+def apply_keyed(entries, keyed_diff):
+    """
+    Applies a keyed diff (see diff_keyed()) to a dictionary of entries.
+
+    :param entries: Entries (not modified)
+    :param keyed_diff: Keyed diff
+    :return: New entries
+    """
+    entries = dict(entries)
+    for key in keyed_diff.get('removed', []):
+        entries.pop(key, None)
+    for key, change in keyed_diff.get('changed', {}).items():
+        if 'value' in change:
+            entries[key] = copy.deepcopy(change['value'])
+        else:
+            entries[key] = apply_properties(entries[key], change)
+    entries.update(copy.deepcopy(keyed_diff.get('added', {})))
+    return entries
+
+
+def summary(patch):
+    """
+    Human readable short summary of a patch, one line per changed section.
+
+    :param patch: The patch
+    :return: List of lines
+    """
+    lines = []
+    for layer, layer_diff in sorted(patch.get(constants.SCENARIO_FILE_MAPS, {}).items()):
+        if layer_diff.get('removed'):
+            lines.append('map {}: removed'.format(layer))
+        elif 'replaced' in layer_diff:
+            lines.append('map {}: replaced'.format(layer))
+        else:
+            lines.append('map {}: {} tiles changed in box {}'.format(layer, layer_diff['number_changed'],
+                                                                     layer_diff['bounding_box']))
+    properties_diff = patch.get(constants.SCENARIO_FILE_PROPERTIES, {})
+    if properties_diff:
+        lines.append('properties: {} set, {} unset'.format(len(properties_diff.get('set', {})),
+                                                           len(properties_diff.get('unset', []))))
+    for section in (RIVERS, constants.SCENARIO_FILE_PROVINCES, constants.SCENARIO_FILE_NATIONS):
+        keyed_diff = patch.get(section, {})
+        if keyed_diff:
+            lines.append('{}: {} added, {} removed, {} changed'.format(section, len(keyed_diff.get('added', {})),
+                                                                       len(keyed_diff.get('removed', [])),
+                                                                       len(keyed_diff.get('changed', {}))))
+    return lines
+
+
+def _add_if_changed(patch, section, section_diff):
+    """
+    Adds a section diff to the patch unless it is empty. Not intended for outside use.
+    """
+    if section_diff:
+        patch[section] = section_diff
+
+
+def _split_rivers(properties):
+    """
+    Separates the rivers (as dictionary position -> river) from the other scenario properties. Not intended for
+    outside use.
+    """
+    properties = dict(properties)
+    rivers = properties.pop(constants.ScenarioProperty.RIVERS, [])
+    return properties, dict(enumerate(rivers))
+
+
+def _join_rivers(properties, rivers):
+    """
+    Inverse of _split_rivers(). Not intended for outside use.
+    """
+    properties = dict(properties)
+    properties[constants.ScenarioProperty.RIVERS] = [rivers[position] for position in sorted(rivers)]
+    return properties
+
+
+def _merge_property_diffs(ours, theirs, conflicts, section, key):
+    """
+    Merges two properties diffs of the same base. Not intended for outside use.
+    """
+    our_set, their_set = ours.get('set', {}), theirs.get('set', {})
+    our_unset, their_unset = set(ours.get('unset', [])), set(theirs.get('unset', []))
+
+    result_set = dict(their_set)
+    result_set.update(our_set)
+    result_unset = (our_unset | their_unset) - set(result_set)
+
+    for name in (set(our_set) | our_unset) & (set(their_set) | their_unset):
+        if our_set.get(name, _UNSET) != their_set.get(name, _UNSET):
+            conflicts.append((section, key, name))
+        if name in our_unset:
+            result_set.pop(name, None)
+            result_unset.add(name)
+
+    result = {}
+    if result_set:
+        result['set'] = result_set
+    if result_unset:
+        result['unset'] = list(result_unset)
+    return result
+
+
+def _merge_keyed_diffs(ours, theirs, conflicts, section):
+    """
+    Merges two keyed diffs of the same base. Not intended for outside use.
+    """
+    added = dict(theirs.get('added', {}))
+    for key, value in ours.get('added', {}).items():
+        if key in added and added[key] != value:
+            conflicts.append((section, key, 'added'))
+        added[key] = value
+
+    our_removed, their_removed = set(ours.get('removed', [])), set(theirs.get('removed', []))
+    our_changed, their_changed = ours.get('changed', {}), theirs.get('changed', {})
+
+    changed = {}
+    for key in set(our_changed) | set(their_changed):
+        if key in our_changed and key in their_changed:
+            our_change, their_change = our_changed[key], their_changed[key]
+            if 'value' in our_change or 'value' in their_change:
+                if our_change != their_change:
+                    conflicts.append((section, key, 'changed'))
+                changed[key] = our_change
+            else:
+                changed[key] = _merge_property_diffs(our_change, their_change, conflicts, section, key)
+        elif key in our_changed:
+            if key in their_removed:
+                conflicts.append((section, key, 'removed'))
+            changed[key] = our_changed[key]
+        elif key not in our_removed:
+            changed[key] = their_changed[key]
+        else:
+            conflicts.append((section, key, 'removed'))
+
+    # ours wins: an entry changed by us stays even if they removed it
+    removed = (our_removed | their_removed) - set(changed)
+
+    result = {}
+    if added:
+        result['added'] = added
+    if removed:
+        result['removed'] = list(removed)
+    if changed:
+        result['changed'] = changed
+    return result
+
+
+def _merge_map_layer_diffs(base, ours, theirs, columns, conflicts, layer):
+    """
+    Merges two layer diffs of the same base layer. Not intended for outside use.
+    """
+    if ours is None or theirs is None:
+        return ours if ours is not None else theirs
+    if ours == theirs:
+        return ours
+    if ours.get('removed') or theirs.get('removed') or 'replaced' in ours or 'replaced' in theirs:
+        conflicts.append((constants.SCENARIO_FILE_MAPS, layer, 'replaced'))
+        return ours
+
+    # tile by tile, ours wins
+    tiles = _tiles_of_runs(theirs)
+    for index, value in _tiles_of_runs(ours).items():
+        if index in tiles and tiles[index] != value:
+            conflicts.append((constants.SCENARIO_FILE_MAPS, layer, index))
+        tiles[index] = value
+    merged = list(base)
+    for index, value in tiles.items():
+        merged[index] = value
+    return diff_map_layer(base, merged, columns)
+
+
+def _tiles_of_runs(layer_diff):
+    """
+    Expands the runs of a layer diff into a dictionary of tile index and value. Not intended for outside use.
+    """
+    tiles = {}
+    for start, values in layer_diff['runs']:
+        for offset, value in enumerate(values):
+            tiles[start + offset] = value
+    return tiles
@@ -18,19 +18,18 @@
 Server network code. Only deals with the network connection, client connection management and message distribution.
 """
 
-from datetime import datetime
+from functools import partial
 import logging
 import logging.handlers
 import multiprocessing
 import os
-import random
 import time
 
 from PyQt5 import QtCore, QtNetwork
 
-from imperialism_remake.base import constants, network as base_network
-from imperialism_remake.lib import utils, qt, network as lib_network
-from imperialism_remake.server.scenario import Scenario
+from imperialism_remake.base import constants, switches, network as base_network
+from imperialism_remake.lib import qt, network as lib_network
+from imperialism_remake.server.services import ServerServices
 
 
 logger = logging.getLogger(__name__)
@@ -45,11 +44,18 @@ class ServerProcess(multiprocessing.Process):
     A Process that inside its run method executes a QCoreApplication which runs the server.
     """
 
-    def __init__(self, log_queue, log_formatter, log_level):
+    def __init__(self, log_queue, log_formatter, log_level, client_connection=None, launch_time=None):
+        """
+        :param client_connection: One end of a multiprocessing.Pipe() to a local client (the client has the other
+            end) or None
+        :param launch_time: Time (time.time()) of the launch for measuring the startup or None
+        """
         super().__init__()
         self._log_queue = log_queue
         self._log_formatter = log_formatter
         self._log_level = log_level
+        self._client_connection = client_connection
+        self._launch_time = launch_time
 
     def run(self):
         """
@@ -65,10 +71,15 @@ class ServerProcess(multiprocessing.Process):
         server_manager = ServerManager()
         server_manager.shutdown.connect(app.quit)
         # noinspection PyCallByClass
-        QtCore.QTimer.singleShot(100, server_manager.start)
+        QtCore.QTimer.singleShot(100, partial(start_server, server_manager, self._launch_time))
+
+        # the local client talks to us over a pipe
+        if self._client_connection is not None:
+            server_manager.add_local_client(self._client_connection)
 
         # run event loop of app
         app.exec_()
+        server_manager.stop_workers()
 
     def _configure_forked_logger(self):
         """ create a new logging handler that will inject its records into a queue
@@ -88,6 +99,52 @@ class ServerProcess(multiprocessing.Process):
         logger.info("created a multiprocess logger (pid=%d)", os.getpid())
 
 
+class ServerThread(QtCore.QThread):
+    """
+    A thread that runs the server inside the process of the client (with its own event loop). Starts faster than a
+    ServerProcess but the server ends with the client, therefore only for single player.
+    """
+
+    def __init__(self, client_connection, launch_time=None):
+        """
+        :param client_connection: One end of a multiprocessing.Pipe() to the local client (the client has the other
+            end)
+        :param launch_time: Time (time.time()) of the launch for measuring the startup or None
+        """
+        super().__init__()
+        self._client_connection = client_connection
+        self._launch_time = launch_time
+
+    def run(self):
+        """
+        Runs the server in the event loop of this thread. The server manager is created here to live in this thread.
+        """
+        server_manager = ServerManager()
+        # the main event loop might have finished already, quit directly
+        server_manager.shutdown.connect(self.quit, QtCore.Qt.DirectConnection)
+        start_server(server_manager, self._launch_time)
+        server_manager.add_local_client(self._client_connection)
+        self.exec_()
+
+        # Qt objects with timers must be deleted in this thread (deferred deletes happen when the thread finishes)
+        for client in list(server_manager.server_clients):
+            server_manager.drop_client(client)
+        server_manager.stop_workers()
+        server_manager.deleteLater()
+
+
+def start_server(server_manager, launch_time=None):
+    """
+    Starts a server manager and logs how long the startup took.
+
+    :param server_manager: The server manager
+    :param launch_time: Time (time.time()) of the launch or None
+    """
+    server_manager.start()
+    if launch_time is not None:
+        logger.info('server ready %.3fs after launch', time.time() - launch_time)
+
+
 class ServerNetworkClient(base_network.NetworkClient):
     """
     Server network client.
@@ -96,20 +153,31 @@ class ServerNetworkClient(base_network.NetworkClient):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # replies and distributed messages often come in bursts
+        self.enable_batching()
+
+        # detect dead connections
+        self.enable_heartbeat(switches.NETWORK_HEARTBEAT_INTERVAL, switches.NETWORK_IDLE_TIMEOUT)
+
+        # slow readers must not make us buffer without limit
+        self.limit_write_queue(switches.SERVER_WRITE_QUEUE_LIMIT, switches.SERVER_WRITE_QUEUE_POLICY)
+
         # important properties
-        self.subscribed_to_chat = False
         self.name = ''
 
 
-class ServerManager(QtCore.QObject):
+class ServerManager(QtCore.QObject, ServerServices):
     """
-    Manages the server, the clients on the server and the general services on the server. In particular creates new
-    clients (NetworkClient) on the server (named server clients).
+    Manages the server, the clients on the server and the general services on the server (see ServerServices). In
+    particular creates new clients (NetworkClient) on the server (named server clients).
     """
 
     #: signal
     shutdown = QtCore.pyqtSignal()
 
+    #: signal (callback), emitted from other threads, see call_soon()
+    _callback_posted = QtCore.pyqtSignal(object)
+
     def __init__(self):
         """
         We start with a server (ExtendedTcpServer) and an empty list of server clients (NetworkClient).
@@ -118,221 +186,127 @@ class ServerManager(QtCore.QObject):
         logger.info("ServerManager started")
         self.server = lib_network.ExtendedTcpServer()
         self.server.new_client.connect(self._new_client)
-        self.server_clients = []
-        self.chat_log = []
+        self._callback_posted.connect(self._run_callback)
 
-    def start(self):
+    def start(self, port=constants.NETWORK_PORT, scope='local'):
         """
-        Start the extended TCP server with a local scope.
+        Start the extended TCP server.
+
+        :param port: The port number.
+        :param scope: The scope (local/any).
         """
         logger.info('server starts (pid=%d)', os.getpid())
-        self.server.start(constants.NETWORK_PORT)
-
-    def _new_client(self, socket: QtNetwork.QTcpSocket):
+        self.server.start(port, scope)
+        self.session_router.scope = scope
+
+        # core scenario previews will surely be requested
+        self.prewarm_previews()
+
+        # log network metrics regularly if wished
+        if switches.NETWORK_METRICS_LOG_INTERVAL > 0:
+            self.metrics_timer = QtCore.QTimer(self)
+            self.metrics_timer.timeout.connect(self.log_metrics)
+            self.metrics_timer.start(switches.NETWORK_METRICS_LOG_INTERVAL * 1000)
+
+        # measure the lag of the event loop if wished
+        if switches.SERVER_LAG_MONITOR_INTERVAL > 0:
+            self.lag_timer = QtCore.QTimer(self)
+            self.lag_timer.setTimerType(QtCore.Qt.PreciseTimer)
+            self.lag_timer.timeout.connect(self._measure_lag)
+            self._lag_time = time.perf_counter()
+            self.lag_timer.start(int(switches.SERVER_LAG_MONITOR_INTERVAL * 1000))
+
+    def stop(self):
         """
-        A new connection (QTCPPSocket) to the server occurred. Give it an id and add some general receivers to the new
-        server client (wrap the socket into a NetworkClient). Add the new server client to the internal client list.
-        Not intended for outside use.
-
-        :param socket: The socket for the new connection
+        Stops listening and emits shutdown.
         """
-        # wrap into a NetworkClient
-        client = ServerNetworkClient(socket)
-
-        # give it a new id
-        while True:
-            # theoretically this could take forever, practically only if we have 1e6 clients already
-            new_id = random.randint(0, 1e6)
-            if not any([new_id == client.client_id for client in self.server_clients]):
-                # not any == none
-                break
-        # noinspection PyUnboundLocalVariable
-        client.client_id = new_id
-        logger.info('new client with id {}'.format(new_id))
-
-        # add some general channels and receivers
-        # TODO the receivers should be in another module eventually
-        client.connect_to_channel(constants.C.LOBBY, self._lobby_messages)
-        client.connect_to_channel(constants.C.GENERAL, general_messages)
-
-        # TODO only if localhost connection add the system channel
-        client.connect_to_channel(constants.C.SYSTEM, self._system_messages)
-
-        # chat message system, handled by a single central routine
-        client.connect_to_channel(constants.C.CHAT, self._chat_system)
-
-        # finally add to list of clients
-        self.server_clients.append(client)
+        self.server.stop()
+        self.shutdown.emit()
 
-    def _chat_system(self, client: ServerNetworkClient, channel: constants.C, action: constants.M, content):
+    def call_soon(self, callback):
         """
+        Calls a callback in the thread of the server manager (queued connection if emitted from another thread).
 
-        :param client:
-        :param channel:
-        :param action:
-        :param content:
+        :param callback: A callable
         """
-
-        if action == constants.M.CHAT_SUBSCRIBE:
-            # add this client to list of clients to be notified of new chat messages
-            client.subscribed_to_chat = True
-
-        elif action == constants.M.CHAT_UNSUBSCRIBE:
-            # remove this client from list of clients to be notified of new chat messages
-            client.subscribed_to_chat = False
-
-        elif action == constants.M.CHAT_LOG:
-            # send history/log of last chat messages
+        try:
+            self._callback_posted.emit(callback)
+        except RuntimeError:
+            # the server manager has been deleted already
             pass
 
-        elif action == constants.M.CHAT_MESSAGE:
-            # new chat message from this client, log and distribute
-
-            # format message
-            now = datetime.now().strftime('%H:%M:%S')
-            chat_message = '{}: {} - {}'.format(now, client.name, content)
-
-            # append to chat log
-            self.chat_log.append(chat_message)
-
-            # distribute chat message
-            for client in self.server_clients:
-                if client.subscribed_to_chat:
-                    client.send(constants.C.CHAT, constants.M.CHAT_MESSAGE, chat_message)
-
-    def _system_messages(self, client: ServerNetworkClient, channel: constants.C, action: constants.M, content):
+    @QtCore.pyqtSlot(object)
+    def _run_callback(self, callback):
         """
-        Handles system messages of a local client to its local server. Not intended for outside use.
-
-        :param client:
-        :param channel:
-        :param action:
-        :param content:
+        Not intended for outside use.
         """
-        if action == constants.M.SYSTEM_SHUTDOWN:
-            # shuts down
-
-            logger.info('server manager shuts down')
-            # TODO disconnect all server clients, clean up, ...
-            self.server.stop()
-            self.shutdown.emit()
+        callback()
 
-        elif action == constants.M.SYSTEM_MONITOR_UPDATE:
-
-            # assemble monitor update
-            update = {
-                'number_connected_clients': len(self.server_clients)
-            }
-            client.send(constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE, update)
-
-    def _lobby_messages(self, client: ServerNetworkClient, channel: constants.C, action: constants.M, content):
+    def _measure_lag(self):
         """
-
-        :param client:
-        :param channel:
-        :param action:
-        :param content:
+        Called by the lag timer, the lag is the time since the last call minus the interval. Not intended for outside
+        use.
         """
-        if action == constants.M.LOBBY_SCENARIO_CORE_LIST:
-            # get list of scenarios and send it back
-            scenarios = scenario_core_titles()
-            client.send(channel, action, scenarios)
-
-        elif action == constants.M.LOBBY_SCENARIO_PREVIEW:
-            # get preview and send it back
-            preview = scenario_preview(content)
-            client.send(channel, action, preview)
-
-        elif action == constants.M.LOBBY_CONNECTED_CLIENTS:
-            # get list of connected clients and send it back
-            connected_clients = [c.name for c in self.server_clients]
-            client.send(channel, action, connected_clients)
-
-
-def general_messages(client: ServerNetworkClient, channel: constants.C, action: constants.M, content):
-    """
-
-    :param client:
-    :param channel:
-    :param action:
-    :param content:
-    """
+        now = time.perf_counter()
+        self.observe_lag(max(0, now - self._lag_time - switches.SERVER_LAG_MONITOR_INTERVAL))
+        self._lag_time = now
 
-    if action == constants.M.GENERAL_NAME:
-        client.name = content
+    def add_local_client(self, connection):
+        """
+        Adds a server client for a local client connected by a pipe instead of TCP.
 
+        :param connection: One end of a multiprocessing.Pipe(), the local client has the other end.
+        """
+        client = ServerNetworkClient(lib_network.PipeSocket(connection))
+        self.add_client(client)
+        client.socket.open()
 
-def scenario_core_titles():
-    """
-    A server client received a message on the constants.C.SCENARIO_CORE_TITLES channel. Return all available core
-    scenario titles and file names.
-    """
-    # get all core scenario files
-    scenario_files = [x for x in os.listdir(constants.CORE_SCENARIO_FOLDER) if x.endswith('.scenario')]
+    def add_client(self, client):
+        """
+        Like ServerServices.add_client() but closed or dead (stalled remote) connections are dropped.
 
-    # join the path
-    scenario_files = [os.path.join(constants.CORE_SCENARIO_FOLDER, x) for x in scenario_files]
+        :param client: The new server client
+        """
+        client.disconnected.connect(partial(self.drop_client, client))
+        client.stalled.connect(partial(self._client_stalled, client))
+        super().add_client(client)
 
-    # read scenario titles
-    scenario_titles = []
-    for scenario_file in scenario_files:
-        reader = utils.ZipArchiveReader(scenario_file)
-        properties = reader.read_as_yaml(constants.SCENARIO_FILE_PROPERTIES)
-        scenario_titles.append(properties[constants.ScenarioProperty.TITLE])
+    def _client_stalled(self, client, idle):
+        """
+        Nothing was received from a server client within the idle timeout. A remote client is dropped, a local client
+        is kept (only logged), its user interface may just be busy and a pipe cannot reconnect. Not intended for
+        outside use.
+        """
+        if client.is_local():
+            logger.warning('local client with id %d stalled for %.1fs, kept', client.client_id, idle)
+            return
+        self.drop_client(client)
 
-    # zip files and titles together
-    scenarios = zip(scenario_titles, scenario_files)
+    def drop_client(self, client):
+        """
+        Like ServerServices.drop_client() but also deletes the Qt objects of the server client (the socket of a TCP
+        connection belongs to the TCP server otherwise).
 
-    # sort them
-    scenarios = sorted(scenarios)  # default sort order is by first element anyway
+        :param client: The server client
+        """
+        if client not in self.server_clients:
+            return
+        super().drop_client(client)
+        client.socket.deleteLater()
+        client.deleteLater()
 
-    return scenarios
+    def _new_client(self, socket: QtNetwork.QTcpSocket):
+        """
+        A new connection (QTCPPSocket) to the server occurred. Wrap the socket into a server client and add it (see
+        ServerServices.add_client()). Not intended for outside use.
 
+        :param socket: The socket for the new connection
+        """
+        if not self.admit_connection():
+            socket.abort()
+            socket.deleteLater()
+            return
 
-def scenario_preview(scenario_file_name):
-    """
-    A client got a message on the constants.C.SCENARIO_PREVIEW channel. In the message should be a scenario file name
-    (key = 'scenario'). Assemble a preview and send it back.
-    """
-    t0 = time.clock()
-
-    # TODO existing? can be loaded?
-    scenario = Scenario.from_file(scenario_file_name)
-    logger.info('reading of the file took {}s'.format(time.clock() - t0))
-
-    preview = {'scenario': scenario_file_name}
-
-    # some scenario properties should be copied
-    scenario_copy_keys = [constants.ScenarioProperty.MAP_COLUMNS,
-                          constants.ScenarioProperty.MAP_ROWS,
-                          constants.ScenarioProperty.TITLE,
-                          constants.ScenarioProperty.DESCRIPTION]
-    for key in scenario_copy_keys:
-        preview[key] = scenario[key]
-
-    # some nations properties should be copied
-    nations = {}
-    nation_copy_keys = [constants.NationProperty.COLOR,
-                        constants.NationProperty.NAME,
-                        constants.NationProperty.DESCRIPTION]
-    for nation in scenario.nations():
-        nations[nation] = {}
-        for key in nation_copy_keys:
-            nations[nation][key] = scenario.nation_property(nation, key)
-    preview['nations'] = nations
-
-    # assemble a nations map (-1 means no nation)
-    columns = scenario[constants.ScenarioProperty.MAP_COLUMNS]
-    rows = scenario[constants.ScenarioProperty.MAP_ROWS]
-    nations_map = [-1] * (columns * rows)
-    for nation_id in scenario.nations():
-        provinces = scenario.provinces_of_nation(nation_id)
-        for province in provinces:
-            tiles = scenario.province_property(province, constants.ProvinceProperty.TILES)
-            for column, row in tiles:
-                nations_map[row * columns + column] = nation_id
-    preview['map'] = nations_map
-
-    logger.info('generating preview took {}s'.format(time.clock() - t0))
-
-    return preview
+        # wrap into a NetworkClient
+        client = ServerNetworkClient(socket)
+        self.add_client(client)
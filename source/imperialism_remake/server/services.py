@@ -0,0 +1,761 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Services of the server (client management, subscriptions, chat, lobby, system) independent of the network transport.
+Used by the Qt server (server.py) and the asyncio server (async_server.py).
+"""
+
+from datetime import datetime
+from functools import partial
+import collections
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+from imperialism_remake.base import constants, switches
+from imperialism_remake.lib import dispatch, metrics, utils
+from imperialism_remake.server.scenario import Scenario
+from imperialism_remake.server.sessions import SessionRouter
+
+logger = logging.getLogger(__name__)
+
+#: token bucket limits (messages per second, burst) of each server client for each channel, other channels are not
+#: limited
+RATE_LIMITS = {
+    constants.C.GENERAL: (2, 10),
+    constants.C.CHAT: (5, 20),
+    constants.C.LOBBY: (10, 50)
+}
+
+#: maximal number of chat messages in a reply to CHAT_LOG
+CHAT_LOG_PAGE_SIZE = 50
+
+#: a chat message in the chat history: consecutive number, time (seconds since the epoch), id and name of the client
+#: and the text
+ChatRecord = collections.namedtuple('ChatRecord', ('number', 'time', 'client_id', 'name', 'text'))
+
+
+class ServerServices:
+    """
+    The server clients, their subscriptions and the processing of their messages. Server clients must offer send(),
+    send_chunked(), pack_letter(), write_frame(), is_connected(), is_local(), abort(), a codec, metrics and
+    metrics_snapshot() as well as the attributes name, client_id, dispatcher and current_request (see
+    ServerNetworkClient).
+
+    Messages are processed by handlers, one for each channel and action, in a dispatch table shared by all server
+    clients. Letters over the rate limit of a client and channel (see RATE_LIMITS) are dropped. Slow requests
+    (scenario titles and previews) run in a pool of workers, the reply is sent when the job is done (with the id of
+    the request). Game sessions run in worker processes of their own (see sessions.py), clients are redirected to
+    them.
+
+    Derived classes implement stop() and call_soon().
+    """
+
+    def __init__(self):
+        self.server_clients = ClientRegistry()
+
+        # the last chat messages (ChatRecord)
+        self.chat_history = collections.deque(maxlen=switches.SERVER_CHAT_HISTORY_SIZE)
+        self._chat_counter = 0
+
+        # metrics of the dropped server clients
+        self.dropped_metrics = metrics.Metrics()
+
+        # subscribed clients for each topic (e.g. a channel) for broadcasting
+        self.subscribers = {}
+
+        # assembled scenario previews by file name and modification time
+        self.preview_cache = utils.LRUCache(switches.SERVER_PREVIEW_CACHE_SIZE)
+
+        # pool of workers for slow requests, the server clients waiting for each job (client, request id, callback)
+        # and the running jobs assembling a scenario preview by file name and modification time
+        self.workers = create_worker_pool()
+        self._waiting = {}
+        self._preview_jobs = {}
+
+        # game sessions in worker processes
+        self.session_router = SessionRouter(self.call_soon)
+
+        # rate limits (token buckets by channel) of each server client
+        self._rate_limiters = {}
+
+        # how much later than scheduled the event loop called a timer (see observe_lag)
+        self.loop_lag = metrics.Histogram()
+
+        # handlers of all messages (slow ones are logged)
+        self.dispatcher = dispatch.Dispatcher()
+        self.dispatcher.admission = self._admit
+        self.dispatcher.slow_threshold = switches.SERVER_SLOW_THRESHOLD or None
+        self.dispatcher.slow_handler = self._slow_handler
+        handlers = {
+            (constants.C.GENERAL, constants.M.GENERAL_NAME): self._general_name,
+            (constants.C.LOBBY, constants.M.LOBBY_SCENARIO_CORE_LIST): self._lobby_scenario_core_list,
+            (constants.C.LOBBY, constants.M.LOBBY_SCENARIO_PREVIEW): self._lobby_scenario_preview,
+            (constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS): self._lobby_connected_clients,
+            (constants.C.LOBBY, constants.M.LOBBY_SESSION_CREATE): self._lobby_session_create,
+            (constants.C.LOBBY, constants.M.LOBBY_SESSION_LIST): self._lobby_session_list,
+            (constants.C.LOBBY, constants.M.LOBBY_SESSION_JOIN): self._lobby_session_join,
+            (constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN): self._system_shutdown,
+            (constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE): self._system_monitor_update,
+            (constants.C.SYSTEM, constants.M.SYSTEM_METRICS): self._system_metrics,
+            (constants.C.CHAT, constants.M.CHAT_SUBSCRIBE): self._chat_subscribe,
+            (constants.C.CHAT, constants.M.CHAT_UNSUBSCRIBE): self._chat_unsubscribe,
+            (constants.C.CHAT, constants.M.CHAT_LOG): self._chat_log,
+            (constants.C.CHAT, constants.M.CHAT_MESSAGE): self._chat_message
+        }
+        for (channel, action), handler in handlers.items():
+            self.dispatcher.register(channel, action, handler)
+
+    def stop(self):
+        """
+        Stops the server (a local client requested a shutdown).
+        """
+        raise NotImplementedError()
+
+    def call_soon(self, callback):
+        """
+        Calls a callback (without arguments) soon in the thread of the server. Must be safe to call from any thread.
+
+        :param callback: A callable
+        """
+        raise NotImplementedError()
+
+    def stop_workers(self):
+        """
+        Shuts the worker pool down and stops the game sessions once the event loop has finished. Jobs that have not
+        started yet are cancelled, waits for the running jobs (a process exiting with workers still running might
+        hang).
+        """
+        self.workers.shutdown(cancel_futures=True)
+        self.session_router.stop()
+
+    def wait_for(self, client, future, callback):
+        """
+        Calls back with the result of a job of the worker pool in the thread of the server, unless the client has
+        been dropped in the meantime. Failed jobs are logged instead. Many requests (also of the same client) can wait
+        for the same job, each is answered.
+
+        :param client: The server client waiting for the job
+        :param future: The job (concurrent.futures.Future)
+        :param callback: A callable taking the result of the job
+        """
+        waiting = self._waiting.get(future)
+        if waiting is not None:
+            waiting.append((client, client.current_request, callback))
+            return
+        # registered before the done callback, which is called at once if the job is done (e.g. a cached preview)
+        # and call_soon() may call directly
+        self._waiting[future] = [(client, client.current_request, callback)]
+        future.add_done_callback(lambda _: self.call_soon(partial(self._job_done, future)))
+
+    def _job_done(self, future):
+        """
+        A job clients wait for is done, calls back for every request still waiting. Not intended for outside use.
+        """
+        waiting = self._waiting.pop(future, None)
+        if waiting is None or future.cancelled():
+            # all waiting clients have been dropped
+            return
+        error = future.exception()
+        for client, request_id, callback in waiting:
+            if error is not None:
+                logger.error('job for client with id %d (request %s) failed', client.client_id, request_id,
+                             exc_info=error)
+                continue
+            callback(future.result())
+
+    def admit_connection(self):
+        """
+        Decides if a new connection is accepted, there can be at most switches.SERVER_MAX_CLIENTS clients. Refused
+        connections are logged and counted ('refused_connections').
+
+        :return: True if the connection is accepted
+        """
+        if not 0 < switches.SERVER_MAX_CLIENTS <= len(self.server_clients):
+            return True
+        logger.warning('refused connection, already %d clients', len(self.server_clients))
+        self.dropped_metrics.count('refused_connections')
+        return False
+
+    def add_client(self, client):
+        """
+        Gives a new server client an id, lets the handlers process its messages and adds it to the internal client
+        list.
+
+        :param client: The new server client
+        """
+        # all messages go to the handlers
+        client.dispatcher = self.dispatcher
+
+        # register (gives it a new id)
+        self.server_clients.add(client)
+        logger.info('new client with id %d', client.client_id)
+
+    def drop_client(self, client):
+        """
+        Closes the connection to a server client and forgets about it (its subscriptions too). Dropping a client that
+        is already dropped does nothing.
+
+        :param client: The server client
+        """
+        if client not in self.server_clients:
+            return
+        logger.info('drop client with id %d', client.client_id)
+        self.server_clients.remove(client)
+        for subscribers in self.subscribers.values():
+            subscribers.discard(client)
+        self._rate_limiters.pop(client, None)
+        self.dropped_metrics.merge(client.metrics)
+
+        # cancel the jobs nobody waits for anymore (if they have not started yet)
+        for future, waiting in list(self._waiting.items()):
+            waiting[:] = [entry for entry in waiting if entry[0] is not client]
+            if not waiting:
+                del self._waiting[future]
+                future.cancel()
+
+        client.abort()
+
+    def _admit(self, client, channel: constants.C, action: constants.M):
+        """
+        Admission of letters by the dispatcher, the rate limits of the clients. Not intended for outside use.
+
+        :return: True if the letter is within the rate limit of the client and channel
+        """
+        limit = RATE_LIMITS.get(channel)
+        if limit is None:
+            return True
+        limiters = self._rate_limiters.setdefault(client, {})
+        limiter = limiters.get(channel)
+        if limiter is None:
+            limiter = limiters[channel] = utils.TokenBucket(*limit)
+        if limiter.take():
+            return True
+        client.metrics.count(('rate_limited', channel, action))
+        return False
+
+    def _slow_handler(self, client, channel: constants.C, action: constants.M, seconds):
+        """
+        A handler took longer than switches.SERVER_SLOW_THRESHOLD. Not intended for outside use.
+        """
+        logger.warning('slow handler %s/%s for client with id %d took %.3fs', channel.name, action.name,
+                       client.client_id, seconds)
+        client.metrics.count(('slow_handler', channel, action))
+
+    def observe_lag(self, lag):
+        """
+        Records the lag of the event loop (how much later than scheduled a timer was called). A lag longer than
+        switches.SERVER_SLOW_THRESHOLD is logged together with the slowest handler called meanwhile, the most likely
+        cause.
+
+        :param lag: Seconds
+        """
+        self.loop_lag.observe(lag)
+        slowest = self.dispatcher.take_slowest()
+        if not 0 < switches.SERVER_SLOW_THRESHOLD < lag:
+            return
+        if slowest is None:
+            logger.warning('event loop blocked for %.3fs', lag)
+        else:
+            seconds, client, channel, action = slowest
+            logger.warning('event loop blocked for %.3fs, slowest handler meanwhile %s/%s for client with id %d took '
+                           '%.3fs', lag, channel.name, action.name, client.client_id, seconds)
+
+    def metrics(self):
+        """
+        Network metrics of all server clients, for each client and in total.
+
+        :return: Dictionary with keys 'total' and 'clients' (client id -> metrics), see Metrics.snapshot(), as well as
+            'handlers' (histograms of the handlers) and 'loop_lag' (summary of the lag of the event loop)
+        """
+        total = metrics.Metrics()
+        total.merge(self.dropped_metrics)
+        clients = {}
+        for client in self.server_clients:
+            total.merge(client.metrics)
+            clients[client.client_id] = client.metrics_snapshot()
+        snapshot = total.snapshot()
+        snapshot['number_clients'] = len(self.server_clients)
+        snapshot['number_sessions'] = len(self.session_router)
+        return {'total': snapshot, 'clients': clients, 'handlers': self.dispatcher.metrics.snapshot()['histograms'],
+                'loop_lag': self.loop_lag.summary()}
+
+    def log_metrics(self):
+        """
+        Logs a summary of the network metrics: the message types with most messages and bytes and the timings.
+        """
+        total = metrics.Metrics()
+        total.merge(self.dropped_metrics)
+        for client in self.server_clients:
+            total.merge(client.metrics)
+        for name in ('messages_in', 'bytes_in', 'messages_out', 'bytes_out', 'rate_limited'):
+            top = ', '.join('{}/{}={}'.format(key[1].name, key[2].name, value)
+                            for key, value in total.top_counters(name, 5))
+            logger.info('network metrics %s: %s', name, top)
+        for key in ('serialize', 'compress', 'decompress', 'parse', 'round_trip'):
+            if key in total.histograms:
+                logger.info('network metrics %s: %s', key, total.histograms[key].summary())
+        logger.info('network metrics dropped messages: %d, write queue overflows: %d',
+                    total.counters['dropped_messages'], total.counters['write_queue_overflows'])
+        busiest = ', '.join('{}={:.3f}s/{}'.format(action.name, histogram.total, histogram.count)
+                            for _, action, histogram in self.dispatcher.busiest_handlers())
+        logger.info('busiest handlers (time/calls): %s', busiest)
+        logger.info('event loop lag: %s', self.loop_lag.summary())
+
+    def preview_job(self, scenario_file_name):
+        """
+        The preview of a scenario from the cache (as long as the file has not been modified since) or else a job of
+        the worker pool assembling it (then cached). Requests of the same preview share the job.
+
+        :param scenario_file_name: The scenario file name
+        :return: A concurrent.futures.Future with the preview (see scenario_preview()) and its estimated size, must
+            not be modified
+        """
+        key = (scenario_file_name, os.path.getmtime(scenario_file_name))
+        entry = self.preview_cache.get(key)
+        if entry is not None:
+            future = concurrent.futures.Future()
+            future.set_result(entry)
+            return future
+        future = self._preview_jobs.get(key)
+        if future is None:
+            future = self._preview_jobs[key] = self.workers.submit(sized_scenario_preview, scenario_file_name)
+            future.add_done_callback(lambda _: self.call_soon(partial(self._preview_done, key, future)))
+        return future
+
+    def _preview_done(self, key, future):
+        """
+        A job assembling a preview is done, caches the preview (its size was estimated by the job, not here in the
+        thread of the server). Not intended for outside use.
+        """
+        if self._preview_jobs.get(key) is future:
+            del self._preview_jobs[key]
+        if not future.cancelled() and future.exception() is None:
+            entry = future.result()
+            self.preview_cache.put(key, entry, entry[1])
+
+    def prewarm_previews(self):
+        """
+        Assembles the previews of all core scenarios in the worker pool, so the first requests are already answered
+        from the cache.
+        """
+        future = self.workers.submit(scenario_core_titles)
+        future.add_done_callback(lambda _: self.call_soon(partial(self._prewarm_previews, future)))
+
+    def _prewarm_previews(self, future):
+        """
+        The core scenarios are known, starts assembling their previews. Not intended for outside use.
+        """
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error('prewarming the scenario previews failed', exc_info=error)
+            return
+        for _, scenario_file_name in future.result():
+            try:
+                self.preview_job(scenario_file_name)
+            except RuntimeError:
+                # the worker pool has been shut down in the meantime
+                return
+
+    def subscribe(self, topic, client):
+        """
+        Subscribes a client to a topic, broadcasts to this topic will reach the client.
+
+        :param topic: Any hashable (e.g. a channel)
+        :param client: The server client
+        """
+        self.subscribers.setdefault(topic, set()).add(client)
+
+    def unsubscribe(self, topic, client):
+        """
+        Removes a client from the subscribers of a topic (if it was subscribed).
+
+        :param topic: Any hashable (e.g. a channel)
+        :param client: The server client
+        """
+        self.subscribers.get(topic, set()).discard(client)
+
+    def broadcast(self, topic, channel: constants.C, action: constants.M, content=None):
+        """
+        Sends a letter to all subscribers of a topic. The letter is serialized and compressed only once for each
+        codec in use and then the same frame is written to all (connected) clients.
+
+        :param topic: Any hashable (e.g. a channel)
+        :param channel: Channel id
+        :param action: action id
+        :param content: Message content
+        """
+        frames = {}
+        # a client with a full write queue might be dropped meanwhile
+        for client in list(self.subscribers.get(topic, ())):
+            if not client.is_connected():
+                continue
+            frame = frames.get(client.codec)
+            if frame is None:
+                frame = frames[client.codec] = client.pack_letter(channel, action, content)
+            client.write_frame(frame)
+            client.metrics.count(('messages_out', channel, action))
+            client.metrics.count(('bytes_out', channel, action), len(frame))
+
+    def _general_name(self, client, channel: constants.C, action: constants.M, content):
+        """
+        A client tells its name. Not intended for outside use.
+        """
+        self.server_clients.rename(client, content)
+
+    def _chat_subscribe(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Adds a client to the clients to be notified of new chat messages. Not intended for outside use.
+        """
+        self.subscribe(constants.C.CHAT, client)
+
+    def _chat_unsubscribe(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Removes a client from the clients to be notified of new chat messages. Not intended for outside use.
+        """
+        self.unsubscribe(constants.C.CHAT, client)
+
+    def _chat_log(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Sends a page of the chat history. The content can be a dictionary with the number of messages ('number', at
+        most CHAT_LOG_PAGE_SIZE) and the chat messages must be older than message 'before' (for the next page).
+        Otherwise the most recent page is sent.
+
+        The reply is a dictionary with the formatted 'messages' (oldest first) and 'before' for the next (older)
+        page or None if there are no older messages. Not intended for outside use.
+        """
+        options = content if isinstance(content, dict) else {}
+        number = options.get('number', CHAT_LOG_PAGE_SIZE)
+        if type(number) is not int or not 0 < number <= CHAT_LOG_PAGE_SIZE:
+            number = CHAT_LOG_PAGE_SIZE
+        before = options.get('before')
+
+        # the numbers of the records in the history are consecutive
+        end = len(self.chat_history)
+        if type(before) is int and self.chat_history:
+            end = max(0, min(end, before - self.chat_history[0].number))
+        start = max(0, end - number)
+        page = list(itertools.islice(self.chat_history, start, end))
+
+        reply = {'messages': [format_chat_record(record) for record in page],
+                 'before': page[0].number if start > 0 else None}
+        client.send(channel, action, reply)
+
+    def _chat_message(self, client, channel: constants.C, action: constants.M, content):
+        """
+        New chat message from a client, log and distribute. Not intended for outside use.
+        """
+        if not isinstance(content, str):
+            return
+
+        # append to chat history (forgets the oldest message if full)
+        self._chat_counter += 1
+        record = ChatRecord(self._chat_counter, time.time(), client.client_id, client.name, content)
+        self.chat_history.append(record)
+
+        # distribute chat message
+        self.broadcast(constants.C.CHAT, constants.C.CHAT, constants.M.CHAT_MESSAGE, format_chat_record(record))
+
+    def _system_shutdown(self, client, channel: constants.C, action: constants.M, content):
+        """
+        A local client shuts its local server down, remote clients cannot. Not intended for outside use.
+        """
+        if not client.is_local():
+            logger.warning('refused shutdown requested by remote client with id %d', client.client_id)
+            return
+        logger.info('server manager shuts down')
+        # TODO disconnect all server clients, clean up, ...
+        self.stop()
+
+    def _system_monitor_update(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Sends the state of the server for the system monitor. Not intended for outside use.
+        """
+        update = {
+            'number_connected_clients': len(self.server_clients)
+        }
+        client.send(channel, action, update)
+
+    def _system_metrics(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Sends all network metrics. Not intended for outside use.
+        """
+        client.send(channel, action, self.metrics())
+
+    def _lobby_scenario_core_list(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Sends the list of core scenarios (titles and file names), read in the worker pool. Not intended for outside
+        use.
+        """
+        request_id = client.current_request
+        self.wait_for(client, self.workers.submit(scenario_core_titles),
+                      lambda titles: client.send(channel, action, titles, reply_to=request_id))
+
+    def _lobby_scenario_preview(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Sends the preview of a scenario (can be large), assembled in the worker pool if not cached. Not intended for
+        outside use.
+        """
+        if not isinstance(content, str):
+            return
+        # only core scenarios, the file name comes from the client
+        folder = os.path.realpath(constants.CORE_SCENARIO_FOLDER)
+        if os.path.dirname(os.path.realpath(content)) != folder or not content.endswith('.scenario'):
+            logger.warning('client with id %d requested preview of %s outside of the core scenarios',
+                           client.client_id, content)
+            return
+        try:
+            future = self.preview_job(content)
+        except OSError:
+            logger.warning('client with id %d requested preview of unknown scenario %s', client.client_id, content)
+            return
+        request_id = client.current_request
+        self.wait_for(client, future, lambda entry: client.send_chunked(channel, action, entry[0],
+                                                                        reply_to=request_id))
+
+    def _lobby_connected_clients(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Sends the names of the connected clients. Not intended for outside use.
+        """
+        client.send(channel, action, [c.name for c in self.server_clients])
+
+    def _lobby_session_create(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Starts a game session (with a title) in its own worker process. Once it is ready, the client is redirected to
+        it (see Session.redirect()), None is sent if it was refused or failed. Not intended for outside use.
+        """
+        if not isinstance(content, str):
+            return
+        request_id = client.current_request
+        redirect = partial(self._redirect, client, channel, action, request_id)
+        if self.session_router.create(content, redirect) is None:
+            redirect(None)
+
+    def _lobby_session_list(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Sends the descriptions of the game sessions. Not intended for outside use.
+        """
+        client.send(channel, action, self.session_router.descriptions(), reply_to=client.current_request)
+
+    def _lobby_session_join(self, client, channel: constants.C, action: constants.M, content):
+        """
+        Redirects the client to a game session (by id) or sends None if there is no such session. Not intended for
+        outside use.
+        """
+        session = self.session_router.get(content) if isinstance(content, int) else None
+        self._redirect(client, channel, action, client.current_request, session)
+
+    def _redirect(self, client, channel: constants.C, action: constants.M, request_id, session):
+        """
+        Sends where a session is (or None) unless the client has been dropped meanwhile. Not intended for outside
+        use.
+        """
+        if client not in self.server_clients:
+            return
+        client.send(channel, action, session.redirect() if session is not None else None, reply_to=request_id)
+
+
+class ClientRegistry:
+    """
+    The server clients indexed by id and by name. Ids are consecutive numbers (never reused). Iterating gives the
+    clients in the order they were added.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self._last_id = 0
+
+    def add(self, client):
+        """
+        Gives a client a new id and adds it.
+
+        :param client: The server client
+        """
+        self._last_id += 1
+        client.client_id = self._last_id
+        self.by_id[client.client_id] = client
+        self.by_name.setdefault(client.name, set()).add(client)
+
+    def remove(self, client):
+        """
+        Removes a client.
+
+        :param client: The server client
+        """
+        del self.by_id[client.client_id]
+        self._discard_name(client)
+
+    def rename(self, client, name):
+        """
+        Changes the name of a client.
+
+        :param client: The server client
+        :param name: The new name
+        """
+        self._discard_name(client)
+        client.name = name
+        self.by_name.setdefault(name, set()).add(client)
+
+    def get(self, client_id):
+        """
+        :param client_id: The id of a client
+        :return: The server client or None
+        """
+        return self.by_id.get(client_id)
+
+    def with_name(self, name):
+        """
+        :param name: A name
+        :return: Set of server clients with this name (do not modify)
+        """
+        return self.by_name.get(name, set())
+
+    def _discard_name(self, client):
+        """
+        Removes a client from the index of names. Not intended for outside use.
+        """
+        clients = self.by_name.get(client.name)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.by_name[client.name]
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, client):
+        return self.by_id.get(client.client_id) is client
+
+
+def format_chat_record(record):
+    """
+    Formats a chat message for display.
+
+    :param record: The chat message (ChatRecord)
+    :return: Time, name and text
+    """
+    return '{}: {} - {}'.format(datetime.fromtimestamp(record.time).strftime('%H:%M:%S'), record.name, record.text)
+
+
+def create_worker_pool():
+    """
+    A pool of threads or of processes (see switches.SERVER_WORKER_POOL) for the slow requests of the server. Processes
+    do not compete with the server for the global interpreter lock but results are pickled.
+
+    :return: A concurrent.futures.Executor
+    """
+    if switches.SERVER_WORKER_POOL == 'process':
+        # forking the (multithreaded) server is unsafe
+        return concurrent.futures.ProcessPoolExecutor(switches.SERVER_WORKERS,
+                                                      mp_context=multiprocessing.get_context('spawn'))
+    return concurrent.futures.ThreadPoolExecutor(switches.SERVER_WORKERS, thread_name_prefix='server worker')
+
+
+def scenario_core_titles():
+    """
+    A server client received a message on the constants.C.SCENARIO_CORE_TITLES channel. Return all available core
+    scenario titles and file names.
+    """
+    # get all core scenario files
+    scenario_files = [x for x in os.listdir(constants.CORE_SCENARIO_FOLDER) if x.endswith('.scenario')]
+
+    # join the path
+    scenario_files = [os.path.join(constants.CORE_SCENARIO_FOLDER, x) for x in scenario_files]
+
+    # read scenario titles
+    scenario_titles = []
+    for scenario_file in scenario_files:
+        reader = utils.ZipArchiveReader(scenario_file)
+        properties = reader.read_as_yaml(constants.SCENARIO_FILE_PROPERTIES)
+        scenario_titles.append(properties[constants.ScenarioProperty.TITLE])
+
+    # zip files and titles together
+    scenarios = zip(scenario_titles, scenario_files)
+
+    # sort them
+    scenarios = sorted(scenarios)  # default sort order is by first element anyway
+
+    return scenarios
+
+
+def sized_scenario_preview(scenario_file_name):
+    """
+    Assembles the preview of a scenario and estimates its size (for the cache of previews), e.g. in the worker pool.
+
+    :param scenario_file_name: The scenario file name
+    :return: The preview (see scenario_preview()) and its estimated size
+    """
+    preview = scenario_preview(scenario_file_name)
+    return preview, utils.estimate_size(preview)
+
+
+def scenario_preview(scenario_file_name):
+    """
+    A client got a message on the constants.C.SCENARIO_PREVIEW channel. In the message should be a scenario file name
+    (key = 'scenario'). Assemble a preview and send it back.
+    """
+    t0 = time.perf_counter()
+
+    # TODO existing? can be loaded?
+    scenario = Scenario.from_file(scenario_file_name)
+    logger.info('reading of the file took {}s'.format(time.perf_counter() - t0))
+
+    preview = {'scenario': scenario_file_name}
+
+    # some scenario properties should be copied
+    scenario_copy_keys = [constants.ScenarioProperty.MAP_COLUMNS,
+                          constants.ScenarioProperty.MAP_ROWS,
+                          constants.ScenarioProperty.TITLE,
+                          constants.ScenarioProperty.DESCRIPTION]
+    for key in scenario_copy_keys:
+        preview[key] = scenario[key]
+
+    # some nations properties should be copied
+    nations = {}
+    nation_copy_keys = [constants.NationProperty.COLOR,
+                        constants.NationProperty.NAME,
+                        constants.NationProperty.DESCRIPTION]
+    for nation in scenario.nations():
+        nations[nation] = {}
+        for key in nation_copy_keys:
+            nations[nation][key] = scenario.nation_property(nation, key)
+    preview['nations'] = nations
+
+    # assemble a nations map (-1 means no nation)
+    columns = scenario[constants.ScenarioProperty.MAP_COLUMNS]
+    rows = scenario[constants.ScenarioProperty.MAP_ROWS]
+    nations_map = [-1] * (columns * rows)
+    for nation_id in scenario.nations():
+        provinces = scenario.provinces_of_nation(nation_id)
+        for province in provinces:
+            tiles = scenario.province_property(province, constants.ProvinceProperty.TILES)
+            for column, row in tiles:
+                nations_map[row * columns + column] = nation_id
+    preview['map'] = nations_map
+
+    logger.info('generating preview took {}s'.format(time.perf_counter() - t0))
+
+    return preview
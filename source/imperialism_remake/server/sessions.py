@@ -0,0 +1,195 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Game sessions in worker processes. The server (the router) keeps the lobby and starts each game session as a worker
+process with its own asyncio server (see async_server.SessionServerManager) on a port chosen by the system. Clients
+are redirected: they get the port of the session from the lobby and connect to it directly, the traffic of a game
+does not pass the router. Concurrent games run on different cores and a busy lobby does not slow them down.
+
+    router                                  worker process of session 1
+      LOBBY_SESSION_CREATE  ->  start  ->     listens on port p, reports ('ready', p)
+      reply {'session': 1, 'port': p}  <-------'
+      client connects to port p  ----------->  game (chat, ...)
+                                               reports ('clients', n), ends when idle
+"""
+
+from functools import partial
+import itertools
+import logging
+import multiprocessing
+import threading
+
+from imperialism_remake.base import switches
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    A game session (worker process) as seen by the router.
+    """
+
+    def __init__(self, session_id, title, process):
+        self.session_id = session_id
+        self.title = title
+        self.process = process
+        # thread reading the reports of the worker
+        self.reader = None
+        # unknown until the worker reported it
+        self.port = None
+        self.number_clients = 0
+        # callables waiting for the session to be ready (called with the session or None if it failed)
+        self.waiting = []
+
+    def redirect(self):
+        """
+        Where clients find the session (on the same host as the router).
+
+        :return: Dictionary with session id and port
+        """
+        return {'session': self.session_id, 'port': self.port}
+
+    def description(self):
+        """
+        :return: Dictionary with session id, title, port and number of clients
+        """
+        return {'session': self.session_id, 'title': self.title, 'port': self.port, 'clients': self.number_clients}
+
+
+class SessionRouter:
+    """
+    Starts, tracks and stops the worker processes of the game sessions of a server. The workers report over a pipe
+    which is read by a thread per session, the reports are processed in the thread of the server (call_soon of the
+    server services). Workers are spawned, not forked (the server is multithreaded), and get the switches of the
+    router.
+    """
+
+    def __init__(self, call_soon, scope='local'):
+        """
+        :param call_soon: Calls a callable soon in the thread of the server (see ServerServices.call_soon())
+        :param scope: The scope (local/any) the sessions listen on
+        """
+        self.call_soon = call_soon
+        self.scope = scope
+        self.sessions = {}
+        self._counter = itertools.count(1)
+        self._context = multiprocessing.get_context('spawn')
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, title, callback):
+        """
+        Starts a new session unless there are already switches.SERVER_MAX_SESSIONS.
+
+        :param title: Title of the session
+        :param callback: Called with the session once it is ready to accept clients or with None if it failed
+        :return: The new session or None if refused
+        """
+        if 0 < switches.SERVER_MAX_SESSIONS <= len(self.sessions):
+            logger.warning('refused new session, already %d sessions', len(self.sessions))
+            return None
+        # imported here because the asyncio server imports the services which use this module
+        from imperialism_remake.server import async_server
+
+        session_id = next(self._counter)
+        receiving, sending = self._context.Pipe(duplex=False)
+        switch_values = {name: getattr(switches, name) for name in dir(switches) if name.isupper()}
+        process = self._context.Process(target=async_server.run_session, name='session {}'.format(session_id),
+                                        args=(sending, session_id, self.scope, switch_values,
+                                              logging.getLogger().getEffectiveLevel()))
+        session = Session(session_id, title, process)
+        session.waiting.append(callback)
+        process.start()
+        # only the worker writes, we see the end of the pipe when it exits
+        sending.close()
+        self.sessions[session_id] = session
+
+        session.reader = threading.Thread(target=self._read_reports, args=(session, receiving), daemon=True)
+        session.reader.start()
+        logger.info('session %d (%s) starts in process %d', session_id, title, process.pid)
+        return session
+
+    def get(self, session_id):
+        """
+        :param session_id: The id of a session
+        :return: The session if it is ready or None
+        """
+        session = self.sessions.get(session_id)
+        if session is None or session.port is None:
+            return None
+        return session
+
+    def descriptions(self):
+        """
+        :return: List of the descriptions (see Session.description()) of all ready sessions
+        """
+        return [session.description() for session in self.sessions.values() if session.port is not None]
+
+    def stop(self):
+        """
+        Stops all sessions and waits until their processes have ended.
+        """
+        sessions = list(self.sessions.values())
+        for session in sessions:
+            session.process.terminate()
+        for session in sessions:
+            session.process.join(5)
+            if session.process.is_alive():
+                logger.warning('session %d did not end, killed', session.session_id)
+                session.process.kill()
+                session.process.join()
+            session.reader.join()
+
+    def _read_reports(self, session, connection):
+        """
+        Reads the reports of a worker until it exits (runs in its own thread). Not intended for outside use.
+        """
+        with connection:
+            while True:
+                try:
+                    report = connection.recv()
+                except (EOFError, OSError):
+                    break
+                self.call_soon(partial(self._report, session, *report))
+        self.call_soon(partial(self._ended, session))
+
+    def _report(self, session, kind, value):
+        """
+        Processes a report of a worker: 'ready' with the port or 'clients' with the number of clients. Not intended
+        for outside use.
+        """
+        if kind == 'ready':
+            session.port = value
+            logger.info('session %d listens on port %d', session.session_id, value)
+            waiting, session.waiting = session.waiting, []
+            for callback in waiting:
+                callback(session)
+        elif kind == 'clients':
+            session.number_clients = value
+
+    def _ended(self, session):
+        """
+        The worker of a session has exited. Not intended for outside use.
+        """
+        if self.sessions.pop(session.session_id, None) is None:
+            return
+        session.process.join()
+        logger.info('session %d ended (exit code %s)', session.session_id, session.process.exitcode)
+        waiting, session.waiting = session.waiting, []
+        for callback in waiting:
+            callback(None)
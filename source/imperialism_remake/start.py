@@ -27,6 +27,7 @@ import multiprocessing
 import os
 import sys
 import threading
+import time
 
 APPLICATION_NAME = 'imperialism_remake'
 
@@ -38,6 +39,8 @@ def get_arguments():
     parser = argparse.ArgumentParser(prog=APPLICATION_NAME)
     parser.add_argument('--debug', dest='debug', action='store_true',
                         help='enable detailed debug logging')
+    parser.add_argument('--server-thread', dest='server_thread', action='store_true',
+                        help='run the local server in a thread instead of its own process (single player only)')
     return parser.parse_args()
 
 
@@ -187,18 +190,29 @@ def main():
     if not tools.get_option(constants.Option.MAINWINDOW_FULLSCREEN_SUPPORTED):
         tools.set_option(constants.Option.MAINWINDOW_FULLSCREEN, False)
 
-    # start server
-    from imperialism_remake.server.server import ServerProcess
-
-    server_process = ServerProcess(log_queue, log_formatter, log_level)
-    server_process.start()
-
-    # start client, we will return when the client finishes
+    # start server (in its own process or in a thread), the local client talks to it over a pipe
+    server_connection, client_connection = multiprocessing.Pipe()
+    launch_time = time.time()
+    if args.server_thread:
+        from imperialism_remake.server.server import ServerThread
+        server = ServerThread(client_connection, launch_time)
+    else:
+        from imperialism_remake.server.server import ServerProcess
+        server = ServerProcess(log_queue, log_formatter, log_level, client_connection, launch_time)
+        server.start()
+
+    # start client (and the server thread), we will return when the client finishes
     from imperialism_remake.client.client import start_client
-    start_client()
-
-    # wait for server process to stop
-    server_process.join()
+    start_client(server_connection, server if args.server_thread else None)
+
+    # wait for server to stop
+    if args.server_thread:
+        # the client might have quit without telling the server
+        if not server.wait(5000):
+            server.quit()
+            server.wait()
+    else:
+        server.join()
 
     # save options
     tools.save_options(options_file)
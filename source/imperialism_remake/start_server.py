@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Starts a dedicated server only (headless, no client, no QApplication and no display needed), e.g. for hosting
+lobbies. Stops on SIGINT/SIGTERM or when a local client requests a shutdown.
+
+    start_server.py [--scope any] [--port 42932] [--max-clients 100] [--max-sessions 8] [--log-file server.log]
+
+Game sessions run in worker processes of their own (see server/sessions.py), they log to the console only.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+APPLICATION_NAME = 'imperialism_remake_server'
+
+
+def get_arguments():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser(prog=APPLICATION_NAME, description='Runs a dedicated server.')
+    parser.add_argument('--scope', choices=('local', 'any'), default='local',
+                        help='listen on the loopback interface only (local) or on all interfaces (any)')
+    parser.add_argument('--port', type=int, default=None, help='port number (default: the port of the game)')
+    parser.add_argument('--max-clients', type=int, default=0, help='maximal number of clients (0 means no limit)')
+    parser.add_argument('--max-sessions', type=int, default=8,
+                        help='maximal number of game sessions, each in its own process (0 means no limit)')
+    parser.add_argument('--workers', type=int, default=2, help='size of the worker pool for slow requests')
+    parser.add_argument('--worker-pool', choices=('thread', 'process'), default='thread',
+                        help='kind of the worker pool')
+    parser.add_argument('--backend', choices=('asyncio', 'qt'), default='asyncio',
+                        help='event loop and networking of the server')
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='INFO',
+                        help='minimal level of logged messages')
+    parser.add_argument('--log-file', default=None, help='also write log messages to this file (appending)')
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help='seconds between logging the network metrics (0 means never)')
+    return parser.parse_args()
+
+
+def configure_logger(log_level, log_file):
+    """
+    Logs to the console and optionally to a file.
+
+    :param log_level: Name of the minimal level
+    :param log_file: File name or None
+    :return: The root logger
+    """
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_console_handler = logging.StreamHandler()
+    log_console_handler.setFormatter(log_formatter)
+    logger.addHandler(log_console_handler)
+    if log_file is not None:
+        log_file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        log_file_handler.setFormatter(log_formatter)
+        logger.addHandler(log_file_handler)
+        logger.info('writing log messages to %s', log_file)
+    return logger
+
+
+def run_asyncio_server(port, scope):
+    """
+    Serves with the asyncio server until stopped.
+    """
+    from imperialism_remake.server import async_server
+
+    server_manager = async_server.AsyncServerManager()
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, server_manager.stop)
+            except NotImplementedError:
+                # not on Windows, Ctrl+C raises KeyboardInterrupt there
+                pass
+        await server_manager.serve(port, scope)
+
+    asyncio.run(serve())
+
+
+def run_qt_server(port, scope):
+    """
+    Serves with the Qt server (in a QCoreApplication) until stopped.
+    """
+    from PyQt5 import QtCore
+    from imperialism_remake.lib import qt
+    from imperialism_remake.server import server
+
+    qt.fix_pyqt5_exception_eating()
+    app = QtCore.QCoreApplication([])
+    server_manager = server.ServerManager()
+    server_manager.shutdown.connect(app.quit)
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *args: server_manager.stop())
+
+    # Python signal handlers only run when the interpreter has control, give it control regularly
+    signal_timer = QtCore.QTimer()
+    signal_timer.timeout.connect(lambda: None)
+    signal_timer.start(500)
+
+    server_manager.start(port, scope)
+    app.exec_()
+    for client in list(server_manager.server_clients):
+        server_manager.drop_client(client)
+    server_manager.stop_workers()
+
+
+def main():
+    """
+    Main entry point. Called from the script generated in setup.py and called when running this module with python.
+    """
+    args = get_arguments()
+
+    # add the parent directory of the package directory to Python's search path (see start.py)
+    source_directory = os.path.realpath(os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir))
+    if source_directory not in sys.path:
+        sys.path.insert(0, source_directory)
+
+    from imperialism_remake.base import constants, switches
+
+    # the switches must be set before the server is created
+    switches.SERVER_MAX_CLIENTS = args.max_clients
+    switches.SERVER_MAX_SESSIONS = args.max_sessions
+    switches.SERVER_WORKERS = args.workers
+    switches.SERVER_WORKER_POOL = args.worker_pool
+    switches.NETWORK_METRICS_LOG_INTERVAL = args.metrics_interval
+
+    logger = configure_logger(args.log_level, args.log_file)
+    port = args.port if args.port is not None else constants.NETWORK_PORT
+    logger.info('dedicated server (%s) on scope=%s port=%d, at most %s clients, %d %s workers', args.backend,
+                args.scope, port, args.max_clients or 'any number of', args.workers, args.worker_pool)
+
+    if args.backend == 'asyncio':
+        run_asyncio_server(port, args.scope)
+    else:
+        run_qt_server(port, args.scope)
+    logger.info('dedicated server stopped')
+
+
+if __name__ == '__main__':
+    main()
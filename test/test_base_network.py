@@ -0,0 +1,54 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests base/network
+"""
+
+import unittest
+from unittest import mock
+from PyQt5 import QtNetwork
+from imperialism_remake.base import constants, network
+
+
+class TestRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = network.NetworkClient()
+        self.client.socket = mock.Mock()
+        self.client.socket.state.return_value = QtNetwork.QAbstractSocket.ConnectedState
+        self.client.socket.bytesToWrite.return_value = 0
+
+    def test_pending_until_answered(self):
+        request = self.client.request(constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS)
+        self.assertTrue(request.is_pending())
+        request.cancel()
+        self.assertEqual(self.client.requests, {})
+
+    def test_failed_or_dropped_send(self):
+        # the write queue is full, the letter is dropped and nobody waits for a reply
+        self.client.limit_write_queue(100, 'drop')
+        self.client.socket.bytesToWrite.return_value = 1000
+        request = self.client.request(constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS)
+        self.assertFalse(request.is_pending())
+        # not connected
+        self.client.socket.state.return_value = QtNetwork.QAbstractSocket.UnconnectedState
+        self.assertRaises(RuntimeError, self.client.request, constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS)
+        self.assertEqual(self.client.requests, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
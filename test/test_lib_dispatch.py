@@ -0,0 +1,57 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests lib/dispatch
+"""
+
+import time
+import unittest
+from imperialism_remake.base import constants
+from imperialism_remake.lib import dispatch
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_dispatch(self):
+        dispatcher = dispatch.Dispatcher()
+        calls = []
+        dispatcher.register(constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS, lambda *args: calls.append(args))
+        self.assertRaises(RuntimeError, dispatcher.register, constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS,
+                          print)
+        self.assertTrue(dispatcher.dispatch(None, constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS, 1))
+        self.assertFalse(dispatcher.dispatch(None, constants.C.LOBBY, constants.M.LOBBY_SCENARIO_PREVIEW, 2))
+        self.assertEqual(calls, [(None, constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS, 1)])
+        (channel, action, histogram), = dispatcher.busiest_handlers()
+        self.assertEqual((action, histogram.count), (constants.M.LOBBY_CONNECTED_CLIENTS, 1))
+
+    def test_slow_handlers(self):
+        dispatcher = dispatch.Dispatcher()
+        slow = []
+        dispatcher.slow_threshold = 0.01
+        dispatcher.slow_handler = lambda *args: slow.append(args[:3])
+        dispatcher.register(constants.C.CHAT, constants.M.CHAT_LOG, lambda *args: time.sleep(0.02))
+        dispatcher.register(constants.C.CHAT, constants.M.CHAT_MESSAGE, lambda *args: None)
+        dispatcher.dispatch('a', constants.C.CHAT, constants.M.CHAT_MESSAGE, None)
+        dispatcher.dispatch('b', constants.C.CHAT, constants.M.CHAT_LOG, None)
+        dispatcher.dispatch('c', constants.C.CHAT, constants.M.CHAT_MESSAGE, None)
+        self.assertEqual(slow, [('b', constants.C.CHAT, constants.M.CHAT_LOG)])
+        self.assertEqual(dispatcher.take_slowest()[1:], ('b', constants.C.CHAT, constants.M.CHAT_LOG))
+        self.assertIsNone(dispatcher.take_slowest())
+
+
+if __name__ == '__main__':
+    unittest.main()
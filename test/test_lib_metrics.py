@@ -0,0 +1,56 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests lib/metrics
+"""
+
+import unittest
+from imperialism_remake.lib import metrics
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = metrics.Histogram(resolution=1)
+        for value in range(1, 101):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.mean(), 50.5)
+        self.assertEqual((histogram.minimum, histogram.maximum), (1, 100))
+        # estimates are upper bounds of the buckets (powers of two)
+        self.assertEqual(histogram.percentile(0.5), 64)
+        self.assertEqual(histogram.percentile(0.99), 100)
+
+    def test_empty(self):
+        self.assertIsNone(metrics.Histogram().percentile(0.5))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_merge(self):
+        a, b = metrics.Metrics(), metrics.Metrics()
+        a.count(('messages_in', 'x'))
+        b.count(('messages_in', 'x'), 2)
+        b.count(('messages_in', 'y'))
+        b.observe('parse', 0.001)
+        a.merge(b)
+        self.assertEqual(a.top_counters('messages_in'), [(('messages_in', 'x'), 3), (('messages_in', 'y'), 1)])
+        self.assertEqual(a.snapshot()['histograms']['parse']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,436 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests lib/protocol
+"""
+
+import random
+import unittest
+from unittest import mock
+from imperialism_remake.base import constants
+from imperialism_remake.lib import protocol
+
+
+class TestBinaryCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = protocol.BinaryCodec()
+        self.codec.register_enums(constants.C, constants.M)
+
+    def test_round_trip(self):
+        value = {
+            'channel': constants.C.LOBBY,
+            'action': constants.M.LOBBY_SCENARIO_CORE_LIST,
+            'content': [None, True, False, 0, -1, 2 ** 63 - 1, -2 ** 63, 1.5, 'Zürich', b'\x00\xff', ('a', 1), {1: []}]
+        }
+        self.assertEqual(self.codec.decode(self.codec.encode(value)), value)
+
+    def test_enums_are_small(self):
+        self.assertEqual(len(self.codec.encode(constants.M.CHAT_MESSAGE)), 3)
+
+    def test_unknown_types(self):
+        self.assertRaises(TypeError, self.codec.encode, {1, 2})
+        self.assertRaises(TypeError, self.codec.encode, constants.ScenarioProperty.TITLE)
+        self.assertRaises(TypeError, self.codec.encode, 2 ** 63)
+        self.assertRaises(ValueError, self.codec.decode, b'\x05\x10a')
+        self.assertRaises(ValueError, self.codec.decode, b'\x03\x02\x00')
+
+    def test_long_varint(self):
+        # at most 10 bytes, longer ones are rejected before they are read (would take quadratic time)
+        self.assertEqual(self.codec.decode(b'\x03' + b'\xff' * 9 + b'\x01'), -2 ** 63)
+        for data in (b'\x03' + b'\xff' * 10 + b'\x01', b'\x03' + b'\x80' * 160000 + b'\x00',
+                     b'\x05' + b'\x80' * 20 + b'\x01a'):
+            self.assertRaises(ValueError, self.codec.decode, data)
+        self.assertRaises(ValueError, protocol.unpack_chunk, b'\x80' * 160000 + b'\x01\x00\x01a')
+
+    def test_yaml_fallback(self):
+        kind, body = protocol.encode_body({1, 2}, 'binary')
+        self.assertEqual(kind, protocol.KIND_YAML)
+        self.assertEqual(protocol.decode_body(kind, body), {1, 2})
+
+    def test_choose_codec(self):
+        self.assertEqual(protocol.choose_codec(['binary', 'yaml'], ['yaml', 'binary']), 'binary')
+        self.assertEqual(protocol.choose_codec(['binary', 'yaml'], ['other']), 'yaml')
+
+
+class TestLetters(unittest.TestCase):
+
+    def setUp(self):
+        protocol.binary_codec.register_enums(constants.C, constants.M)
+        self.letter = {'channel': constants.C.CHAT, 'action': constants.M.CHAT_MESSAGE, 'content': ['hi', (1, 2.5)]}
+
+    def decode(self, kind, body):
+        return protocol.decode_letter(kind, body, constants.C, constants.M)
+
+    def test_valid(self):
+        for codec in ('binary', 'yaml'):
+            self.assertEqual(self.decode(*protocol.encode_body(self.letter, codec)), self.letter)
+
+    def test_invalid_shape(self):
+        for value in ({'channel': constants.C.CHAT, 'action': constants.M.CHAT_MESSAGE},
+                      {'channel': constants.M.CHAT_MESSAGE, 'action': constants.M.CHAT_MESSAGE, 'content': None},
+                      dict(self.letter, extra=1), [self.letter]):
+            for codec in ('binary', 'yaml'):
+                self.assertRaises(ValueError, self.decode, *protocol.encode_body(value, codec))
+
+    def test_ids(self):
+        for codec in ('binary', 'yaml'):
+            for key in ('request', 'reply'):
+                letter = dict(self.letter, **{key: 7})
+                self.assertEqual(self.decode(*protocol.encode_body(letter, codec)), letter)
+            for value in (dict(self.letter, request='7'), dict(self.letter, request=7, reply=7)):
+                self.assertRaises(ValueError, self.decode, *protocol.encode_body(value, codec))
+
+    def test_pickle_only_if_allowed(self):
+        kind, body = protocol.encode_body(self.letter, 'pickle')
+        self.assertRaises(ValueError, self.decode, kind, body)
+        self.assertEqual(protocol.decode_letter(kind, body, constants.C, constants.M, allow_pickle=True), self.letter)
+
+    def test_unsafe_yaml(self):
+        body = b'!!python/object/apply:os.system ["echo unsafe"]'
+        self.assertRaises(ValueError, protocol.decode_yaml, body)
+        body = protocol.encode_yaml(dict(self.letter, content=constants.Option.LOCALCLIENT_NAME))
+        self.assertRaises(ValueError, self.decode, protocol.KIND_YAML, body)
+
+    def test_fuzz(self):
+        # random mutations of valid letters either decode to a valid letter or raise a ValueError
+        generator = random.Random(0)
+        for codec in ('binary', 'yaml'):
+            kind, body = protocol.encode_body(self.letter, codec)
+            for _ in range(500):
+                data = bytearray(body)
+                for _ in range(generator.randint(1, 4)):
+                    position = generator.randrange(len(data))
+                    operation = generator.randint(0, 2)
+                    if operation == 0:
+                        data[position] = generator.randrange(256)
+                    elif operation == 1:
+                        del data[position]
+                    else:
+                        data.insert(position, generator.randrange(256))
+                try:
+                    letter = self.decode(kind, bytes(data))
+                except ValueError:
+                    continue
+                self.assertEqual(letter.keys(), protocol.LETTER_KEYS)
+
+
+class TestFuzzFrames(unittest.TestCase):
+    """
+    Random, truncated and mutated frames (header, compressed payload and length prefix) on the receiving side.
+    """
+
+    def setUp(self):
+        protocol.binary_codec.register_enums(constants.C, constants.M)
+        self.letter = {'channel': constants.C.CHAT, 'action': constants.M.CHAT_MESSAGE, 'content': 'hi ' * 100}
+        self.generator = random.Random(0)
+        self.frames = []
+        for codec in ('binary', 'yaml'):
+            kind, body = protocol.encode_body(self.letter, codec)
+            for algorithm in protocol.CompressionPolicy.ALGORITHMS:
+                self.frames.append(protocol.pack_frame(kind, body, protocol.CompressionPolicy(algorithm=algorithm)))
+            self.frames.append(protocol.pack_frame(kind, body, None))
+
+    def mutated_frame(self):
+        """
+        :return: A random frame (without length prefix): garbage, a truncated frame or one with mutated or
+            inserted bytes
+        """
+        generator = self.generator
+        frame = bytearray(generator.choice(self.frames))
+        operation = generator.randint(0, 4)
+        if operation == 0:
+            return bytes(generator.randrange(256) for _ in range(generator.randrange(50)))
+        if operation == 1:
+            return bytes(frame[:generator.randrange(len(frame))])
+        if operation == 2:
+            frame[0] = generator.randrange(256)
+            return bytes(frame)
+        if operation == 3:
+            # a long run of continuation bytes (variable length integers)
+            position = generator.randrange(1, len(frame))
+            length = generator.randrange(10, 500)
+            frame[position:position] = bytes(generator.randrange(0x80, 256) for _ in range(length))
+            return bytes(frame)
+        for _ in range(generator.randint(1, 4)):
+            frame[generator.randrange(len(frame))] = generator.randrange(256)
+        return bytes(frame)
+
+    def test_frame_buffer(self):
+        # random bytes (also in the length prefixes) never make the buffer grow beyond a frame or raise other errors
+        buffer = protocol.FrameBuffer(max_frame_size=1000)
+        for _ in range(300):
+            if self.generator.random() < 0.5:
+                data = protocol.prefix_length(self.mutated_frame())
+            else:
+                data = bytes(self.generator.randrange(256) for _ in range(self.generator.randrange(1, 20)))
+            buffer.feed(data)
+            try:
+                for frame in buffer.frames():
+                    try:
+                        kind, body = protocol.unpack_frame(frame, max_size=1000)
+                        self.assertEqual(protocol.decode_letter(kind, body, constants.C, constants.M).keys(),
+                                         protocol.LETTER_KEYS)
+                    except ValueError:
+                        pass
+            except ValueError:
+                # the stream cannot be resynchronized
+                buffer.clear()
+            self.assertLessEqual(len(buffer), 1004)
+
+    def test_socket(self):
+        # a mutated frame followed by a valid one: the mutated frame is dropped (or is valid) and the next message
+        # still arrives, or the connection is aborted
+        from imperialism_remake.lib import network
+        socket = network.ExtendedTcpSocket()
+        socket.letter_types = (constants.C, constants.M)
+        received = []
+        socket.received.connect(received.append)
+        aborted = 0
+        with self.assertLogs('imperialism_remake.lib.network', 'WARNING'):
+            for _ in range(300):
+                socket.socket = mock.Mock()
+                received.clear()
+                data = protocol.prefix_length(self.mutated_frame()) + protocol.prefix_length(self.frames[0])
+                split = self.generator.randrange(len(data))
+                for part in (data[:split], data[split:]):
+                    socket.socket.readAll.return_value.data.return_value = part
+                    socket._receive()
+                if socket.socket.abort.called:
+                    aborted += 1
+                    self.assertEqual(len(socket._receive_buffer), 0)
+                    continue
+                self.assertIn(len(received), (1, 2))
+                self.assertEqual(received[-1], self.letter)
+                for letter in received:
+                    self.assertEqual(letter.keys(), protocol.LETTER_KEYS)
+                self.assertEqual(len(socket._receive_buffer), 0)
+        self.assertGreater(socket.metrics.counters['rejected_frames'], 0)
+        self.assertEqual(socket.metrics.counters['protocol_errors'], aborted)
+
+        # a truncated stream waits for the rest of the frame
+        socket.socket = mock.Mock()
+        received.clear()
+        socket.socket.readAll.return_value.data.return_value = protocol.prefix_length(self.frames[0])[:-1]
+        socket._receive()
+        self.assertEqual(received, [])
+        self.assertFalse(socket.socket.abort.called)
+
+
+class TestControl(unittest.TestCase):
+
+    def test_valid(self):
+        for value in ((protocol.CONTROL_HELLO, ['binary', 'unknown']), (protocol.CONTROL_HELLO_ACK, 'yaml'),
+                      (protocol.CONTROL_PING, 1.5)):
+            self.assertEqual(protocol.decode_body(protocol.KIND_CONTROL, protocol.binary_codec.encode(value)), value)
+
+    def test_malformed(self):
+        for value in (None, 1, (1,), (1, 2, 3), ('1', 2), (True, 2), (protocol.CONTROL_HELLO, 'binary'),
+                      (protocol.CONTROL_HELLO, [1]), (protocol.CONTROL_HELLO_ACK, ['yaml'])):
+            body = protocol.binary_codec.encode(value)
+            self.assertRaises(ValueError, protocol.decode_body, protocol.KIND_CONTROL, body)
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def setUp(self):
+        from imperialism_remake.lib import network
+        self.socket = network.ExtendedTcpSocket()
+        self.socket.socket = mock.Mock()
+        self.socket.socket.bytesToWrite.return_value = 0
+        self.received = []
+        self.socket.received.connect(self.received.append)
+
+    def receive_frame(self, kind, body):
+        self.socket.socket.readAll.return_value.data.return_value = protocol.prefix_length(
+            protocol.pack_frame(kind, body, None))
+        with self.assertLogs('imperialism_remake.lib.network', 'WARNING'):
+            self.socket._receive()
+
+    def acknowledge(self, codec):
+        self.receive_frame(protocol.KIND_CONTROL, protocol.binary_codec.encode((protocol.CONTROL_HELLO_ACK, codec)))
+
+    def test_accepting_side_ignores_acknowledgement(self):
+        self.acknowledge('pickle')
+        self.assertEqual(self.socket.codec, 'yaml')
+        # pickled messages are never accepted on a network socket
+        self.receive_frame(*protocol.encode_body('unpickled', 'pickle'))
+        self.assertEqual(self.received, [])
+
+    def test_connecting_side_accepts_offered_codec(self):
+        self.socket.codecs = ['yaml']
+        self.socket._send_hello()
+        for codec in ('pickle', 'binary'):
+            self.acknowledge(codec)
+            self.assertEqual(self.socket.codec, 'yaml')
+        self.socket.codecs = ['binary', 'yaml']
+        self.socket._send_hello()
+        self.socket._process_control((protocol.CONTROL_HELLO_ACK, 'binary'))
+        self.assertEqual(self.socket.codec, 'binary')
+        # only once
+        self.acknowledge('yaml')
+        self.assertEqual(self.socket.codec, 'binary')
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_threshold(self):
+        policy = protocol.CompressionPolicy(threshold=100)
+        frame = protocol.pack_frame(protocol.KIND_BINARY, b'short', policy)
+        self.assertEqual(frame, bytes((protocol.KIND_BINARY,)) + b'short')
+        self.assertEqual(protocol.unpack_frame(frame), (protocol.KIND_BINARY, b'short'))
+
+    @mock.patch.object(protocol, '_preset_dictionary', b'')
+    def test_algorithms(self):
+        body = b'lobby message ' * 50
+        protocol.set_preset_dictionary(b'lobby message')
+        for policy in (protocol.CompressionPolicy(), protocol.CompressionPolicy(algorithm='bz2', level=9),
+                       protocol.CompressionPolicy(algorithm='lzma', level=1),
+                       protocol.CompressionPolicy(use_dictionary=True)):
+            statistics = protocol.FrameStatistics()
+            frame = protocol.pack_frame(protocol.KIND_YAML, body, policy, statistics)
+            self.assertNotEqual(frame[0] >> 4, protocol.COMPRESSION_NONE)
+            self.assertEqual(protocol.unpack_frame(frame, statistics), (protocol.KIND_YAML, body))
+            self.assertLess(statistics.compression_ratio(), 0.5)
+            self.assertEqual(statistics.frames_received_compressed, 1)
+
+    def test_corrupt(self):
+        body = b'lobby message ' * 50
+        for algorithm in protocol.CompressionPolicy.ALGORITHMS:
+            frame = protocol.pack_frame(protocol.KIND_YAML, body, protocol.CompressionPolicy(algorithm=algorithm))
+            for corrupt in (frame[:1] + b'garbage' * 10, frame[:len(frame) // 2]):
+                self.assertRaises(ValueError, protocol.unpack_frame, corrupt)
+        self.assertRaises(ValueError, protocol.unpack_frame, b'')
+        self.assertRaises(ValueError, protocol.unpack_frame, bytes((0xf0 | protocol.KIND_YAML,)) + body)
+
+    def test_output_is_bounded(self):
+        # a few KB that would decompress to 10 MB
+        frame = protocol.pack_frame(protocol.KIND_BINARY, bytes(10 * 2 ** 20), protocol.CompressionPolicy(level=9))
+        self.assertLess(len(frame), 20000)
+        self.assertRaises(ValueError, protocol.unpack_frame, frame, max_size=2 ** 20)
+        self.assertEqual(len(protocol.unpack_frame(frame)[1]), 10 * 2 ** 20)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_round_trip(self):
+        entries = [(protocol.KIND_BINARY, b'abc'), (protocol.KIND_YAML, b''), (protocol.KIND_BINARY, b'x' * 300)]
+        unpacked = protocol.unpack_batch(protocol.pack_batch(entries))
+        self.assertEqual([(kind, bytes(body)) for kind, body in unpacked], entries)
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, protocol.unpack_batch, b'\x01\x05ab')
+        self.assertRaises(ValueError, protocol.unpack_batch, b'\x01\x80')
+
+
+class TestChunk(unittest.TestCase):
+
+    def test_round_trip(self):
+        transfer_id, offset, total, data = protocol.unpack_chunk(protocol.pack_chunk(7, 300, 1000, b'abc'))
+        self.assertEqual((transfer_id, offset, total, bytes(data)), (7, 300, 1000, b'abc'))
+
+    def test_exceeds_transfer(self):
+        self.assertRaises(ValueError, protocol.unpack_chunk, protocol.pack_chunk(1, 999, 1000, b'ab'))
+
+    def test_empty_transfer(self):
+        self.assertRaises(ValueError, protocol.unpack_chunk, protocol.pack_chunk(1, 0, 0, b''))
+
+
+class TestIncomingTransfers(unittest.TestCase):
+
+    def test_in_order(self):
+        transfers = protocol.IncomingTransfers()
+        self.assertEqual(transfers.add(protocol.pack_chunk(3, 0, 5, b'abc')), (3, 3, 5, None))
+        transfer_id, received, total, data = transfers.add(protocol.pack_chunk(3, 3, 5, b'de'))
+        self.assertEqual((transfer_id, received, total, bytes(data)), (3, 5, 5, b'abcde'))
+        self.assertEqual(len(transfers), 0)
+
+    def test_holes_and_repeats(self):
+        transfers = protocol.IncomingTransfers()
+        self.assertRaises(ValueError, transfers.add, protocol.pack_chunk(1, 2, 5, b'cde'))
+        for offset in (0, 4):
+            transfers.add(protocol.pack_chunk(1, 0, 5, b'ab'))
+            # a repeated or a skipping chunk drops the transfer
+            self.assertRaises(ValueError, transfers.add, protocol.pack_chunk(1, offset, 5, b'c'))
+            self.assertEqual(len(transfers), 0)
+        self.assertRaises(ValueError, transfers.add, protocol.pack_chunk(1, 0, 5, b''))
+
+    def test_limits(self):
+        transfers = protocol.IncomingTransfers(max_transfers=2, max_size=100, budget=protocol.TransferBudget(1000))
+        transfers.add(protocol.pack_chunk(1, 0, 10, b'a'))
+        self.assertRaises(ValueError, transfers.add, protocol.pack_chunk(2, 0, 101, b'a'))
+        transfers.add(protocol.pack_chunk(2, 0, 100, b'a'))
+        self.assertRaises(ValueError, transfers.add, protocol.pack_chunk(3, 0, 1, b'a'))
+        self.assertEqual(transfers.budget.used, 2)
+        transfers.clear()
+        self.assertEqual(transfers.budget.used, 0)
+        transfers.add(protocol.pack_chunk(3, 0, 100, b'a'))
+
+    def test_huge_announced_size(self):
+        # a small chunk announcing a huge transfer allocates nothing, up to the maximal frame size only what arrived
+        transfers = protocol.IncomingTransfers(budget=protocol.TransferBudget(1000))
+        self.assertRaises(ValueError, transfers.add, protocol.pack_chunk(1, 0, 2 ** 40, b'a'))
+        self.assertEqual(transfers.add(protocol.pack_chunk(2, 0, protocol.MAX_FRAME_SIZE, b'abc')),
+                         (2, 3, protocol.MAX_FRAME_SIZE, None))
+        self.assertEqual(transfers.budget.used, 3)
+
+    def test_shared_budget(self):
+        budget = protocol.TransferBudget(10)
+        first, second = protocol.IncomingTransfers(budget=budget), protocol.IncomingTransfers(budget=budget)
+        first.add(protocol.pack_chunk(1, 0, 100, b'a' * 6))
+        # the other connection cannot exceed the budget, its transfer is dropped
+        second.add(protocol.pack_chunk(1, 0, 100, b'b' * 3))
+        self.assertRaises(ValueError, second.add, protocol.pack_chunk(1, 3, 100, b'b' * 3))
+        self.assertEqual((len(second), budget.used), (0, 6))
+        first.clear()
+        second.add(protocol.pack_chunk(1, 0, 100, b'b' * 10))
+        self.assertEqual(budget.used, 10)
+
+
+class TestFrameBuffer(unittest.TestCase):
+
+    def test_partial_and_many_frames(self):
+        frames = [b'a' * n for n in (1, 1000, 3, 70000)]
+        data = b''.join(protocol.prefix_length(frame) for frame in frames)
+        buffer = protocol.FrameBuffer()
+        received = []
+        # feed in pieces of odd size
+        for start in range(0, len(data), 997):
+            buffer.feed(data[start:start + 997])
+            received.extend(bytes(frame) for frame in buffer.frames())
+        self.assertEqual(received, frames)
+        self.assertEqual(len(buffer), 0)
+
+    def test_consumer_error(self):
+        # a frame is consumed even if processing it fails while views of it are still referenced
+        buffer = protocol.FrameBuffer()
+        buffer.feed(protocol.prefix_length(b'first') + protocol.prefix_length(b'second'))
+        views = []
+        with self.assertRaises(TypeError):
+            for frame in buffer.frames():
+                views.append(frame[1:])
+                raise TypeError()
+        self.assertEqual([bytes(frame) for frame in buffer.frames()], [b'second'])
+
+    def test_frame_too_large(self):
+        buffer = protocol.FrameBuffer(max_frame_size=10)
+        buffer.feed(protocol.prefix_length(b'x' * 11))
+        self.assertRaises(ValueError, list, buffer.frames())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -37,5 +37,40 @@ class TestYAML(unittest.TestCase):
         os.remove(temp_file)
         self.assertEqual(value, copy)
 
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_forget_least_recently_used(self):
+        cache = utils.LRUCache(10, size_of=len)
+        cache.put('a', 'aaaa')
+        cache.put('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        cache.put('c', 'cccc')
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.size, 8)
+        cache.put('d', 'd' * 11)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_given_size(self):
+        cache = utils.LRUCache(10, size_of=len)
+        cache.put('a', 'aaaa', 9)
+        self.assertEqual(cache.size, 9)
+        cache.put('b', 'b', 2)
+        self.assertNotIn('a', cache)
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate_and_burst(self):
+        now = [0]
+        bucket = utils.TokenBucket(2, 3, clock=lambda: now[0])
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        now[0] = 1
+        self.assertEqual([bucket.take() for _ in range(3)], [True, True, False])
+        now[0] = 100
+        self.assertEqual(sum(bucket.take() for _ in range(10)), 3)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,168 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests server/async_server
+"""
+
+import asyncio
+import unittest
+from unittest import mock
+from imperialism_remake.base import constants, switches
+from imperialism_remake.lib import protocol
+from imperialism_remake.server import async_server
+
+
+def run_with_server(test):
+    """
+    Starts a server, connects and negotiates a client, awaits test(manager, client) and shuts everything down again.
+
+    :param test: Coroutine function taking the server manager and the client
+    :return: Whatever the test returns
+    """
+
+    async def run():
+        manager = async_server.AsyncServerManager()
+        serving = asyncio.ensure_future(manager.serve(port=0))
+        while manager.server is None:
+            await asyncio.sleep(0.01)
+        port = manager.server.sockets[0].getsockname()[1]
+
+        client = await async_server.AsyncNetworkClient.connect(port)
+        receiving = asyncio.ensure_future(client.run())
+        await client.negotiated.wait()
+        try:
+            return await test(manager, client)
+        finally:
+            client.send(constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN)
+            await asyncio.wait_for(serving, 5)
+            await asyncio.wait_for(receiving, 5)
+
+    return asyncio.run(run())
+
+
+class TestAsyncServer(unittest.TestCase):
+
+    def test_round_trip(self):
+
+        async def test(manager, client):
+            replies = asyncio.Queue()
+            client.connect_to_channel(constants.C.LOBBY, lambda *args: replies.put_nowait(args[1:]))
+            client.send(constants.C.GENERAL, constants.M.GENERAL_NAME, 'Alice')
+            client.send(constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS)
+            return client.codec, await asyncio.wait_for(replies.get(), 5)
+
+        codec, reply = run_with_server(test)
+        self.assertEqual(codec, 'binary')
+        self.assertEqual(reply, (constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS, ['Alice']))
+
+    def test_pipelined_requests(self):
+
+        async def test(manager, client):
+            # replies go to their requests, not to the receivers of the channel
+            client.connect_to_channel(constants.C.LOBBY, lambda *args: self.fail('reply went to the channel'))
+            client.send(constants.C.GENERAL, constants.M.GENERAL_NAME, 'Alice')
+            replies = await asyncio.wait_for(asyncio.gather(
+                client.request(constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE),
+                client.request(constants.C.LOBBY, constants.M.LOBBY_CONNECTED_CLIENTS),
+                client.request(constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE)), 5)
+            return replies, len(client.requests)
+
+        replies, pending = run_with_server(test)
+        self.assertEqual(replies[1], ['Alice'])
+        self.assertEqual(replies[0], replies[2])
+        self.assertEqual(pending, 0)
+
+    def test_write_queue_limit(self):
+
+        async def test(manager, client):
+            # the first message fills the queue (until the batch is sent), the second is dropped
+            client.limit_write_queue(100, 'drop')
+            client.send(constants.C.CHAT, constants.M.CHAT_MESSAGE, 'x' * 200)
+            client.send(constants.C.CHAT, constants.M.CHAT_MESSAGE, 'y')
+            queued = client.queued_bytes()
+            client.flush_batch()
+            client.write_queue_limit = None
+            return queued, client.metrics.counters['dropped_messages']
+
+        queued, dropped = run_with_server(test)
+        self.assertGreater(queued, 200)
+        self.assertEqual(dropped, 1)
+
+    def test_chunked_metrics(self):
+
+        async def test(manager, client):
+            # a letter sent in chunks counts like any other letter
+            client.send_chunked(constants.C.CHAT, constants.M.CHAT_MESSAGE, 'x' * 1000)
+            client.send(constants.C.CHAT, constants.M.CHAT_MESSAGE, 'x' * 1000)
+            counters = client.metrics.counters
+            key = (constants.C.CHAT, constants.M.CHAT_MESSAGE)
+            return counters[('messages_out',) + key], counters[('bytes_out',) + key]
+
+        messages, size = run_with_server(test)
+        self.assertEqual(messages, 2)
+        self.assertGreater(size, 2000)
+
+    def test_session_redirect(self):
+        idle_timeout = switches.SERVER_SESSION_IDLE_TIMEOUT
+        switches.SERVER_SESSION_IDLE_TIMEOUT = 0.2
+        self.addCleanup(setattr, switches, 'SERVER_SESSION_IDLE_TIMEOUT', idle_timeout)
+
+        async def test(manager, client):
+            # the session runs in another process and has its own port
+            redirect = await asyncio.wait_for(client.request(constants.C.LOBBY, constants.M.LOBBY_SESSION_CREATE,
+                                                             'Game'), 30)
+            session_client = await async_server.AsyncNetworkClient.connect(redirect['port'])
+            session_receiving = asyncio.ensure_future(session_client.run())
+            await session_client.negotiated.wait()
+            session_client.send(constants.C.GENERAL, constants.M.GENERAL_NAME, 'Alice')
+            names = await asyncio.wait_for(session_client.request(constants.C.LOBBY,
+                                                                  constants.M.LOBBY_CONNECTED_CLIENTS), 5)
+            joined = await asyncio.wait_for(client.request(constants.C.LOBBY, constants.M.LOBBY_SESSION_JOIN,
+                                                           redirect['session']), 5)
+            listed = await asyncio.wait_for(client.request(constants.C.LOBBY, constants.M.LOBBY_SESSION_LIST), 5)
+
+            # without clients the session ends
+            session_client.abort()
+            await asyncio.wait_for(session_receiving, 5)
+            while len(manager.session_router):
+                await asyncio.sleep(0.05)
+            return manager.server.sockets[0].getsockname()[1], redirect, names, joined, listed
+
+        port, redirect, names, joined, listed = run_with_server(test)
+        self.assertNotEqual(redirect['port'], port)
+        self.assertEqual(names, ['Alice'])
+        self.assertEqual(joined, redirect)
+        # the number of clients is reported by the session on its own time
+        self.assertEqual([(description['session'], description['port'], description['title'])
+                          for description in listed], [(redirect['session'], redirect['port'], 'Game')])
+
+
+class TestAsyncNetworkClient(unittest.TestCase):
+
+    def test_unexpected_acknowledgement(self):
+        # the accepting side never takes a codec from an acknowledgement, the connecting side only an offered one
+        client = async_server.AsyncNetworkClient(mock.Mock(), mock.Mock())
+        with self.assertLogs('imperialism_remake.server.async_server', 'WARNING'):
+            client._process_control((protocol.CONTROL_HELLO_ACK, 'pickle'))
+            client._offered_codecs = ['yaml']
+            client._process_control((protocol.CONTROL_HELLO_ACK, 'binary'))
+        self.assertEqual(client.codec, 'yaml')
+        self.assertFalse(client.negotiated.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests server/scenario_diff
+"""
+
+import copy
+import unittest
+from imperialism_remake.base import constants
+from imperialism_remake.server import scenario_diff
+
+
+def create_sections():
+    """
+    A small 4x3 scenario with one nation, two provinces and one river.
+    """
+    return {
+        constants.SCENARIO_FILE_PROPERTIES: {
+            constants.ScenarioProperty.TITLE: 'Test',
+            constants.ScenarioProperty.MAP_COLUMNS: 4,
+            constants.ScenarioProperty.MAP_ROWS: 3,
+            constants.ScenarioProperty.RIVERS: [{'name': 'Rhine', 'tiles': [[0, 0], [1, 1]]}]
+        },
+        constants.SCENARIO_FILE_MAPS: {
+            'terrain': [0] * 12,
+            'resource': [0] * 12
+        },
+        constants.SCENARIO_FILE_PROVINCES: {
+            0: {constants.ProvinceProperty.NAME: 'A', constants.ProvinceProperty.NATION: 0},
+            1: {constants.ProvinceProperty.NAME: 'B', constants.ProvinceProperty.NATION: 0}
+        },
+        constants.SCENARIO_FILE_NATIONS: {
+            0: {constants.NationProperty.NAME: 'X', constants.NationProperty.PROVINCES: [0, 1]}
+        }
+    }
+
+
+class TestScenarioDiff(unittest.TestCase):
+
+    def test_no_differences(self):
+        self.assertEqual(scenario_diff.diff(create_sections(), create_sections()), {})
+
+    def test_diff_and_patch(self):
+        old = create_sections()
+        new = copy.deepcopy(old)
+        new[constants.SCENARIO_FILE_MAPS]['terrain'][5] = 2
+        new[constants.SCENARIO_FILE_MAPS]['terrain'][6] = 3
+        new[constants.SCENARIO_FILE_MAPS]['terrain'][9] = 1
+        new[constants.SCENARIO_FILE_PROPERTIES][constants.ScenarioProperty.TITLE] = 'Other'
+        new[constants.SCENARIO_FILE_PROPERTIES][constants.ScenarioProperty.RIVERS].append({'name': 'Elbe',
+                                                                                          'tiles': [[3, 2]]})
+        new[constants.SCENARIO_FILE_PROVINCES][1][constants.ProvinceProperty.NAME] = 'C'
+        del new[constants.SCENARIO_FILE_NATIONS][0][constants.NationProperty.PROVINCES]
+
+        patch = scenario_diff.diff(old, new)
+        terrain = patch[constants.SCENARIO_FILE_MAPS]['terrain']
+        self.assertEqual(terrain['runs'], [[5, [2, 3]], [9, [1]]])
+        self.assertEqual(terrain['bounding_box'], (1, 1, 2, 2))
+        self.assertNotIn('resource', patch[constants.SCENARIO_FILE_MAPS])
+        self.assertEqual(patch[scenario_diff.RIVERS]['added'], {1: {'name': 'Elbe', 'tiles': [[3, 2]]}})
+        self.assertEqual(patch[constants.SCENARIO_FILE_PROVINCES]['changed'][1],
+                         {'set': {constants.ProvinceProperty.NAME: 'C'}})
+
+        self.assertEqual(scenario_diff.apply_patch(old, patch), new)
+        self.assertEqual(old, create_sections())
+
+    def test_rivers_with_the_same_name(self):
+        old = create_sections()
+        new = copy.deepcopy(old)
+        rivers = new[constants.SCENARIO_FILE_PROPERTIES][constants.ScenarioProperty.RIVERS]
+        rivers.append({'name': 'Rhine', 'tiles': [[2, 2]]})
+        rivers.insert(0, {'name': 'Rhine', 'tiles': [[3, 0]]})
+        patch = scenario_diff.diff(old, new)
+        self.assertEqual(scenario_diff.apply_patch(old, patch), new)
+        self.assertEqual(scenario_diff.apply_patch(new, scenario_diff.diff(new, old)), old)
+
+    def test_merge(self):
+        base = create_sections()
+        ours = copy.deepcopy(base)
+        theirs = copy.deepcopy(base)
+        ours[constants.SCENARIO_FILE_MAPS]['terrain'][0] = 1
+        ours[constants.SCENARIO_FILE_MAPS]['terrain'][1] = 1
+        theirs[constants.SCENARIO_FILE_MAPS]['terrain'][1] = 2
+        theirs[constants.SCENARIO_FILE_MAPS]['terrain'][11] = 2
+        ours[constants.SCENARIO_FILE_PROVINCES][0][constants.ProvinceProperty.NAME] = 'Ours'
+        theirs[constants.SCENARIO_FILE_PROVINCES][1][constants.ProvinceProperty.NAME] = 'Theirs'
+
+        merged, conflicts = scenario_diff.merge(base, ours, theirs)
+        self.assertEqual(merged[constants.SCENARIO_FILE_MAPS]['terrain'], [1, 1] + [0] * 9 + [2])
+        self.assertEqual(merged[constants.SCENARIO_FILE_PROVINCES][0][constants.ProvinceProperty.NAME], 'Ours')
+        self.assertEqual(merged[constants.SCENARIO_FILE_PROVINCES][1][constants.ProvinceProperty.NAME], 'Theirs')
+        self.assertEqual(conflicts, [(constants.SCENARIO_FILE_MAPS, 'terrain', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests server/server
+"""
+
+import multiprocessing
+import unittest
+from PyQt5 import QtCore, QtNetwork
+from imperialism_remake.server import server
+
+
+def setUpModule():
+    # the heartbeat of the server clients needs timers
+    global app
+    app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+
+class TestServerManager(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = server.ServerManager()
+
+    def tearDown(self):
+        for client in list(self.manager.server_clients):
+            self.manager.drop_client(client)
+        self.manager.stop_workers()
+
+    def test_stalled_local_client_is_kept(self):
+        # a busy single player client must not be disconnected, it could not reconnect over the pipe
+        connection, _ = multiprocessing.Pipe()
+        self.manager.add_local_client(connection)
+        client, = self.manager.server_clients
+        with self.assertLogs(server.logger, 'WARNING'):
+            client.stalled.emit(100.0)
+        self.assertIn(client, self.manager.server_clients)
+
+    def test_stalled_remote_client_is_dropped(self):
+        client = server.ServerNetworkClient(QtNetwork.QTcpSocket())
+        self.manager.add_client(client)
+        client.stalled.emit(100.0)
+        self.assertNotIn(client, self.manager.server_clients)
+
+
+if __name__ == '__main__':
+    unittest.main()
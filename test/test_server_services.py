@@ -0,0 +1,267 @@
+# Imperialism remake
+# Copyright (C) 2016 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Tests server/services
+"""
+
+import collections
+import concurrent.futures
+import os
+import queue
+import threading
+import unittest
+from imperialism_remake.base import constants, switches
+from imperialism_remake.lib import metrics, utils
+from imperialism_remake.server import services
+
+
+class Client:
+
+    def __init__(self):
+        self.name = ''
+        self.client_id = None
+        self.current_request = None
+        self.metrics = metrics.Metrics()
+        self.sent = []
+        self.local = True
+
+    def send(self, channel, action, content=None, reply_to=None):
+        self.sent.append(content)
+
+    def send_chunked(self, channel, action, content=None, reply_to=None):
+        self.sent.append(content)
+
+    def is_local(self):
+        return self.local
+
+    def abort(self):
+        pass
+
+
+class Services(services.ServerServices):
+
+    def __init__(self):
+        super().__init__()
+        self.callbacks = queue.Queue()
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        self.stop_workers()
+
+    def call_soon(self, callback):
+        self.callbacks.put(callback)
+
+    def run_callback(self):
+        self.callbacks.get(timeout=5)()
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def test_add_rename_remove(self):
+        registry = services.ClientRegistry()
+        first, second = Client(), Client()
+        registry.add(first)
+        registry.add(second)
+        self.assertNotEqual(first.client_id, second.client_id)
+        self.assertIs(registry.get(second.client_id), second)
+        registry.rename(first, 'Alice')
+        self.assertEqual(registry.with_name('Alice'), {first})
+        self.assertEqual(registry.with_name(''), {second})
+        registry.remove(first)
+        self.assertNotIn(first, registry)
+        self.assertEqual(list(registry), [second])
+        self.assertNotIn('Alice', registry.by_name)
+
+
+class TestChatHistory(unittest.TestCase):
+
+    def test_bounded_and_paged(self):
+        server = Services()
+        server.chat_history = collections.deque(maxlen=5)
+        client = Client()
+        server.add_client(client)
+        for index in range(8):
+            server.dispatcher.dispatch(client, constants.C.CHAT, constants.M.CHAT_MESSAGE, str(index))
+        self.assertEqual([record.text for record in server.chat_history], ['3', '4', '5', '6', '7'])
+
+        server.dispatcher.dispatch(client, constants.C.CHAT, constants.M.CHAT_LOG, {'number': 2})
+        page = client.sent.pop()
+        self.assertEqual([message[-1] for message in page['messages']], ['6', '7'])
+        server.dispatcher.dispatch(client, constants.C.CHAT, constants.M.CHAT_LOG,
+                                   {'number': 2, 'before': page['before']})
+        page = client.sent.pop()
+        self.assertEqual([message[-1] for message in page['messages']], ['4', '5'])
+        server.dispatcher.dispatch(client, constants.C.CHAT, constants.M.CHAT_LOG,
+                                   {'number': 2, 'before': page['before']})
+        page = client.sent.pop()
+        self.assertEqual(([message[-1] for message in page['messages']], page['before']), (['3'], None))
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_flood_is_dropped(self):
+        server = Services()
+        flooding, other = Client(), Client()
+        server.add_client(flooding)
+        server.add_client(other)
+        burst = services.RATE_LIMITS[constants.C.CHAT][1]
+        for index in range(burst + 10):
+            server.dispatcher.dispatch(flooding, constants.C.CHAT, constants.M.CHAT_MESSAGE, str(index))
+        self.assertEqual(len(server.chat_history), burst)
+        self.assertEqual(flooding.metrics.counters[('rate_limited', constants.C.CHAT, constants.M.CHAT_MESSAGE)], 10)
+        # other clients and channels are not limited by the flood
+        server.dispatcher.dispatch(other, constants.C.CHAT, constants.M.CHAT_MESSAGE, 'hi')
+        self.assertEqual(server.chat_history[-1].text, 'hi')
+        server.dispatcher.dispatch(flooding, constants.C.CHAT, constants.M.CHAT_LOG, None)
+        self.assertEqual(len(server.chat_history), burst + 1)
+        server.drop_client(flooding)
+        self.assertNotIn(flooding, server._rate_limiters)
+        server.stop()
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.max_clients = switches.SERVER_MAX_CLIENTS
+
+    def tearDown(self):
+        switches.SERVER_MAX_CLIENTS = self.max_clients
+
+    def test_client_limit(self):
+        switches.SERVER_MAX_CLIENTS = 2
+        server = Services()
+        for _ in range(2):
+            self.assertTrue(server.admit_connection())
+            server.add_client(Client())
+        with self.assertLogs(services.logger, 'WARNING'):
+            self.assertFalse(server.admit_connection())
+        self.assertEqual(server.dropped_metrics.counters['refused_connections'], 1)
+        server.stop()
+
+    def test_only_local_shutdown(self):
+        server = Services()
+        remote = Client()
+        remote.local = False
+        server.add_client(remote)
+        with self.assertLogs(services.logger, 'WARNING'):
+            server.dispatcher.dispatch(remote, constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN, None)
+        self.assertFalse(server.stopped)
+        server.dispatcher.dispatch(Client(), constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN, None)
+        self.assertTrue(server.stopped)
+
+
+class TestLag(unittest.TestCase):
+
+    def test_blocked_loop_names_slowest_handler(self):
+        server = Services()
+        client = Client()
+        server.add_client(client)
+        server.dispatcher.dispatch(client, constants.C.CHAT, constants.M.CHAT_MESSAGE, 'hi')
+        with self.assertLogs(services.logger, 'WARNING') as logs:
+            server.observe_lag(1)
+        self.assertIn('CHAT/CHAT_MESSAGE for client with id {}'.format(client.client_id), logs.output[0])
+        server.observe_lag(0)
+        summary = server.loop_lag.summary()
+        self.assertEqual((summary['count'], summary['max']), (2, 1))
+        server.stop()
+
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Services()
+        self.first, self.second = Client(), Client()
+        self.server.add_client(self.first)
+        self.server.add_client(self.second)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_reply_unless_dropped(self):
+        release = threading.Event()
+        first_job = self.server.workers.submit(release.wait)
+        second_job = self.server.workers.submit(release.wait)
+        self.server.wait_for(self.first, first_job, self.first.sent.append)
+        self.server.wait_for(self.second, second_job, self.second.sent.append)
+        self.server.drop_client(self.second)
+        release.set()
+        self.server.run_callback()
+        self.server.run_callback()
+        self.assertEqual(self.first.sent, [True])
+        self.assertEqual(self.second.sent, [])
+        self.assertEqual(self.server._waiting, {})
+
+    def test_same_job_twice(self):
+        # two requests of the same client waiting for the same job (e.g. the same preview) are both answered
+        release = threading.Event()
+        job = self.server.workers.submit(release.wait)
+        for request_id in (1, 2):
+            self.first.current_request = request_id
+            self.server.wait_for(self.first, job, lambda result, request_id=request_id: self.first.sent.append(
+                (request_id, result)))
+        self.server.wait_for(self.second, job, self.second.sent.append)
+        self.server.drop_client(self.second)
+        self.assertFalse(job.cancelled())
+        release.set()
+        self.server.run_callback()
+        self.assertEqual(self.first.sent, [(1, True), (2, True)])
+        self.assertEqual(self.second.sent, [])
+        self.assertEqual(self.server._waiting, {})
+
+    def test_done_job_and_direct_call_soon(self):
+        # a cached preview is a job that is already done, the Qt server calls back directly in its own thread
+        self.server.call_soon = lambda callback: callback()
+        job = concurrent.futures.Future()
+        job.set_result('preview')
+        self.server.wait_for(self.first, job, self.first.sent.append)
+        self.server.wait_for(self.first, job, self.first.sent.append)
+        self.assertEqual(self.first.sent, ['preview', 'preview'])
+        self.assertEqual(self.server._waiting, {})
+
+    def test_scenario_preview(self):
+        (_, scenario_file), = services.scenario_core_titles()
+        # only core scenarios
+        with self.assertLogs(services.logger, 'WARNING'):
+            outside = os.path.join(constants.CORE_SCENARIO_FOLDER, os.path.pardir, os.path.basename(scenario_file))
+            for content in ('/etc/passwd', outside):
+                self.server.dispatcher.dispatch(self.first, constants.C.LOBBY, constants.M.LOBBY_SCENARIO_PREVIEW,
+                                                content)
+        self.assertEqual(self.server._waiting, {})
+        self.server.dispatcher.dispatch(self.first, constants.C.LOBBY, constants.M.LOBBY_SCENARIO_PREVIEW,
+                                        scenario_file)
+        # cached with the size estimated by the job
+        self.server.run_callback()
+        self.server.run_callback()
+        preview, = self.first.sent
+        self.assertEqual(preview['scenario'], scenario_file)
+        self.assertEqual(self.server.preview_cache.size, utils.estimate_size(preview))
+
+    def test_cancel_waiting_jobs(self):
+        release = threading.Event()
+        # occupy all workers, then the job of the dropped client never starts
+        for _ in range(self.server.workers._max_workers):
+            self.server.workers.submit(release.wait)
+        job = self.server.workers.submit(release.wait)
+        self.server.wait_for(self.first, job, self.first.sent.append)
+        self.server.drop_client(self.first)
+        self.assertTrue(job.cancelled())
+        release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Measures decoding of typical letters (see lib/protocol.py): the unsafe YAML loader, the safe YAML loader with letter
+validation and the binary codec with letter validation.
+
+    benchmark_protocol.py [--repetitions 1000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+
+if __name__ == '__main__':
+
+    # add source directory to path if needed
+    source_directory = os.path.realpath(os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir,
+                                                     'source'))
+    if source_directory not in sys.path:
+        sys.path.insert(0, source_directory)
+
+    from imperialism_remake.base import constants
+    # registers the enums of the binary codec
+    from imperialism_remake.base import network  # noqa: F401
+    from imperialism_remake.lib import protocol, utils
+
+    parser = argparse.ArgumentParser(description='Benchmark decoding of letters.')
+    parser.add_argument('--repetitions', type=int, default=1000, help='number of decodings of each letter')
+    args = parser.parse_args()
+
+    letters = {
+        'chat message': {'channel': constants.C.CHAT, 'action': constants.M.CHAT_MESSAGE,
+                         'content': '12:00:00: Alice - Hello everyone!'},
+        'scenario list': {'channel': constants.C.LOBBY, 'action': constants.M.LOBBY_SCENARIO_CORE_LIST,
+                          'content': [('Scenario {}'.format(i), 'scenario{}.scenario'.format(i)) for i in range(10)]},
+        'preview': {'channel': constants.C.LOBBY, 'action': constants.M.LOBBY_SCENARIO_PREVIEW,
+                    'content': {constants.ScenarioProperty.TITLE: 'Europe', 'map': [i % 7 - 1 for i in range(6000)],
+                                'nations': {i: {constants.NationProperty.NAME: 'Nation {}'.format(i)}
+                                            for i in range(10)}}}
+    }
+
+    for name, letter in letters.items():
+        yaml_body = protocol.encode_yaml(letter)
+        binary_body = protocol.binary_codec.encode(letter)
+        print('{} ({} bytes yaml, {} bytes binary)'.format(name, len(yaml_body), len(binary_body)))
+        repetitions = max(1, args.repetitions * 100 // len(yaml_body))
+        decoders = (('unsafe yaml', lambda: utils.yaml.load(yaml_body.decode())),
+                    ('safe yaml + validation', lambda: protocol.decode_letter(protocol.KIND_YAML, yaml_body,
+                                                                              constants.C, constants.M)),
+                    ('binary + validation', lambda: protocol.decode_letter(protocol.KIND_BINARY, binary_body,
+                                                                           constants.C, constants.M)))
+        for decoder_name, decoder in decoders:
+            seconds = timeit.timeit(decoder, number=repetitions) / repetitions
+            print('  {:<25}{:>10.1f} us'.format(decoder_name, seconds * 1e6))
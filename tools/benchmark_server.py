@@ -0,0 +1,130 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Compares the Qt server (server/server.py) and the asyncio server (server/async_server.py). The server runs in its own
+process, many clients (asyncio) connect at once and then each sends a number of requests (system monitor update) and
+waits for all replies.
+
+    benchmark_server.py [--clients 200] [--messages 100] [--backend qt asyncio]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+
+def run_qt_server():
+    """
+    Runs the Qt server (in its own process) until it is shut down.
+    """
+    from PyQt5 import QtCore
+    from imperialism_remake.server import server
+
+    app = QtCore.QCoreApplication([])
+    server_manager = server.ServerManager()
+    server_manager.shutdown.connect(app.quit)
+    server_manager.start()
+    app.exec_()
+    server_manager.stop_workers()
+
+
+def run_asyncio_server():
+    """
+    Runs the asyncio server (in its own process) until it is shut down.
+    """
+    from imperialism_remake.server import async_server
+
+    asyncio.run(async_server.AsyncServerManager().serve())
+
+
+async def benchmark(number_clients, number_messages):
+    """
+    Connects the clients, sends the requests, waits for all replies and finally shuts the server down.
+
+    :return: Tuple of seconds for connecting and seconds for sending and receiving
+    """
+    from imperialism_remake.base import constants
+    from imperialism_remake.server.async_server import AsyncNetworkClient
+
+    # connect all clients (the server might need some time to start)
+    for attempt in range(50):
+        try:
+            first = await AsyncNetworkClient.connect(constants.NETWORK_PORT)
+            break
+        except ConnectionError:
+            await asyncio.sleep(0.1)
+    else:
+        raise RuntimeError('Server did not start.')
+    t0 = time.perf_counter()
+    connecting = [AsyncNetworkClient.connect(constants.NETWORK_PORT) for _ in range(number_clients - 1)]
+    clients = [first] + list(await asyncio.gather(*connecting))
+    tasks = [asyncio.ensure_future(client.run()) for client in clients]
+    await asyncio.gather(*[client.negotiated.wait() for client in clients])
+    connect_time = time.perf_counter() - t0
+
+    # each client sends requests and counts replies
+    done = asyncio.Event()
+    remaining = [number_clients * number_messages]
+
+    def receive(client, channel, action, content):
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            done.set()
+
+    t0 = time.perf_counter()
+    for client in clients:
+        client.connect_to_channel(constants.C.SYSTEM, receive)
+        for _ in range(number_messages):
+            client.send(constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE)
+    await done.wait()
+    message_time = time.perf_counter() - t0
+
+    # shut down
+    first.send(constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN)
+    await asyncio.sleep(0.5)
+    for client in clients:
+        client.abort()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return connect_time, message_time
+
+
+if __name__ == '__main__':
+
+    # add source directory to path if needed
+    source_directory = os.path.realpath(os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir,
+                                                     'source'))
+    if source_directory not in sys.path:
+        sys.path.insert(0, source_directory)
+
+    parser = argparse.ArgumentParser(description='Benchmark the Qt and the asyncio server.')
+    parser.add_argument('--clients', type=int, default=200, help='number of connected clients')
+    parser.add_argument('--messages', type=int, default=100, help='number of requests per client')
+    parser.add_argument('--backend', nargs='+', choices=('qt', 'asyncio'), default=('qt', 'asyncio'))
+    args = parser.parse_args()
+
+    servers = {'qt': run_qt_server, 'asyncio': run_asyncio_server}
+    for backend in args.backend:
+        process = multiprocessing.Process(target=servers[backend])
+        process.start()
+        connect_time, message_time = asyncio.run(benchmark(args.clients, args.messages))
+        process.join(10)
+        number = args.clients * args.messages
+        print('{}: connecting {} clients took {:.3f}s, {} requests and replies took {:.3f}s ({:.0f} per second)'
+              .format(backend, args.clients, connect_time, number, message_time, number / message_time))
@@ -0,0 +1,92 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Compares, patches and merges scenario files (see server/scenario_diff.py).
+
+    scenario_diff.py diff old.scenario new.scenario [--output changes.patch]
+    scenario_diff.py patch old.scenario changes.patch new.scenario
+    scenario_diff.py merge base.scenario ours.scenario theirs.scenario merged.scenario
+"""
+
+import argparse
+import os
+import sys
+
+
+def get_arguments():
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Compare, patch and merge scenario files.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser('diff', help='compare two scenarios')
+    command.add_argument('old')
+    command.add_argument('new')
+    command.add_argument('--output', help='store the patch in this file')
+
+    command = commands.add_parser('patch', help='apply a patch to a scenario')
+    command.add_argument('old')
+    command.add_argument('patch')
+    command.add_argument('new')
+
+    command = commands.add_parser('merge', help='three-way merge of two scenarios with a common base')
+    command.add_argument('base')
+    command.add_argument('ours')
+    command.add_argument('theirs')
+    command.add_argument('merged')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # add source directory to path if needed
+    source_directory = os.path.realpath(os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir,
+                                                     'source'))
+    if source_directory not in sys.path:
+        sys.path.insert(0, source_directory)
+
+    from imperialism_remake.lib import utils
+    from imperialism_remake.server import scenario_diff
+
+    args = get_arguments()
+
+    if args.command == 'diff':
+        patch = scenario_diff.diff(scenario_diff.read_scenario_sections(args.old),
+                                   scenario_diff.read_scenario_sections(args.new))
+        for line in scenario_diff.summary(patch) or ['no differences']:
+            print(line)
+        if args.output:
+            print('write to {}'.format(args.output))
+            utils.write_as_yaml(args.output, patch)
+
+    elif args.command == 'patch':
+        sections = scenario_diff.apply_patch(scenario_diff.read_scenario_sections(args.old),
+                                             utils.read_as_yaml(args.patch))
+        print('write to {}'.format(args.new))
+        scenario_diff.write_scenario_sections(args.new, sections)
+
+    elif args.command == 'merge':
+        sections, conflicts = scenario_diff.merge(scenario_diff.read_scenario_sections(args.base),
+                                                  scenario_diff.read_scenario_sections(args.ours),
+                                                  scenario_diff.read_scenario_sections(args.theirs))
+        for section, key, detail in conflicts:
+            print('conflict in {} at {} ({}), kept ours'.format(section, key, detail))
+        print('write to {}'.format(args.merged))
+        scenario_diff.write_scenario_sections(args.merged, sections)
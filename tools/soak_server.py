@@ -0,0 +1,116 @@
+# Imperialism remake
+# Copyright (C) 2014-16 Trilarion
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+"""
+Soak test of the client management of the Qt server (server/server.py) or the asyncio server (server/async_server.py).
+The server runs in its own process, in each round many clients (asyncio, at most 50 at once) connect, send their name,
+subscribe to the chat and disconnect again. After each round the number of clients on the server and the memory of the
+server process (resident set size, only on Linux) are printed, both should stay flat.
+
+    soak_server.py [--rounds 10] [--clients 500] [--backend qt]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+
+from benchmark_server import run_qt_server, run_asyncio_server
+
+
+def resident_memory(pid):
+    """
+    :param pid: Process id
+    :return: Resident set size of a process in MB or None if not available (only on Linux)
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+async def soak(pid, number_rounds, number_clients):
+    """
+    Connects and disconnects the clients in rounds while a monitor client watches the server and finally shuts the
+    server down.
+    """
+    from imperialism_remake.base import constants
+    from imperialism_remake.server.async_server import AsyncNetworkClient
+
+    # the monitor client (the server might need some time to start)
+    for attempt in range(50):
+        try:
+            monitor = await AsyncNetworkClient.connect(constants.NETWORK_PORT)
+            break
+        except ConnectionError:
+            await asyncio.sleep(0.1)
+    else:
+        raise RuntimeError('Server did not start.')
+    monitoring = asyncio.ensure_future(monitor.run())
+    await monitor.negotiated.wait()
+
+    # the Qt server listens with a backlog of 50 connections (fixed in Qt 5), more connecting at once would wait for
+    # retransmissions of TCP
+    connecting = asyncio.Semaphore(50)
+
+    async def connect_and_leave(index):
+        async with connecting:
+            client = await AsyncNetworkClient.connect(constants.NETWORK_PORT)
+            running = asyncio.ensure_future(client.run())
+            client.send(constants.C.GENERAL, constants.M.GENERAL_NAME, 'Soak {}'.format(index))
+            client.send(constants.C.CHAT, constants.M.CHAT_SUBSCRIBE)
+            # the reply shows that everything before was processed
+            await client.request(constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE)
+        client.abort()
+        await asyncio.gather(running, return_exceptions=True)
+
+    for round_number in range(number_rounds):
+        await asyncio.gather(*[connect_and_leave(index) for index in range(number_clients)])
+        # give the server some time to notice the disconnections
+        await asyncio.sleep(0.5)
+        update = await monitor.request(constants.C.SYSTEM, constants.M.SYSTEM_MONITOR_UPDATE)
+        memory = resident_memory(pid)
+        print('round {}: {} clients connected and disconnected, {} clients on the server, memory {}'.format(
+            round_number + 1, (round_number + 1) * number_clients, update['number_connected_clients'],
+            '{:.1f} MB'.format(memory) if memory is not None else 'n/a'))
+
+    monitor.send(constants.C.SYSTEM, constants.M.SYSTEM_SHUTDOWN)
+    await asyncio.sleep(0.5)
+    monitor.abort()
+    await asyncio.gather(monitoring, return_exceptions=True)
+
+
+if __name__ == '__main__':
+
+    # add source directory to path if needed
+    source_directory = os.path.realpath(os.path.join(os.path.abspath(os.path.dirname(__file__)), os.path.pardir,
+                                                     'source'))
+    if source_directory not in sys.path:
+        sys.path.insert(0, source_directory)
+
+    parser = argparse.ArgumentParser(description='Soak test of connecting and disconnecting clients.')
+    parser.add_argument('--rounds', type=int, default=10, help='number of rounds')
+    parser.add_argument('--clients', type=int, default=500, help='number of clients connecting in each round')
+    parser.add_argument('--backend', choices=('qt', 'asyncio'), default='qt')
+    args = parser.parse_args()
+
+    servers = {'qt': run_qt_server, 'asyncio': run_asyncio_server}
+    process = multiprocessing.Process(target=servers[args.backend])
+    process.start()
+    asyncio.run(soak(process.pid, args.rounds, args.clients))
+    process.join(10)